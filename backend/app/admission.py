@@ -0,0 +1,242 @@
+import math
+import os
+import time
+from collections import OrderedDict
+
+# Admission control in front of every route; ADMISSION_CONTROL=0 turns it off
+ADMISSION_CONTROL = os.getenv('ADMISSION_CONTROL', '1') != '0'
+# Writes (POST and friends: votes, device registration, login) per client IP
+ADMISSION_IP_RATE = float(os.getenv('ADMISSION_IP_RATE', '5'))
+ADMISSION_IP_BURST = float(os.getenv('ADMISSION_IP_BURST', '20'))
+# Reads get their own, larger per-IP budget and are never shed
+ADMISSION_READ_IP_RATE = float(os.getenv('ADMISSION_READ_IP_RATE', '20'))
+ADMISSION_READ_IP_BURST = float(os.getenv('ADMISSION_READ_IP_BURST', '60'))
+# Writes per worker from all clients together
+ADMISSION_GLOBAL_RATE = float(os.getenv('ADMISSION_GLOBAL_RATE', '1000'))
+ADMISSION_GLOBAL_BURST = float(os.getenv('ADMISSION_GLOBAL_BURST', '2000'))
+# Once write latency passes this, only ADMISSION_SHED_QUEUE writes may be in flight
+ADMISSION_LATENCY_MS = float(os.getenv('ADMISSION_LATENCY_MS', '250'))
+ADMISSION_SHED_QUEUE = int(os.getenv('ADMISSION_SHED_QUEUE', '64'))
+ADMISSION_MAX_IPS = int(os.getenv('ADMISSION_MAX_IPS', '100000'))
+# Reverse proxies in front of the app that append to X-Forwarded-For; 0 ignores the header
+TRUSTED_PROXY_HOPS = int(os.getenv('TRUSTED_PROXY_HOPS', '1'))
+
+WRITE_METHODS = frozenset(("POST", "PUT", "PATCH", "DELETE"))
+EXEMPT_PATHS = frozenset(("/", "/metrics"))
+# Weight of the newest write in the latency average
+LATENCY_SMOOTHING = 0.2
+# Idle buckets dropped per request, enough to keep pace with new IPs
+PRUNE_PER_CALL = 2
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, rate, burst, now):
+        """0 when a token was taken, otherwise seconds until one is available"""
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / rate
+
+
+class TokenBucketTable:
+    """One token bucket per client IP, kept in least-recently-used order.
+
+    A bucket untouched for burst / rate seconds has refilled, which is the
+    same as having no bucket, so each call drops a couple of those from the
+    old end. No request ever scans the table.
+    """
+
+    def __init__(self, rate, burst, max_keys=ADMISSION_MAX_IPS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.idle_after = burst / rate if rate > 0 else 0.0
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key, now):
+        if self.rate <= 0:
+            return 0.0
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.burst, now)
+        else:
+            self._buckets.move_to_end(key)
+        wait = bucket.take(self.rate, self.burst, now)
+        self._prune(now)
+        return wait
+
+    def _prune(self, now):
+        buckets = self._buckets
+        for _ in range(PRUNE_PER_CALL):
+            key, bucket = next(iter(buckets.items()))
+            if len(buckets) <= self.max_keys and now - bucket.updated < self.idle_after:
+                return
+            del buckets[key]
+            if not buckets:
+                return
+
+
+class AdmissionController:
+    """Per-worker admission decisions for the two lanes.
+
+    Reads only pass a per-IP bucket. Writes pass a per-IP bucket and the
+    worker-wide bucket, and are shed by queue depth while the average write
+    takes longer than ADMISSION_LATENCY_MS, so a saturated database gets a
+    bounded number of concurrent writers instead of a growing queue.
+    Everything runs on the event loop, so nothing is locked.
+    """
+
+    def __init__(self):
+        now = time.monotonic()
+        self.reads = TokenBucketTable(ADMISSION_READ_IP_RATE, ADMISSION_READ_IP_BURST)
+        self.writes = TokenBucketTable(ADMISSION_IP_RATE, ADMISSION_IP_BURST)
+        self.global_writes = TokenBucket(ADMISSION_GLOBAL_BURST, now)
+        self.latency_threshold = ADMISSION_LATENCY_MS / 1000
+        self.write_latency = 0.0
+        self.writes_in_flight = 0
+        self._counters = {
+            "admitted_reads": 0,
+            "admitted_writes": 0,
+            "limited_reads": 0,
+            "limited_writes": 0,
+            "limited_global": 0,
+            "shed_writes": 0,
+        }
+
+    def shedding(self):
+        return self.write_latency > self.latency_threshold
+
+    def admit_read(self, client_ip):
+        """None when admitted, else (status, retry_after_seconds)"""
+        wait = self.reads.take(client_ip, time.monotonic())
+        if wait:
+            self._counters["limited_reads"] += 1
+            return 429, wait
+        self._counters["admitted_reads"] += 1
+        return None
+
+    def admit_write(self, client_ip):
+        if self.shedding() and self.writes_in_flight >= ADMISSION_SHED_QUEUE:
+            self._counters["shed_writes"] += 1
+            return 503, self.write_latency
+
+        now = time.monotonic()
+        wait = self.writes.take(client_ip, now)
+        if wait:
+            self._counters["limited_writes"] += 1
+            return 429, wait
+        if ADMISSION_GLOBAL_RATE > 0:
+            wait = self.global_writes.take(ADMISSION_GLOBAL_RATE, ADMISSION_GLOBAL_BURST, now)
+            if wait:
+                self._counters["limited_global"] += 1
+                return 429, wait
+
+        self._counters["admitted_writes"] += 1
+        self.writes_in_flight += 1
+        return None
+
+    def write_done(self, elapsed):
+        self.writes_in_flight -= 1
+        self.write_latency += LATENCY_SMOOTHING * (elapsed - self.write_latency)
+
+    def stats(self):
+        return dict(
+            self._counters,
+            enabled=ADMISSION_CONTROL,
+            write_latency_ms=round(self.write_latency * 1000, 3),
+            writes_in_flight=self.writes_in_flight,
+            shedding=int(self.shedding()),
+            tracked_read_ips=len(self.reads),
+            tracked_write_ips=len(self.writes)
+        )
+
+
+admission = AdmissionController()
+
+REFUSAL_BODIES = {
+    429: b'{"success":false,"message":"Too many requests, please try again shortly"}',
+    503: b'{"success":false,"message":"The server is busy, please try again shortly"}'
+}
+
+
+def client_ip(scope, trusted_hops=TRUSTED_PROXY_HOPS):
+    """The client address for the IP rules, shared by admission and the vote endpoint.
+
+    Clients can put anything in X-Forwarded-For, so only the entries the
+    trusted proxies appended count: the `trusted_hops`-th from the right.
+    Without the header (or trusted proxies) it is the peer address.
+    """
+    if trusted_hops > 0:
+        forwarded = []
+        for name, value in scope["headers"]:
+            if name == b"x-forwarded-for":
+                forwarded.extend(address.strip() for address in value.decode("latin-1").split(","))
+        forwarded = [address for address in forwarded if address]
+        if forwarded:
+            # A shorter chain skipped a proxy; its first entry is still one a proxy wrote
+            return forwarded[-min(trusted_hops, len(forwarded))]
+    client = scope.get("client")
+    return client[0] if client else ""
+
+
+class AdmissionMiddleware:
+    """ASGI middleware answering 429 / 503 with Retry-After before a refused request reaches a route"""
+
+    def __init__(self, app, controller=admission):
+        self.app = app
+        self.controller = controller
+
+    async def _refuse(self, send, status, retry_after):
+        body = REFUSAL_BODIES[status]
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode())
+            ]
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ADMISSION_CONTROL or scope["path"] in EXEMPT_PATHS:
+            return await self.app(scope, receive, send)
+
+        controller = self.controller
+        if scope["method"] not in WRITE_METHODS:
+            refused = controller.admit_read(client_ip(scope))
+            if refused:
+                return await self._refuse(send, *refused)
+            return await self.app(scope, receive, send)
+
+        refused = controller.admit_write(client_ip(scope))
+        if refused:
+            return await self._refuse(send, *refused)
+
+        started = time.perf_counter()
+        done = False
+
+        async def send_timed(message):
+            nonlocal done
+            if message["type"] == "http.response.start" and not done:
+                done = True
+                controller.write_done(time.perf_counter() - started)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            if not done:
+                controller.write_done(time.perf_counter() - started)
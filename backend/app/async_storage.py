@@ -0,0 +1,511 @@
+import asyncio
+import os
+import random
+import re
+
+from starlette.concurrency import run_in_threadpool
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+from app import storage
+from app.cache import AsyncReadCache
+from app.metrics import metrics, storage_error
+from app.database import (
+    ADMIT_BALLOT_SQL,
+    BALLOT_INSERT_SQL,
+    BATCH_INSERT_BALLOTS_SQL,
+    BATCH_INSERT_IPS_SQL,
+    BATCH_INSERT_VOTES_SQL,
+    BATCH_IP_SEEN_SQL,
+    BATCH_LOCK_SQL,
+    BATCH_RATE_SQL,
+    BATCH_SEEN_SQL,
+    BATCH_TALLY_SQL,
+    CAST_VOTE_SQL,
+    CONCURRENT_USERS_SQL,
+    CURRENT_ELECTION_SQL,
+    ENSURE_CANDIDATE_SQL,
+    FAST_ADMIT_BALLOT_SQL,
+    PRESENCE_EXPIRE_SQL,
+    PRESENCE_TOUCH_SQL,
+    RATE_INCREMENT_SQL,
+    COUNTS_SQL,
+    HAS_IP_VOTED_SQL,
+    HAS_VOTED_SQL,
+    IP_VOTE_SQL,
+    RESET_SQL,
+    RESULTS_SQL,
+    TALLY_INCREMENT_SQL,
+    TIMELINE_SQL,
+    TALLY_SHARDS,
+    admit_ballot_params,
+    ballot_decided,
+    ballot_is_new,
+    ballot_rejection,
+    duplicate_filter,
+    batch_lookup_params,
+    load_registry_db,
+    plan_ballot_batch,
+    presence_expiry_due,
+    presence_seen,
+    presence_touch_params,
+    replicas
+)
+from app.registry import hash_tokens, registry, token_hash
+from app.replicas import REPLICA_CONNECT_TIMEOUT, REPLICA_POOL_MAX
+from app.results import build_counts, build_results
+from app.timeline import build_timeline, minute_start
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+ASYNC_DB_POOL_MIN = int(os.getenv('ASYNC_DB_POOL_MIN', '2'))
+ASYNC_DB_POOL_MAX = int(os.getenv('ASYNC_DB_POOL_MAX', '20'))
+ASYNC_DB_TIMEOUT = float(os.getenv('ASYNC_DB_TIMEOUT', '5'))
+ASYNC_DB_MAX_QUERIES = int(os.getenv('ASYNC_DB_MAX_QUERIES', '50000'))
+
+# Native asyncpg for the postgres backend; ASYNC_DB=0 (or asyncpg not
+# installed) falls back to the psycopg2 functions run in the threadpool
+USE_ASYNCPG = storage.backend.name == "postgres" and asyncpg is not None and os.getenv('ASYNC_DB', '1') != '0'
+
+def to_asyncpg(sql):
+    """Rewrite psycopg2 %s / %(name)s placeholders as $n; returns (sql, parameter names)"""
+    names = []
+
+    def placeholder(match):
+        if match.group(0) == '%%':
+            return '%'
+        name = match.group(1)
+        if name is not None and name in names:
+            return f"${names.index(name) + 1}"
+        names.append(name)
+        return f"${len(names)}"
+
+    return re.sub(r"%%|%\((\w+)\)s|%s", placeholder, sql), names
+
+ADMIT_BALLOT_ASYNC_SQL, ADMIT_BALLOT_PARAMS = to_asyncpg(ADMIT_BALLOT_SQL)
+FAST_ADMIT_BALLOT_ASYNC_SQL, FAST_ADMIT_BALLOT_PARAMS = to_asyncpg(FAST_ADMIT_BALLOT_SQL)
+CAST_VOTE_ASYNC_SQL, _ = to_asyncpg(CAST_VOTE_SQL)
+BALLOT_INSERT_ASYNC_SQL, _ = to_asyncpg(BALLOT_INSERT_SQL)
+ENSURE_CANDIDATE_ASYNC_SQL, ENSURE_CANDIDATE_PARAMS = to_asyncpg(ENSURE_CANDIDATE_SQL)
+IP_VOTE_ASYNC_SQL, _ = to_asyncpg(IP_VOTE_SQL)
+TALLY_INCREMENT_ASYNC_SQL, _ = to_asyncpg(TALLY_INCREMENT_SQL)
+RATE_INCREMENT_ASYNC_SQL, _ = to_asyncpg(RATE_INCREMENT_SQL)
+TIMELINE_ASYNC_SQL, _ = to_asyncpg(TIMELINE_SQL)
+HAS_VOTED_ASYNC_SQL, _ = to_asyncpg(HAS_VOTED_SQL)
+HAS_IP_VOTED_ASYNC_SQL, _ = to_asyncpg(HAS_IP_VOTED_SQL)
+PRESENCE_TOUCH_ASYNC_SQL, PRESENCE_TOUCH_PARAMS = to_asyncpg(PRESENCE_TOUCH_SQL)
+PRESENCE_EXPIRE_ASYNC_SQL = [to_asyncpg(statement)[0] for statement in PRESENCE_EXPIRE_SQL]
+CONCURRENT_USERS_ASYNC_SQL, _ = to_asyncpg(CONCURRENT_USERS_SQL)
+BATCH_SEEN_ASYNC_SQL, _ = to_asyncpg(BATCH_SEEN_SQL)
+BATCH_IP_SEEN_ASYNC_SQL, _ = to_asyncpg(BATCH_IP_SEEN_SQL)
+BATCH_INSERT_VOTES_ASYNC_SQL, _ = to_asyncpg(BATCH_INSERT_VOTES_SQL)
+BATCH_INSERT_IPS_ASYNC_SQL, _ = to_asyncpg(BATCH_INSERT_IPS_SQL)
+BATCH_INSERT_BALLOTS_ASYNC_SQL, _ = to_asyncpg(BATCH_INSERT_BALLOTS_SQL)
+BATCH_TALLY_ASYNC_SQL, _ = to_asyncpg(BATCH_TALLY_SQL)
+BATCH_RATE_ASYNC_SQL, _ = to_asyncpg(BATCH_RATE_SQL)
+
+read_cache = AsyncReadCache(storage.read_cache.ttl)
+
+_pool = None
+_pool_lock = None
+_replica_pools = {}
+
+async def get_pool():
+    global _pool, _pool_lock
+    if _pool is None:
+        if _pool_lock is None:
+            _pool_lock = asyncio.Lock()
+        async with _pool_lock:
+            if _pool is None:
+                _pool = await asyncpg.create_pool(
+                    DATABASE_URL,
+                    min_size=ASYNC_DB_POOL_MIN,
+                    max_size=ASYNC_DB_POOL_MAX,
+                    max_queries=ASYNC_DB_MAX_QUERIES,
+                    command_timeout=ASYNC_DB_TIMEOUT
+                )
+    return _pool
+
+async def get_replica_pool(replica):
+    global _pool_lock
+    pool = _replica_pools.get(replica.name)
+    if pool is None:
+        if _pool_lock is None:
+            _pool_lock = asyncio.Lock()
+        async with _pool_lock:
+            pool = _replica_pools.get(replica.name)
+            if pool is None:
+                pool = _replica_pools[replica.name] = await asyncpg.create_pool(
+                    replica.dsn,
+                    min_size=0,
+                    max_size=REPLICA_POOL_MAX,
+                    max_queries=ASYNC_DB_MAX_QUERIES,
+                    command_timeout=ASYNC_DB_TIMEOUT,
+                    timeout=REPLICA_CONNECT_TIMEOUT
+                )
+    return pool
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+    while _replica_pools:
+        await _replica_pools.popitem()[1].close()
+
+def acquire(pool):
+    return pool.acquire(timeout=ASYNC_DB_TIMEOUT)
+
+async def call_sync(func, *args):
+    # Unjournaled in-memory storage never blocks, so it runs inline; psycopg2, sqlite3,
+    # shared memory and the vote journal go to the threadpool
+    if storage.backend.blocking:
+        return await run_in_threadpool(func, *args)
+    return func(*args)
+
+async def category_id_for(category):
+    # None for a category that does not exist, after reloading the registry
+    # in case another worker or an operator has just added it
+    category_id = registry.category_id(category)
+    if category_id is None and registry.refresh_due():
+        await run_in_threadpool(load_registry_db)
+        category_id = registry.category_id(category)
+    return category_id
+
+async def candidate_id_for(conn, category_id, candidate_name):
+    # Created on first use, outside (and ahead of) the ballot's transaction
+    if candidate_name is None:
+        return None
+    candidate_id = registry.candidate_id(category_id, candidate_name)
+    if candidate_id is None:
+        params = {"category_id": category_id, "name": candidate_name}
+        args = [params[name] for name in ENSURE_CANDIDATE_PARAMS]
+        candidate_id = await conn.fetchval(ENSURE_CANDIDATE_ASYNC_SQL, *args)
+        if candidate_id is None:
+            # Committed concurrently after the first statement began
+            candidate_id = await conn.fetchval(ENSURE_CANDIDATE_ASYNC_SQL, *args)
+        registry.add_candidate(candidate_id, category_id, candidate_name)
+    return candidate_id
+
+async def fetch_read(sql, *args):
+    # database.fetch_read for asyncpg: a usable replica (health-checked by
+    # the psycopg2 side), else the primary. Never for duplicate checks.
+    replica = replicas.choose()
+    if replica is not None:
+        try:
+            pool = await get_replica_pool(replica)
+            async with acquire(pool) as conn:
+                rows = await conn.fetch(sql, *args)
+            replica.served()
+            return rows
+        except Exception as e:
+            replica.failed(e)
+            replicas.fell_back()
+
+    pool = await get_pool()
+    async with acquire(pool) as conn:
+        return await conn.fetch(sql, *args)
+
+async def _fetch_counts():
+    try:
+        rows = await fetch_read(COUNTS_SQL)
+        return build_counts((row['category'], row['count']) for row in rows)
+    except Exception as e:
+        storage_error("Database", e)
+        return build_counts([])
+
+@metrics.timed("get_counts")
+async def get_counts():
+    if not USE_ASYNCPG:
+        return await call_sync(storage.get_counts)
+    return await read_cache.get("counts", _fetch_counts)
+
+@metrics.timed("admit_ballot")
+async def admit_ballot(tokens: dict, category: str, candidate_name: str = None, client_ip: str = None):
+    if not USE_ASYNCPG:
+        return await call_sync(storage.admit_ballot, tokens, category, candidate_name, client_ip)
+
+    category_id = await category_id_for(category)
+    if category_id is None:
+        return "invalid_category"
+    hashed = hash_tokens(tokens)
+    fast = ballot_is_new(hashed, category_id, client_ip)
+    sql, names = (FAST_ADMIT_BALLOT_ASYNC_SQL, FAST_ADMIT_BALLOT_PARAMS) if fast else (ADMIT_BALLOT_ASYNC_SQL, ADMIT_BALLOT_PARAMS)
+    try:
+        pool = await get_pool()
+        async with acquire(pool) as conn:
+            params = admit_ballot_params(tokens, hashed, category_id, await candidate_id_for(conn, category_id, candidate_name), client_ip)
+            transaction = conn.transaction()
+            await transaction.start()
+            try:
+                row = await conn.fetchrow(sql, *[params[name] for name in names])
+                rejected_by = ballot_rejection(row, hashed, client_ip)
+            except BaseException:
+                await transaction.rollback()
+                raise
+            if rejected_by:
+                await transaction.rollback()
+            else:
+                await transaction.commit()
+    except Exception as e:
+        storage_error("Vote", e)
+        return "error"
+
+    ballot_decided(hashed, category_id, client_ip, rejected_by, fast)
+    if rejected_by is None:
+        read_cache.invalidate()
+    return rejected_by
+
+def _affected_rows(status):
+    # asyncpg returns the command tag, e.g. "INSERT 0 12"
+    return int(status.rsplit(' ', 1)[-1])
+
+class _BatchRaced(Exception):
+    pass
+
+async def _resolve_ballots(conn, ballots):
+    # (tokens, hashed, category_id, candidate_id, client_ip) per ballot, None for an unknown category
+    resolved = []
+    for tokens, category, candidate_name, client_ip in ballots:
+        category_id = await category_id_for(category)
+        if category_id is None:
+            resolved.append(None)
+            continue
+        candidate_id = await candidate_id_for(conn, category_id, candidate_name)
+        resolved.append((tokens, hash_tokens(tokens), category_id, candidate_id, client_ip))
+    return resolved
+
+@metrics.timed("admit_ballots")
+async def admit_ballots(ballots: list):
+    if not USE_ASYNCPG:
+        return await call_sync(storage.admit_ballots, ballots)
+
+    try:
+        pool = await get_pool()
+        async with acquire(pool) as conn:
+            resolved = await _resolve_ballots(conn, ballots)
+            token_params, ip_params = batch_lookup_params(resolved)
+            async with conn.transaction():
+                await conn.execute(BATCH_LOCK_SQL)
+                epoch = await conn.fetchval(CURRENT_ELECTION_SQL)
+                seen = [(row['token_hash'], row['category_id']) for row in await conn.fetch(BATCH_SEEN_ASYNC_SQL, *token_params, epoch)]
+                ip_seen = [(row['client_ip'], row['category_id']) for row in await conn.fetch(BATCH_IP_SEEN_ASYNC_SQL, *ip_params, epoch)]
+
+                rejections, vote_rows, ballot_rows, ip_rows, tally_rows = plan_ballot_batch(resolved, seen, ip_seen)
+                if vote_rows[0]:
+                    # A write outside the batch lock got in first: roll back and admit one by one
+                    if _affected_rows(await conn.execute(BATCH_INSERT_VOTES_ASYNC_SQL, epoch, *vote_rows)) != len(vote_rows[0]):
+                        raise _BatchRaced()
+                    if _affected_rows(await conn.execute(BATCH_INSERT_IPS_ASYNC_SQL, epoch, *ip_rows)) != len(ip_rows[0]):
+                        raise _BatchRaced()
+                    await conn.execute(BATCH_INSERT_BALLOTS_ASYNC_SQL, epoch, *ballot_rows)
+                    await conn.execute(BATCH_TALLY_ASYNC_SQL, epoch, *tally_rows)
+                    await conn.execute(BATCH_RATE_ASYNC_SQL, epoch, *tally_rows)
+            for ballot, rejected_by in zip(resolved, rejections):
+                if ballot:
+                    ballot_decided(ballot[1], ballot[2], ballot[4], rejected_by, False)
+    except _BatchRaced:
+        rejections = [await admit_ballot(*ballot) for ballot in ballots]
+    except Exception as e:
+        storage_error("Batch vote", e)
+        return ["error"] * len(ballots)
+
+    if None in rejections:
+        read_cache.invalidate()
+    return rejections
+
+@metrics.timed("cast_vote")
+async def cast_vote(device_token: str, category: str, candidate_name: str = None, client_ip: str = None):
+    if not USE_ASYNCPG:
+        return await call_sync(storage.cast_vote, device_token, category, candidate_name, client_ip)
+
+    category_id = await category_id_for(category)
+    if category_id is None:
+        return False
+    digest = token_hash(device_token)
+    try:
+        pool = await get_pool()
+        async with acquire(pool) as conn:
+            candidate_id = await candidate_id_for(conn, category_id, candidate_name)
+            async with conn.transaction():
+                epoch = await conn.fetchval(CURRENT_ELECTION_SQL)
+                status = await conn.execute(CAST_VOTE_ASYNC_SQL, epoch, digest, category_id)
+                inserted = status.endswith(' 1')
+                if inserted:
+                    shard = random.randrange(TALLY_SHARDS)
+                    await conn.execute(BALLOT_INSERT_ASYNC_SQL, epoch, device_token, category_id, candidate_id, client_ip)
+                    await conn.execute(TALLY_INCREMENT_ASYNC_SQL, epoch, category_id, candidate_id or 0, shard)
+                    await conn.execute(RATE_INCREMENT_ASYNC_SQL, epoch, category_id, shard)
+                if client_ip:
+                    await conn.execute(IP_VOTE_ASYNC_SQL, epoch, client_ip, category_id)
+    except Exception as e:
+        storage_error("Vote", e)
+        return False
+
+    if inserted:
+        ballot_decided({"device": digest}, category_id, client_ip, None, False)
+        read_cache.invalidate()
+    return inserted
+
+@metrics.timed("has_voted")
+async def has_voted(device_token: str):
+    return await call_sync(storage.has_voted, device_token)
+
+@metrics.timed("has_voted_for_category")
+async def has_voted_for_category(device_token: str, category: str):
+    if not USE_ASYNCPG:
+        return await call_sync(storage.has_voted_for_category, device_token, category)
+
+    category_id = await category_id_for(category)
+    if category_id is None:
+        return False
+    try:
+        pool = await get_pool()
+        async with acquire(pool) as conn:
+            return await conn.fetchval(HAS_VOTED_ASYNC_SQL, token_hash(device_token), category_id) is not None
+    except Exception as e:
+        storage_error("Check vote", e)
+        return False
+
+@metrics.timed("has_ip_voted_for_category")
+async def has_ip_voted_for_category(client_ip: str, category: str):
+    if not USE_ASYNCPG:
+        return await call_sync(storage.has_ip_voted_for_category, client_ip, category)
+
+    category_id = await category_id_for(category)
+    if category_id is None:
+        return False
+    try:
+        pool = await get_pool()
+        async with acquire(pool) as conn:
+            return await conn.fetchval(HAS_IP_VOTED_ASYNC_SQL, client_ip, category_id) is not None
+    except Exception as e:
+        storage_error("Check IP vote", e)
+        return False
+
+@metrics.timed("reset_all_votes")
+async def reset_all_votes():
+    if not USE_ASYNCPG:
+        return await call_sync(storage.reset_all_votes)
+
+    try:
+        pool = await get_pool()
+        async with acquire(pool) as conn:
+            async with conn.transaction():
+                for statement in RESET_SQL:
+                    await conn.execute(statement)
+        presence_seen.clear()
+        if duplicate_filter is not None:
+            duplicate_filter.clear()
+    except Exception as e:
+        storage_error("Reset", e)
+    read_cache.invalidate()
+
+@metrics.timed("update_user_activity")
+async def update_user_activity(device_token: str):
+    if not USE_ASYNCPG:
+        return await call_sync(storage.update_user_activity, device_token)
+
+    params = presence_touch_params(device_token)
+    if params is None:
+        return
+
+    try:
+        pool = await get_pool()
+        async with acquire(pool) as conn:
+            await conn.execute(PRESENCE_TOUCH_ASYNC_SQL, *[params[name] for name in PRESENCE_TOUCH_PARAMS])
+            cutoff = presence_expiry_due()
+            if cutoff is not None:
+                for statement in PRESENCE_EXPIRE_ASYNC_SQL:
+                    await conn.execute(statement, cutoff)
+    except Exception as e:
+        storage_error("User activity", e)
+
+async def _fetch_concurrent_users():
+    try:
+        rows = await fetch_read(CONCURRENT_USERS_ASYNC_SQL, presence_seen.cutoff())
+        return rows[0]['count'] if rows else 0
+    except Exception as e:
+        storage_error("Concurrent users", e)
+        return 0
+
+@metrics.timed("get_concurrent_users")
+async def get_concurrent_users():
+    if not USE_ASYNCPG:
+        return await call_sync(storage.get_concurrent_users)
+    return await read_cache.get("concurrent_users", _fetch_concurrent_users)
+
+async def _fetch_results():
+    try:
+        rows = await fetch_read(RESULTS_SQL)
+        return build_results((row['category'], row['candidate_name'], row['votes']) for row in rows)
+    except Exception as e:
+        storage_error("Results", e)
+        return {}
+
+@metrics.timed("get_results")
+async def get_results():
+    if not USE_ASYNCPG:
+        return await call_sync(storage.get_results)
+    return await read_cache.get("results", _fetch_results)
+
+@metrics.timed("get_timeline")
+async def get_timeline(first: int, last: int):
+    if not USE_ASYNCPG:
+        return await call_sync(storage.get_timeline, first, last)
+    try:
+        rows = await fetch_read(TIMELINE_ASYNC_SQL, minute_start(first), minute_start(last + 1))
+        return build_timeline(((row['minute'], row['category'], row['ballots']) for row in rows), first, last)
+    except Exception as e:
+        storage_error("Timeline", e)
+        return build_timeline([], first, last)
+
+def get_pool_stats():
+    if not USE_ASYNCPG:
+        return storage.get_pool_stats()
+    if _pool is None:
+        return {"driver": "asyncpg"}
+    return {
+        "driver": "asyncpg",
+        "min_size": _pool.get_min_size(),
+        "max_size": _pool.get_max_size(),
+        "size": _pool.get_size(),
+        "idle": _pool.get_idle_size(),
+        "in_use": _pool.get_size() - _pool.get_idle_size(),
+        "timeout": ASYNC_DB_TIMEOUT
+    }
+
+async def iter_ballots(category: str = None, since=None, until=None, fetch_size: int = 5000, election: int = None):
+    # Always the sync store: a server-side psycopg2 cursor streams the rows,
+    # and StreamingResponse advances the iterator in the threadpool. The
+    # query starts here, so it waits for a connection off the event loop.
+    return await call_sync(storage.iter_ballots, category, since, until, fetch_size, election)
+
+async def get_categories():
+    return await call_sync(storage.get_categories)
+
+def get_storage_backend():
+    return storage.backend.name
+
+def get_replica_stats():
+    return storage.get_replica_stats()
+
+def get_filter_stats():
+    return storage.get_filter_stats()
+
+def get_journal_stats():
+    return storage.get_journal_stats()
+
+def get_registry_stats():
+    return storage.get_registry_stats()
+
+def close_storage():
+    storage.close()
+
+def get_cache_stats():
+    if not USE_ASYNCPG:
+        return storage.get_cache_stats()
+    return read_cache.stats()
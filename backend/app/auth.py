@@ -1,59 +1,177 @@
-import hashlib
+import asyncio
+import hmac
+import multiprocessing
+import os
 import secrets
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from typing import Optional
 
+from app.kdf import pbkdf2
+from app.sessions import SessionStore, create_persistence
+
+# Password hashing runs in its own process pool so a burst of logins cannot
+# starve the threadpool or the event loop (KDF_WORKERS=0 hashes in the threadpool)
+KDF_WORKERS = int(os.getenv('KDF_WORKERS', str(min(2, os.cpu_count() or 1))))
+KDF_MAX_PENDING = int(os.getenv('KDF_MAX_PENDING', '32'))
+# Parameters for new hashes; each stored hash keeps the parameters it was made with
+KDF_ALGORITHM = "pbkdf2_sha256"
+KDF_ITERATIONS = int(os.getenv('KDF_ITERATIONS', '100000'))
+# Hashes in the original "salt:hash" format used 100000 iterations
+LEGACY_ITERATIONS = 100000
+
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', '10000'))
+
 # Simple in-memory user storage (replace with database in production)
 users_db = {}
-sessions_db = {}
 
-def hash_password(password: str) -> str:
-    """Hash password with salt"""
+class KDFBusy(Exception):
+    """Raised instead of queueing when KDF_MAX_PENDING hashes are already waiting"""
+
+_kdf_pool = None
+_kdf_pending = 0
+_kdf_lock = threading.Lock()
+
+def _get_kdf_pool():
+    global _kdf_pool
+    if _kdf_pool is None:
+        with _kdf_lock:
+            if _kdf_pool is None:
+                # spawn: forking a process that already runs threads is unsafe
+                _kdf_pool = ProcessPoolExecutor(KDF_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _kdf_pool
+
+def _kdf_done(_):
+    global _kdf_pending
+    with _kdf_lock:
+        _kdf_pending -= 1
+
+async def run_kdf(password: str, salt: str, iterations: int) -> str:
+    """PBKDF2 off the event loop; raises KDFBusy when the queue is full"""
+    global _kdf_pending
+    with _kdf_lock:
+        if _kdf_pending >= KDF_MAX_PENDING:
+            raise KDFBusy()
+        _kdf_pending += 1
+
+    if KDF_WORKERS > 0:
+        pool = _get_kdf_pool()
+        try:
+            future = pool.submit(pbkdf2, password, salt, iterations)
+        except BaseException:
+            _kdf_done(None)
+            raise
+        future.add_done_callback(_kdf_done)
+        try:
+            return await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            # A worker died; start a fresh pool for the next request
+            _reset_kdf_pool(pool)
+            raise KDFBusy()
+
+    try:
+        return await asyncio.get_running_loop().run_in_executor(None, pbkdf2, password, salt, iterations)
+    finally:
+        _kdf_done(None)
+
+def _reset_kdf_pool(pool):
+    global _kdf_pool
+    with _kdf_lock:
+        if _kdf_pool is pool:
+            _kdf_pool = None
+    pool.shutdown(wait=False)
+
+def shutdown_kdf_pool():
+    global _kdf_pool
+    if _kdf_pool is not None:
+        _kdf_pool.shutdown(wait=False, cancel_futures=True)
+        _kdf_pool = None
+
+def get_kdf_stats():
+    return {"workers": KDF_WORKERS, "pending": _kdf_pending, "max_pending": KDF_MAX_PENDING, "iterations": KDF_ITERATIONS}
+
+def parse_password_hash(hashed: str):
+    """(algorithm, iterations, salt, hash) for both the current and the legacy format"""
+    if hashed.count('$') == 3:
+        algorithm, iterations, salt, pwd_hash = hashed.split('$')
+        return algorithm, int(iterations), salt, pwd_hash
+    salt, pwd_hash = hashed.split(':')
+    return KDF_ALGORITHM, LEGACY_ITERATIONS, salt, pwd_hash
+
+def needs_rehash(hashed: str) -> bool:
+    algorithm, iterations, _, _ = parse_password_hash(hashed)
+    return hashed.count('$') != 3 or algorithm != KDF_ALGORITHM or iterations != KDF_ITERATIONS
+
+async def hash_password(password: str) -> str:
+    """Hash password with salt, recording the algorithm and iteration count"""
     salt = secrets.token_hex(16)
-    pwd_hash = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), 100000)
-    return f"{salt}:{pwd_hash.hex()}"
+    pwd_hash = await run_kdf(password, salt, KDF_ITERATIONS)
+    return f"{KDF_ALGORITHM}${KDF_ITERATIONS}${salt}${pwd_hash}"
 
-def verify_password(password: str, hashed: str) -> bool:
+async def verify_password(password: str, hashed: str) -> bool:
     """Verify password against hash"""
     try:
-        salt, pwd_hash = hashed.split(':')
-        return hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), 100000).hex() == pwd_hash
-    except:
+        algorithm, iterations, salt, pwd_hash = parse_password_hash(hashed)
+    except ValueError:
+        return False
+    if algorithm != KDF_ALGORITHM:
         return False
+    return hmac.compare_digest(await run_kdf(password, salt, iterations), pwd_hash)
+
+BUSY_RESPONSE = {"success": False, "message": "Too many sign-ins right now, please try again in a moment"}
 
-def create_user(email: str, password: str, name: str) -> dict:
+async def create_user(email: str, password: str, name: str) -> dict:
     """Create new user account"""
     if email in users_db:
         return {"success": False, "message": "Email already registered"}
-    
+
+    try:
+        password_hash = await hash_password(password)
+    except KDFBusy:
+        return BUSY_RESPONSE
+
+    # Another request may have registered the email while we were hashing
+    if email in users_db:
+        return {"success": False, "message": "Email already registered"}
+
     user_id = f"user_{int(time.time())}_{secrets.token_hex(4)}"
     users_db[email] = {
         "id": user_id,
         "email": email,
         "name": name,
-        "password": hash_password(password),
+        "password": password_hash,
         "created_at": time.time()
     }
-    
+
     return {"success": True, "message": "Account created successfully"}
 
-def authenticate_user(email: str, password: str) -> dict:
+async def authenticate_user(email: str, password: str) -> dict:
     """Authenticate user login"""
     if email not in users_db:
         return {"success": False, "message": "Invalid email or password"}
-    
+
     user = users_db[email]
-    if not verify_password(password, user["password"]):
-        return {"success": False, "message": "Invalid email or password"}
-    
+    try:
+        if not await verify_password(password, user["password"]):
+            return {"success": False, "message": "Invalid email or password"}
+        # Upgrade hashes made with older parameters while the password is at hand
+        if needs_rehash(user["password"]):
+            user["password"] = await hash_password(password)
+    except KDFBusy:
+        return BUSY_RESPONSE
+
     # Create session
     session_token = secrets.token_hex(32)
-    sessions_db[session_token] = {
+    sessions_db.create(session_token, {
         "user_id": user["id"],
         "email": email,
+        "name": user["name"],
         "created_at": time.time()
-    }
-    
+    })
+
     return {
         "success": True,
         "message": "Login successful",
@@ -65,31 +183,60 @@ def authenticate_user(email: str, password: str) -> dict:
         }
     }
 
+# token -> user projection, least recently used first
+_session_cache = OrderedDict()
+_session_cache_lock = threading.Lock()
+
+def _cache_session(token: str, user: dict):
+    with _session_cache_lock:
+        _session_cache[token] = user
+        _session_cache.move_to_end(token)
+        while len(_session_cache) > SESSION_CACHE_SIZE:
+            _session_cache.popitem(last=False)
+
+def _uncache_session(token: str):
+    with _session_cache_lock:
+        _session_cache.pop(token, None)
+
+# Expired, evicted and logged-out sessions also leave the verify cache
+sessions_db = SessionStore(persistence=create_persistence(), on_remove=_uncache_session)
+sessions_db.load()
+
+def get_session_stats():
+    return sessions_db.stats()
+
+def start_session_sweeper():
+    sessions_db.start()
+
+async def stop_session_sweeper():
+    await sessions_db.stop()
+
 def verify_session(token: str) -> Optional[dict]:
     """Verify session token"""
-    if token not in sessions_db:
-        return None
-    
-    session = sessions_db[token]
-    # Session expires after 24 hours
-    if time.time() - session["created_at"] > 86400:
-        del sessions_db[token]
+    # The store checks the 24 hour expiry and marks the session recently used
+    session = sessions_db.get(token)
+    if session is None:
         return None
-    
-    email = session["email"]
-    if email in users_db:
-        user = users_db[email]
-        return {
-            "id": user["id"],
-            "email": user["email"],
-            "name": user["name"]
-        }
-    
-    return None
+
+    with _session_cache_lock:
+        user = _session_cache.get(token)
+        if user is not None:
+            _session_cache.move_to_end(token)
+            return user
+
+    # The session record is the source of truth: users live only in this
+    # worker's memory, while sessions may have been persisted before a restart
+    name = session.get("name")
+    if not name:
+        name = users_db.get(session["email"], {}).get("name", "")
+    projection = {
+        "id": session["user_id"],
+        "email": session["email"],
+        "name": name
+    }
+    _cache_session(token, projection)
+    return projection
 
 def logout_user(token: str) -> bool:
     """Logout user by removing session"""
-    if token in sessions_db:
-        del sessions_db[token]
-        return True
-    return False
\ No newline at end of file
+    return sessions_db.delete(token)
@@ -0,0 +1,111 @@
+import os
+
+from app.registry import registry
+
+
+class StorageBackend:
+    """Interface every vote store implements; app/storage.py picks one at startup"""
+
+    name = None
+    # True when calls block on I/O and must run in the threadpool from async code
+    blocking = True
+
+    def init(self):
+        pass
+
+    def close(self):
+        pass
+
+    def get_counts(self):
+        raise NotImplementedError
+
+    def get_results(self):
+        raise NotImplementedError
+
+    def admit_ballot(self, tokens, category, candidate_name=None, client_ip=None):
+        """Check and record one ballot atomically; returns the rejecting rule or None"""
+        raise NotImplementedError
+
+    def admit_ballots(self, ballots):
+        """Group commit of (tokens, category, candidate_name, client_ip) ballots, decided in order"""
+        return [self.admit_ballot(*ballot) for ballot in ballots]
+
+    def cast_vote(self, device_token, category, candidate_name=None, client_ip=None):
+        raise NotImplementedError
+
+    def has_voted(self, device_token):
+        raise NotImplementedError
+
+    def has_voted_for_category(self, device_token, category):
+        raise NotImplementedError
+
+    def has_ip_voted_for_category(self, client_ip, category):
+        raise NotImplementedError
+
+    def reset_all_votes(self):
+        raise NotImplementedError
+
+    def update_user_activity(self, device_token):
+        raise NotImplementedError
+
+    def get_concurrent_users(self):
+        raise NotImplementedError
+
+    def iter_ballots(self, category=None, since=None, until=None, fetch_size=5000, election=None):
+        """Lists of (device_token, category, candidate_name, client_ip, created_at) rows, one per ballot.
+
+        Rows come from the current election unless `election` names an earlier
+        one. Raises NotImplementedError right away for stores that keep no
+        per-ballot rows, or no earlier elections, and ExportUnavailable when
+        the store cannot be read.
+        """
+        raise NotImplementedError(f"the {self.name} backend keeps no per-ballot rows to export")
+
+    def get_timeline(self, first, last):
+        """The /timeline payload: ballots per category for each minute number first..last"""
+        raise NotImplementedError
+
+    def get_categories(self):
+        """Category names in display order"""
+        return registry.names()
+
+    def get_pool_stats(self):
+        return {}
+
+    def get_replica_stats(self):
+        return {"configured": 0}
+
+    def get_filter_stats(self):
+        return {"enabled": False}
+
+    def get_journal_stats(self):
+        return {"enabled": False}
+
+    def get_registry_stats(self):
+        return registry.stats()
+
+
+def create_backend(name=None):
+    """Build the backend named by STORAGE_BACKEND (memory, shared, postgres, sqlite).
+
+    Defaults to postgres when DATABASE_URL is set and memory otherwise.
+    """
+    if name is None:
+        name = os.getenv('STORAGE_BACKEND') or ('postgres' if os.getenv('DATABASE_URL') else 'memory')
+
+    if name == 'postgres':
+        if os.getenv('DATABASE_URL'):
+            from app.backends.postgres import PostgresBackend
+            return PostgresBackend()
+        print("STORAGE_BACKEND=postgres needs DATABASE_URL, using in-memory storage")
+    elif name == 'shared':
+        from app.backends.shared import SharedMemoryBackend
+        return SharedMemoryBackend()
+    elif name == 'sqlite':
+        from app.backends.sqlite import SQLiteBackend
+        return SQLiteBackend()
+    elif name != 'memory':
+        print(f"Unknown STORAGE_BACKEND '{name}', using in-memory storage")
+
+    from app.backends.memory import MemoryBackend
+    return MemoryBackend()
@@ -0,0 +1,112 @@
+from app.backends import StorageBackend
+from app.journal import VOTE_JOURNAL_DIR, VoteJournal
+from app.memory_engine import MemoryVoteEngine
+from app.presence import PresenceTracker
+from app.results import build_counts, build_results
+from app.timeline import build_timeline
+
+
+class MemoryBackend(StorageBackend):
+    name = "memory"
+    blocking = False
+    # Per-process state, so one journal per process can rebuild it
+    journaled = True
+
+    def __init__(self):
+        self.engine = MemoryVoteEngine()
+        self.presence = PresenceTracker()
+        self.journal = None
+
+    def init(self):
+        if VOTE_JOURNAL_DIR and self.journaled:
+            journal = VoteJournal(self.engine, VOTE_JOURNAL_DIR)
+            replayed = journal.open()
+            self.journal = journal
+            # Journaled writes can wait on the gate, a file write or an fsync,
+            # so they go to the threadpool instead of running on the event loop
+            self.blocking = True
+            print(f"Vote journal: replayed {replayed} records from {VOTE_JOURNAL_DIR}")
+
+    def close(self):
+        if self.journal:
+            self.journal.close()
+
+    def get_counts(self):
+        return build_counts(self.engine.totals().items())
+
+    def get_results(self):
+        return build_results(self.engine.candidate_rows(), totals=self.engine.totals())
+
+    def admit_ballot(self, tokens, category, candidate_name=None, client_ip=None):
+        if not self.journal:
+            return self.engine.admit(tokens, category, candidate_name, client_ip)
+        with self.journal.gate.shared():
+            rejected_by = self.engine.admit(tokens, category, candidate_name, client_ip)
+            if rejected_by is None:
+                try:
+                    self.journal.record_ballot(tokens, category, candidate_name, client_ip)
+                except OSError:
+                    # Never acknowledge a ballot a restart would lose
+                    self.engine.retract(tokens, category, candidate_name, client_ip)
+                    return "error"
+        return rejected_by
+
+    def admit_ballots(self, ballots):
+        if not self.journal:
+            return [self.engine.admit(*ballot) for ballot in ballots]
+        with self.journal.gate.shared():
+            rejections = [self.engine.admit(*ballot) for ballot in ballots]
+            admitted = [ballot for ballot, rejected_by in zip(ballots, rejections) if rejected_by is None]
+            try:
+                self.journal.record_ballots(admitted)
+            except OSError:
+                for ballot in admitted:
+                    self.engine.retract(*ballot)
+                return ["error" if rejected_by is None else rejected_by for rejected_by in rejections]
+        return rejections
+
+    def cast_vote(self, device_token, category, candidate_name=None, client_ip=None):
+        if not self.journal:
+            return self.engine.admit({"device": device_token}, category, candidate_name, client_ip, check_ip=False) is None
+        with self.journal.gate.shared():
+            if self.engine.admit({"device": device_token}, category, candidate_name, client_ip, check_ip=False) is not None:
+                return False
+            try:
+                self.journal.record_ballot({"device": device_token}, category, candidate_name, client_ip)
+            except OSError:
+                # The IP was not checked, so it may belong to an earlier ballot: leave it
+                self.engine.retract({"device": device_token}, category, candidate_name)
+                return False
+        return True
+
+    def get_timeline(self, first, last):
+        return build_timeline(self.engine.timeline_rows(first, last), first, last, self.engine.categories)
+
+    def has_voted(self, device_token):
+        return self.engine.has_token(device_token)
+
+    def has_voted_for_category(self, device_token, category):
+        return self.engine.has_voted(device_token, category)
+
+    def has_ip_voted_for_category(self, client_ip, category):
+        return self.engine.has_ip_voted(client_ip, category)
+
+    def reset_all_votes(self):
+        if not self.journal:
+            self.engine.reset()
+            return
+        with self.journal.gate.exclusive():
+            # Journaled first: a reset that raises leaves the votes in place
+            self.journal.record_reset()
+            self.engine.reset()
+
+    def update_user_activity(self, device_token):
+        self.presence.touch(device_token)
+
+    def get_concurrent_users(self):
+        return self.presence.count()
+
+    def get_journal_stats(self):
+        if not self.journal:
+            return {"enabled": False}
+        return self.journal.stats()
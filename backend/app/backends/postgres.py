@@ -0,0 +1,69 @@
+from app.backends import StorageBackend
+from app import database
+
+
+class PostgresBackend(StorageBackend):
+    name = "postgres"
+
+    def init(self):
+        database.init_database()
+        database.warm_duplicate_filter()
+        database.replicas.start()
+
+    def close(self):
+        database.replicas.stop()
+
+    def get_counts(self):
+        return database.get_vote_counts()
+
+    def get_results(self):
+        return database.get_results_db()
+
+    def get_timeline(self, first, last):
+        return database.get_timeline_db(first, last)
+
+    def admit_ballot(self, tokens, category, candidate_name=None, client_ip=None):
+        return database.admit_ballot_db(tokens, category, candidate_name, client_ip)
+
+    def admit_ballots(self, ballots):
+        rejections = database.admit_ballots_db(ballots)
+        if rejections is None:
+            # A write outside the batch lock raced us; admit one by one instead
+            rejections = [database.admit_ballot_db(*ballot) for ballot in ballots]
+        return rejections
+
+    def cast_vote(self, device_token, category, candidate_name=None, client_ip=None):
+        return database.cast_vote_db(device_token, category, candidate_name, client_ip)
+
+    def has_voted(self, device_token):
+        return database.has_voted_db(device_token)
+
+    def has_voted_for_category(self, device_token, category):
+        return database.has_voted_for_category_db(device_token, category)
+
+    def has_ip_voted_for_category(self, client_ip, category):
+        return database.has_ip_voted_for_category_db(client_ip, category)
+
+    def reset_all_votes(self):
+        database.reset_all_votes_db()
+
+    def update_user_activity(self, device_token):
+        database.update_user_activity_db(device_token)
+
+    def get_concurrent_users(self):
+        return database.get_concurrent_users_db()
+
+    def iter_ballots(self, category=None, since=None, until=None, fetch_size=5000, election=None):
+        return database.iter_ballots_db(category, since, until, fetch_size, election)
+
+    def get_categories(self):
+        return database.get_categories_db()
+
+    def get_pool_stats(self):
+        return database.get_pool_stats()
+
+    def get_replica_stats(self):
+        return database.get_replica_stats()
+
+    def get_filter_stats(self):
+        return database.get_duplicate_filter_stats()
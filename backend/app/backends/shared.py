@@ -0,0 +1,27 @@
+from app.backends.memory import MemoryBackend
+from app.shared_engine import SharedPresenceTracker, SharedVoteEngine
+
+
+class SharedMemoryBackend(MemoryBackend):
+    """In-memory storage shared by every worker on the host through one shared-memory segment"""
+
+    name = "shared"
+    # Writes wait on a cross-process flock that another worker may hold, so
+    # calls go to the threadpool instead of stalling this worker's event loop
+    blocking = True
+    # The segment already outlives each worker, and every worker replaying
+    # its own journal into it would count ballots several times
+    journaled = False
+
+    def __init__(self):
+        super().__init__()
+        self.engine = SharedVoteEngine()
+        self.presence = SharedPresenceTracker()
+
+    def close(self):
+        super().close()
+        self.presence.close()
+        self.engine.close()
+
+    def get_pool_stats(self):
+        return dict(self.engine.stats(), **self.presence.stats())
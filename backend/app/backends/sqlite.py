@@ -0,0 +1,380 @@
+import os
+import sqlite3
+import threading
+
+from app.backends import StorageBackend
+from app.export import ExportUnavailable
+from app.metrics import storage_error
+from app.presence import PresenceTracker, current_bucket
+from app.registry import registry
+from app.results import build_counts, build_results
+from app.timeline import build_timeline
+
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'votes.db')
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+# Python's sqlite3 keeps this many prepared statements per connection, keyed by
+# SQL text, so the fixed statements below are compiled once per thread
+SQLITE_STATEMENT_CACHE = int(os.getenv('SQLITE_STATEMENT_CACHE', '64'))
+
+SCHEMA_SQL = [
+    '''
+    CREATE TABLE IF NOT EXISTS votes (
+        id INTEGER PRIMARY KEY,
+        device_token TEXT NOT NULL,
+        category TEXT NOT NULL,
+        candidate_name TEXT,
+        client_ip TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(device_token, category)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS ip_votes (
+        id INTEGER PRIMARY KEY,
+        client_ip TEXT NOT NULL,
+        category TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(client_ip, category)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS presence (
+        device_token TEXT PRIMARY KEY,
+        bucket INTEGER NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS presence_bucket_idx ON presence (bucket)',
+    '''
+    CREATE TABLE IF NOT EXISTS presence_counts (
+        bucket INTEGER PRIMARY KEY,
+        users INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    # One writer at a time, so no sharding is needed
+    '''
+    CREATE TABLE IF NOT EXISTS vote_tallies (
+        category TEXT NOT NULL,
+        candidate_name TEXT NOT NULL DEFAULT '',
+        votes INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (category, candidate_name)
+    )
+    ''',
+    # Ballots per category per minute number (Unix time // 60) for the timeline
+    '''
+    CREATE TABLE IF NOT EXISTS vote_rates (
+        minute INTEGER NOT NULL,
+        category TEXT NOT NULL,
+        ballots INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (minute, category)
+    )
+    '''
+]
+
+COUNTS_SQL = 'SELECT category, SUM(votes) FROM vote_tallies GROUP BY category'
+
+RESULTS_SQL = '''
+    SELECT category, candidate_name, SUM(votes) AS votes
+    FROM vote_tallies
+    GROUP BY category, candidate_name
+    ORDER BY votes DESC, candidate_name
+'''
+
+RESET_SQL = [
+    'DELETE FROM votes',
+    'DELETE FROM ip_votes',
+    'DELETE FROM vote_tallies',
+    'DELETE FROM vote_rates',
+    'DELETE FROM presence',
+    'DELETE FROM presence_counts'
+]
+
+HAS_TOKEN_SQL = 'SELECT 1 FROM votes WHERE device_token = ? LIMIT 1'
+
+HAS_VOTED_SQL = 'SELECT 1 FROM votes WHERE device_token = ? AND category = ?'
+
+HAS_IP_VOTED_SQL = 'SELECT 1 FROM ip_votes WHERE client_ip = ? AND category = ?'
+
+CAST_VOTE_SQL = 'INSERT OR IGNORE INTO votes (device_token, category, candidate_name, client_ip) VALUES (?, ?, ?, ?)'
+
+IP_VOTE_SQL = 'INSERT OR IGNORE INTO ip_votes (client_ip, category) VALUES (?, ?)'
+
+TALLY_INCREMENT_SQL = '''
+    INSERT INTO vote_tallies (category, candidate_name, votes) VALUES (?, ?, ?)
+    ON CONFLICT (category, candidate_name) DO UPDATE SET votes = votes + excluded.votes
+'''
+
+RATE_INCREMENT_SQL = '''
+    INSERT INTO vote_rates (minute, category, ballots) VALUES (CAST(strftime('%s', 'now') AS INTEGER) / 60, ?, 1)
+    ON CONFLICT (minute, category) DO UPDATE SET ballots = ballots + 1
+'''
+
+TIMELINE_SQL = 'SELECT minute, category, ballots FROM vote_rates WHERE minute BETWEEN ? AND ?'
+
+PRESENCE_PREVIOUS_SQL = 'SELECT bucket FROM presence WHERE device_token = ?'
+
+PRESENCE_MOVE_SQL = '''
+    INSERT INTO presence (device_token, bucket) VALUES (?, ?)
+    ON CONFLICT (device_token) DO UPDATE SET bucket = excluded.bucket
+'''
+
+PRESENCE_JOIN_SQL = '''
+    INSERT INTO presence_counts (bucket, users) VALUES (?, 1)
+    ON CONFLICT (bucket) DO UPDATE SET users = users + 1
+'''
+
+PRESENCE_LEAVE_SQL = 'UPDATE presence_counts SET users = users - 1 WHERE bucket = ?'
+
+PRESENCE_EXPIRE_SQL = [
+    'DELETE FROM presence_counts WHERE bucket < ?',
+    'DELETE FROM presence WHERE bucket < ?'
+]
+
+CONCURRENT_USERS_SQL = 'SELECT COALESCE(SUM(users), 0) FROM presence_counts WHERE bucket >= ?'
+
+# One row per ballot: the device: row, not its shadow tokens. Timestamps are
+# stored as UTC 'YYYY-MM-DD HH:MM:SS' text, so the bounds compare as strings
+EXPORT_BALLOTS_SQL = '''
+    SELECT substr(device_token, 8), category, candidate_name, client_ip,
+           strftime('%Y-%m-%dT%H:%M:%S', created_at)
+    FROM votes
+    WHERE device_token LIKE 'device:%'
+      AND (:category IS NULL OR category = :category)
+      AND (:since IS NULL OR created_at >= :since)
+      AND (:until IS NULL OR created_at < :until)
+    ORDER BY id
+'''
+
+
+class SQLiteBackend(StorageBackend):
+    """Single-file store in WAL mode for one-box deployments without Postgres.
+
+    Readers never block the writer under WAL. Each thread keeps its own
+    connection, and every write runs in a BEGIN IMMEDIATE transaction, so
+    duplicate checks and inserts are serialized across threads and worker
+    processes sharing the file.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self.presence_seen = PresenceTracker()
+        self._expired_until = None
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+                isolation_level=None,
+                check_same_thread=False,
+                cached_statements=SQLITE_STATEMENT_CACHE
+            )
+            conn.execute('PRAGMA journal_mode=WAL')
+            # NORMAL is durable across application crashes in WAL mode; only
+            # an OS crash can lose the last few commits
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _write(self, work):
+        # Runs work(conn) in one immediate transaction and returns its result
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = work(conn)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return result
+
+    def init(self):
+        try:
+            def create(conn):
+                for statement in SCHEMA_SQL:
+                    conn.execute(statement)
+            self._write(create)
+        except Exception as e:
+            storage_error("SQLite init", e)
+
+    def get_counts(self):
+        try:
+            return build_counts(self.connection().execute(COUNTS_SQL).fetchall())
+        except Exception as e:
+            storage_error("Database", e)
+            return build_counts([])
+
+    def get_results(self):
+        try:
+            return build_results(self.connection().execute(RESULTS_SQL).fetchall())
+        except Exception as e:
+            storage_error("Results", e)
+            return {}
+
+    def get_timeline(self, first, last):
+        try:
+            rows = self.connection().execute(TIMELINE_SQL, (first, last)).fetchall()
+        except Exception as e:
+            storage_error("Timeline", e)
+            rows = []
+        return build_timeline(rows, first, last)
+
+    def _admit(self, conn, tokens, category, candidate_name, client_ip):
+        # Caller holds the write lock, so check-then-insert cannot race
+        if registry.category_id(category) is None:
+            return "invalid_category"
+        for rule, token in tokens.items():
+            if conn.execute(HAS_VOTED_SQL, (token, category)).fetchone():
+                return rule
+        if client_ip and conn.execute(HAS_IP_VOTED_SQL, (client_ip, category)).fetchone():
+            return "ip"
+
+        conn.executemany(CAST_VOTE_SQL, [(token, category, candidate_name, client_ip)
+                                         for token in dict.fromkeys(tokens.values())])
+        if client_ip:
+            conn.execute(IP_VOTE_SQL, (client_ip, category))
+        conn.execute(TALLY_INCREMENT_SQL, (category, candidate_name or '', 1))
+        conn.execute(RATE_INCREMENT_SQL, (category,))
+        return None
+
+    def admit_ballot(self, tokens, category, candidate_name=None, client_ip=None):
+        try:
+            return self._write(lambda conn: self._admit(conn, tokens, category, candidate_name, client_ip))
+        except Exception as e:
+            storage_error("Vote", e)
+            return "error"
+
+    def admit_ballots(self, ballots):
+        # The whole batch shares one transaction and one WAL commit
+        try:
+            return self._write(lambda conn: [self._admit(conn, *ballot) for ballot in ballots])
+        except Exception as e:
+            storage_error("Batch vote", e)
+            return ["error"] * len(ballots)
+
+    def cast_vote(self, device_token, category, candidate_name=None, client_ip=None):
+        if registry.category_id(category) is None:
+            return False
+
+        def cast(conn):
+            inserted = conn.execute(CAST_VOTE_SQL, (device_token, category, candidate_name, client_ip)).rowcount > 0
+            if inserted:
+                conn.execute(TALLY_INCREMENT_SQL, (category, candidate_name or '', 1))
+                conn.execute(RATE_INCREMENT_SQL, (category,))
+            if client_ip:
+                conn.execute(IP_VOTE_SQL, (client_ip, category))
+            return inserted
+
+        try:
+            return self._write(cast)
+        except Exception as e:
+            storage_error("Vote", e)
+            return False
+
+    def _exists(self, sql, params, label):
+        try:
+            return self.connection().execute(sql, params).fetchone() is not None
+        except Exception as e:
+            storage_error(label, e)
+            return False
+
+    def has_voted(self, device_token):
+        return self._exists(HAS_TOKEN_SQL, (device_token,), "Check vote")
+
+    def has_voted_for_category(self, device_token, category):
+        return self._exists(HAS_VOTED_SQL, (device_token, category), "Check vote")
+
+    def has_ip_voted_for_category(self, client_ip, category):
+        return self._exists(HAS_IP_VOTED_SQL, (client_ip, category), "Check IP vote")
+
+    def reset_all_votes(self):
+        def reset(conn):
+            for statement in RESET_SQL:
+                conn.execute(statement)
+
+        try:
+            self._write(reset)
+            self.presence_seen.clear()
+        except Exception as e:
+            storage_error("Reset", e)
+
+    def update_user_activity(self, device_token):
+        # Same bucket scheme as the Postgres tables: at most one write per device per bucket
+        if not self.presence_seen.touch(device_token):
+            return
+        bucket = current_bucket(self.presence_seen.bucket_seconds)
+        cutoff = self.presence_seen.cutoff(bucket)
+        expire = self._expired_until != cutoff
+        self._expired_until = cutoff
+
+        def touch(conn):
+            previous = conn.execute(PRESENCE_PREVIOUS_SQL, (device_token,)).fetchone()
+            # Another worker sharing the file may have moved it already
+            if not previous or previous[0] < bucket:
+                conn.execute(PRESENCE_MOVE_SQL, (device_token, bucket))
+                conn.execute(PRESENCE_JOIN_SQL, (bucket,))
+                if previous:
+                    conn.execute(PRESENCE_LEAVE_SQL, (previous[0],))
+            if expire:
+                for statement in PRESENCE_EXPIRE_SQL:
+                    conn.execute(statement, (cutoff,))
+
+        try:
+            self._write(touch)
+        except Exception as e:
+            storage_error("User activity", e)
+
+    def get_concurrent_users(self):
+        try:
+            return self.connection().execute(CONCURRENT_USERS_SQL, (self.presence_seen.cutoff(),)).fetchone()[0]
+        except Exception as e:
+            storage_error("Concurrent users", e)
+            return 0
+
+    def iter_ballots(self, category=None, since=None, until=None, fetch_size=5000, election=None):
+        if election is not None:
+            raise NotImplementedError("the sqlite backend keeps only the current election")
+        # Run the query now, so a failure is raised before the response starts
+        batches = self._ballot_batches(category, since, until, fetch_size)
+        try:
+            next(batches)
+        except Exception as e:
+            raise ExportUnavailable(str(e)) from e
+        return batches
+
+    def _ballot_batches(self, category, since, until, fetch_size):
+        def bound(value):
+            return value.strftime('%Y-%m-%d %H:%M:%S') if value else None
+
+        # Its own connection: a response stream is advanced from whichever
+        # threadpool thread is free, so the per-thread connections cannot be used
+        conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+        try:
+            cur = conn.execute(EXPORT_BALLOTS_SQL, {"category": category, "since": bound(since), "until": bound(until)})
+            yield None
+            while True:
+                rows = cur.fetchmany(fetch_size)
+                if not rows:
+                    break
+                yield rows
+        except Exception as e:
+            storage_error("Export", e)
+            raise
+        finally:
+            conn.close()
+
+    def get_pool_stats(self):
+        return {
+            "driver": "sqlite3",
+            "path": self.path,
+            "connections": len(self._connections),
+            "statement_cache": SQLITE_STATEMENT_CACHE
+        }
@@ -0,0 +1,116 @@
+import math
+import os
+import threading
+
+from app.registry import token_hash
+
+# Per-worker pre-filter in front of the duplicate-vote checks
+DUPLICATE_FILTER = os.getenv('DUPLICATE_FILTER', '1') != '0'
+# Keys per category filter: every ballot adds all of its tokens (five from main.vote())
+DUPLICATE_FILTER_CAPACITY = int(os.getenv('DUPLICATE_FILTER_CAPACITY', '500000'))
+DUPLICATE_FILTER_FPR = float(os.getenv('DUPLICATE_FILTER_FPR', '0.01'))
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter sized for `capacity` keys at `fpr` false positives"""
+
+    def __init__(self, capacity=DUPLICATE_FILTER_CAPACITY, fpr=DUPLICATE_FILTER_FPR):
+        self.capacity = capacity
+        self.fpr = fpr
+        self.size = max(8, int(-capacity * math.log(fpr) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def _positions(self, digest):
+        # Keys are already 16-byte hashes; double hashing takes k positions from their two halves
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def add(self, key):
+        positions = self._positions(key)
+        with self._lock:
+            for position in positions:
+                self.bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def estimated_fpr(self):
+        # Expected rate at the current fill, which exceeds `fpr` once past capacity
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) ** self.hash_count
+
+
+class DuplicateFilter:
+    """One Bloom filter of token hashes per category, plus one per category for IPs.
+
+    A miss is definite for every vote this worker has written or loaded at
+    startup. Votes written by other workers are not seen, so a miss only
+    chooses the fast insert path; the unique constraints still decide.
+    """
+
+    def __init__(self, capacity=DUPLICATE_FILTER_CAPACITY, fpr=DUPLICATE_FILTER_FPR):
+        self.capacity = capacity
+        self.fpr = fpr
+        self._filters = {}
+        self._lock = threading.Lock()
+        self._counters = {"checks": 0, "definite_misses": 0, "probable_hits": 0, "miss_conflicts": 0}
+
+    def _filter(self, kind, category_id, create=False):
+        key = (kind, category_id)
+        bloom = self._filters.get(key)
+        if bloom is None and create:
+            with self._lock:
+                bloom = self._filters.setdefault(key, BloomFilter(self.capacity, self.fpr))
+        return bloom
+
+    def _might_contain(self, kind, category_id, digest):
+        bloom = self._filter(kind, category_id)
+        return bloom is not None and digest in bloom
+
+    def add_token(self, digest, category_id):
+        self._filter("token", category_id, create=True).add(digest)
+
+    def add_ip(self, client_ip, category_id):
+        self._filter("ip", category_id, create=True).add(token_hash(client_ip))
+
+    def ballot_is_new(self, hashed_tokens, category_id, client_ip=None):
+        """True when no token hash and not the IP can have voted in this category"""
+        self._counters["checks"] += 1
+        if any(self._might_contain("token", category_id, digest) for digest in hashed_tokens.values()) or \
+                (client_ip and self._might_contain("ip", category_id, token_hash(client_ip))):
+            self._counters["probable_hits"] += 1
+            return False
+        self._counters["definite_misses"] += 1
+        return True
+
+    def note_conflict(self):
+        # A definite miss that the database rejected: written by another worker
+        self._counters["miss_conflicts"] += 1
+
+    def record(self, hashed_tokens, category_id, client_ip=None):
+        for digest in hashed_tokens.values():
+            self.add_token(digest, category_id)
+        if client_ip:
+            self.add_ip(client_ip, category_id)
+
+    def clear(self):
+        with self._lock:
+            self._filters = {}
+
+    def stats(self):
+        filters = list(self._filters.values())
+        return dict(
+            self._counters,
+            enabled=True,
+            filters=len(filters),
+            keys=sum(bloom.count for bloom in filters),
+            capacity_per_filter=self.capacity,
+            target_fpr=self.fpr,
+            max_estimated_fpr=round(max((bloom.estimated_fpr() for bloom in filters), default=0.0), 6),
+            memory_bytes=sum(len(bloom.bits) for bloom in filters)
+        )
@@ -0,0 +1,148 @@
+import asyncio
+import functools
+import threading
+import time
+
+
+# Result handed to followers when the leader's load was cancelled
+_ABANDONED = object()
+
+
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ReadCache:
+    """Read-through micro-cache with single-flight loading for the polled read endpoints"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._inflight = {}
+        self._generation = 0
+        self._counters = {"hits": 0, "misses": 0, "coalesced": 0, "invalidations": 0, "errors": 0}
+
+    def get(self, key, loader):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._counters["hits"] += 1
+                return entry[1]
+            flight = self._inflight.get(key)
+            if flight is not None:
+                self._counters["coalesced"] += 1
+                leader = False
+            else:
+                flight = _Flight()
+                self._inflight[key] = flight
+                self._counters["misses"] += 1
+                generation = self._generation
+                leader = True
+
+        # Everyone but the first caller waits for the one computation in flight
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+                if flight.error is not None:
+                    self._counters["errors"] += 1
+                elif self.ttl > 0 and generation == self._generation:
+                    # Results loaded across an invalidation may predate the write, so don't keep them
+                    self._entries[key] = (time.monotonic() + self.ttl, flight.value)
+            flight.event.set()
+        return flight.value
+
+    def cached(self, key):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper():
+                return self.get(key, func)
+            return wrapper
+        return decorator
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self._counters["invalidations"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["ttl"] = self.ttl
+            stats["entries"] = len(self._entries)
+            stats["in_flight"] = len(self._inflight)
+        return stats
+
+
+class AsyncReadCache(ReadCache):
+    """ReadCache for coroutine loaders; concurrent misses await one shared future"""
+
+    async def get(self, key, loader):
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > time.monotonic():
+                    self._counters["hits"] += 1
+                    return entry[1]
+                future = self._inflight.get(key)
+                if future is not None:
+                    self._counters["coalesced"] += 1
+                    leader = False
+                else:
+                    future = asyncio.get_running_loop().create_future()
+                    self._inflight[key] = future
+                    self._counters["misses"] += 1
+                    generation = self._generation
+                    leader = True
+
+            if leader:
+                return await self._load(key, loader, future, generation)
+            value = await asyncio.shield(future)
+            # A cancelled leader only gave up its own request: one of its followers takes over
+            if value is not _ABANDONED:
+                return value
+
+    async def _load(self, key, loader, future, generation):
+        try:
+            value = await loader()
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[key]
+            if isinstance(e, asyncio.CancelledError):
+                future.set_result(_ABANDONED)
+            else:
+                with self._lock:
+                    self._counters["errors"] += 1
+                future.set_exception(e)
+                # Mark the exception retrieved in case nobody else was waiting
+                future.exception()
+            raise
+        with self._lock:
+            del self._inflight[key]
+            if self.ttl > 0 and generation == self._generation:
+                self._entries[key] = (time.monotonic() + self.ttl, value)
+        future.set_result(value)
+        return value
+
+    def cached(self, key):
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper():
+                return await self.get(key, func)
+            return wrapper
+        return decorator
@@ -1,18 +1,115 @@
 import os
+import random
+import threading
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import json
+from app.bloom import DUPLICATE_FILTER, DuplicateFilter
+from app.export import ExportUnavailable
+from app.metrics import storage_error
+from app.migrations import SEED_CATEGORIES_SQL, run_migrations
+from app.pool import ConnectionPool
+from app.presence import PresenceTracker, current_bucket
+from app.registry import VOTING_CATEGORIES, hash_tokens, registry, token_hash
+from app.replicas import PRIMARY_POSITION_SQL, ReplicaSet
+from app.results import build_counts, build_results
+from app.timeline import build_timeline, minute_start
 
 DATABASE_URL = os.getenv('DATABASE_URL')
 
+# Connection pool settings (tune to the Postgres max_connections budget per worker)
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '5'))
+DB_POOL_MAX_USES = int(os.getenv('DB_POOL_MAX_USES', '1000'))
+DB_POOL_CHECK_INTERVAL = float(os.getenv('DB_POOL_CHECK_INTERVAL', '0'))
+
+# Each (category, candidate) tally is split over this many rows so concurrent
+# ballots for the same candidate do not queue on one row lock
+TALLY_SHARDS = int(os.getenv('TALLY_SHARDS', '8'))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    if _pool is None and DATABASE_URL:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    DATABASE_URL,
+                    minconn=DB_POOL_MIN,
+                    maxconn=DB_POOL_MAX,
+                    timeout=DB_POOL_TIMEOUT,
+                    max_uses=DB_POOL_MAX_USES,
+                    check_interval=DB_POOL_CHECK_INTERVAL,
+                    cursor_factory=RealDictCursor
+                )
+    return _pool
+
 def get_db_connection():
     try:
-        if DATABASE_URL:
-            return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+        pool = get_pool()
+        if pool:
+            return pool.getconn()
     except Exception as e:
-        print(f"Database connection failed: {e}")
+        storage_error("Database connection", e)
     return None
 
+def release_db_connection(conn):
+    pool = get_pool()
+    if pool:
+        pool.putconn(conn)
+    else:
+        conn.close()
+
+def get_pool_stats():
+    pool = get_pool()
+    if not pool:
+        return {}
+    return pool.stats()
+
+def primary_wal_position():
+    # For replica lag: how far the primary's WAL has got, in bytes
+    conn = get_db_connection()
+    if not conn:
+        return None
+    try:
+        with conn.cursor() as cur:
+            cur.execute(PRIMARY_POSITION_SQL)
+            return cur.fetchone()['position']
+    finally:
+        release_db_connection(conn)
+
+# Optional streaming replicas for the polled totals (DATABASE_REPLICA_URLS)
+replicas = ReplicaSet(primary_position=primary_wal_position)
+
+def fetch_read(sql, params=None):
+    """Rows of a read-only query from a usable replica, else the primary; None without a connection.
+
+    Only for published totals: duplicate checks and anything else that
+    decides a ballot must read the primary.
+    """
+    replica = replicas.choose()
+    if replica is not None:
+        rows = replica.fetch(sql, params)
+        if rows is not None:
+            return rows
+        replicas.fell_back()
+    
+    conn = get_db_connection()
+    if not conn:
+        return None
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            return cur.fetchall()
+    finally:
+        release_db_connection(conn)
+
+def get_replica_stats():
+    return replicas.stats()
+
 def init_database():
     conn = get_db_connection()
     if not conn:
@@ -20,155 +117,783 @@ def init_database():
     
     try:
         with conn.cursor() as cur:
-            # Create tables
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS votes (
-                    id SERIAL PRIMARY KEY,
-                    device_token VARCHAR(255) NOT NULL,
-                    category VARCHAR(100) NOT NULL,
-                    candidate_name VARCHAR(255),
-                    client_ip VARCHAR(45),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(device_token, category)
-                )
-            ''')
-            
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS ip_votes (
-                    id SERIAL PRIMARY KEY,
-                    client_ip VARCHAR(45) NOT NULL,
-                    category VARCHAR(100) NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(client_ip, category)
-                )
-            ''')
-            
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS active_users (
-                    device_token VARCHAR(255) PRIMARY KEY,
-                    last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
+            # Schema changes live in app/migrations.py, one version each
+            run_migrations(cur, VOTING_CATEGORIES)
+            # Categories added to VOTING_CATEGORIES since the last start
+            cur.execute(SEED_CATEGORIES_SQL, (VOTING_CATEGORIES,))
             conn.commit()
     except Exception as e:
-        print(f"Database init error: {e}")
+        storage_error("Database init", e)
     finally:
-        conn.close()
+        release_db_connection(conn)
+    load_registry_db()
 
-def get_vote_counts():
+LOAD_CATEGORIES_SQL = 'SELECT id, name FROM categories ORDER BY position, id'
+
+LOAD_CANDIDATES_SQL = 'SELECT id, category_id, name FROM candidates'
+
+# Get-or-create: the SELECT covers a candidate that already existed. One
+# committed concurrently after this statement began is in neither half, so
+# the caller runs it again.
+ENSURE_CANDIDATE_SQL = '''
+    WITH inserted AS (
+        INSERT INTO candidates (category_id, name) VALUES (%(category_id)s, %(name)s)
+        ON CONFLICT (category_id, name) DO NOTHING
+        RETURNING id
+    )
+    SELECT id FROM inserted
+    UNION ALL
+    SELECT id FROM candidates WHERE category_id = %(category_id)s AND name = %(name)s
+    LIMIT 1
+'''
+
+def load_registry_db():
     conn = get_db_connection()
     if not conn:
-        return {"King": 0, "Queen": 0, "Prince": 0, "Princess": 0, "Best Costume Male": 0, "Best Costume Female": 0, "Best Performance Award": 0, "total": 0}
+        return
     
     try:
         with conn.cursor() as cur:
-            cur.execute('SELECT category, COUNT(*) as count FROM votes GROUP BY category')
-            results = cur.fetchall()
-            
-            counts = {"King": 0, "Queen": 0, "Prince": 0, "Princess": 0, "Best Costume Male": 0, "Best Costume Female": 0, "Best Performance Award": 0}
-            
-            for row in results:
-                if row['category'] in counts:
-                    counts[row['category']] = row['count']
-            
-            counts['total'] = sum(counts.values())
-            return counts
+            cur.execute(LOAD_CATEGORIES_SQL)
+            categories = [(row['id'], row['name']) for row in cur.fetchall()]
+            cur.execute(LOAD_CANDIDATES_SQL)
+            candidates = [(row['id'], row['category_id'], row['name']) for row in cur.fetchall()]
+        conn.rollback()
+        registry.load(categories, candidates)
     except Exception as e:
-        print(f"Database error: {e}")
-        return {"King": 0, "Queen": 0, "Prince": 0, "Princess": 0, "Best Costume Male": 0, "Best Costume Female": 0, "Best Performance Award": 0, "total": 0}
+        storage_error("Registry load", e)
     finally:
-        conn.close()
+        release_db_connection(conn)
+
+def category_id_db(category):
+    # None for a category that does not exist, after reloading the registry
+    # in case another worker or an operator has just added it
+    category_id = registry.category_id(category)
+    if category_id is None and registry.refresh_due():
+        load_registry_db()
+        category_id = registry.category_id(category)
+    return category_id
+
+def candidate_id_db(conn, category_id, candidate_name):
+    # Created and committed on first use, ahead of the ballot that names it
+    if candidate_name is None:
+        return None
+    candidate_id = registry.candidate_id(category_id, candidate_name)
+    if candidate_id is not None:
+        return candidate_id
+    
+    params = {"category_id": category_id, "name": candidate_name}
+    with conn.cursor() as cur:
+        cur.execute(ENSURE_CANDIDATE_SQL, params)
+        row = cur.fetchone()
+        if row is None:
+            cur.execute(ENSURE_CANDIDATE_SQL, params)
+            row = cur.fetchone()
+    conn.commit()
+    registry.add_candidate(row['id'], category_id, candidate_name)
+    return row['id']
+
+def get_categories_db():
+    if registry.refresh_due():
+        load_registry_db()
+    return registry.names()
+
+# Statements shared with the asyncpg backend in app/async_storage.py
+
+# The election (round) votes are counted in: the newest row of elections, a
+# one-entry backward scan of its primary key. Statements embed it so every
+# worker follows a reset at once, with nothing cached.
+CURRENT_ELECTION_SQL = 'SELECT max(id) AS epoch FROM elections'
+
+COUNTS_SQL = '''
+    SELECT c.name as category, SUM(t.votes)::bigint as count
+    FROM vote_tallies t JOIN categories c ON c.id = t.category_id
+    WHERE t.epoch = (SELECT max(id) FROM elections)
+    GROUP BY c.name
+'''
+
+RESULTS_SQL = '''
+    SELECT c.name as category, COALESCE(k.name, '') as candidate_name, SUM(t.votes)::bigint as votes
+    FROM vote_tallies t
+    JOIN categories c ON c.id = t.category_id
+    LEFT JOIN candidates k ON k.id = t.candidate_id
+    WHERE t.epoch = (SELECT max(id) FROM elections)
+    GROUP BY c.name, k.name
+    ORDER BY votes DESC, candidate_name
+'''
+
+# Opening the next election is one insert, whatever was recorded in this
+# one; earlier rounds stay in place for audit. Presence is per device and
+# small, so it is still cleared. Categories and candidates stay registered.
+RESET_SQL = [
+    'INSERT INTO elections DEFAULT VALUES',
+    'DELETE FROM presence',
+    'DELETE FROM presence_counts'
+]
+
+# Moves a device into the current bucket: +1 there, -1 in the bucket it left
+PRESENCE_TOUCH_SQL = '''
+    WITH previous AS (
+        SELECT bucket FROM presence WHERE device_token = %(device_token)s FOR UPDATE
+    ), moved AS (
+        INSERT INTO presence (device_token, bucket) VALUES (%(device_token)s, %(bucket)s)
+        ON CONFLICT (device_token) DO UPDATE SET bucket = EXCLUDED.bucket
+        WHERE presence.bucket < EXCLUDED.bucket
+        RETURNING 1
+    ), joined AS (
+        INSERT INTO presence_counts (bucket, users)
+        SELECT %(bucket)s, 1 WHERE EXISTS (SELECT 1 FROM moved)
+        ON CONFLICT (bucket) DO UPDATE SET users = presence_counts.users + 1
+    )
+    UPDATE presence_counts SET users = users - 1
+    WHERE bucket = (SELECT bucket FROM previous) AND EXISTS (SELECT 1 FROM moved)
+'''
+
+# Run once per bucket rollover, not per request
+PRESENCE_EXPIRE_SQL = [
+    'DELETE FROM presence_counts WHERE bucket < %s',
+    'DELETE FROM presence WHERE bucket < %s'
+]
+
+CONCURRENT_USERS_SQL = 'SELECT COALESCE(SUM(users), 0)::bigint as count FROM presence_counts WHERE bucket >= %s'
+
+# Per-process filter so a device costs at most one write per bucket
+presence_seen = PresenceTracker()
+_presence_expired_until = None
+_presence_lock = threading.Lock()
+
+def presence_touch_params(device_token):
+    # None when this worker already recorded the device in the current bucket
+    if not presence_seen.touch(device_token):
+        return None
+    return {"device_token": device_token, "bucket": current_bucket(presence_seen.bucket_seconds)}
+
+def presence_expiry_due():
+    # The window cutoff the first time it advances past the last cleanup, else None
+    global _presence_expired_until
+    cutoff = presence_seen.cutoff()
+    with _presence_lock:
+        if _presence_expired_until == cutoff:
+            return None
+        _presence_expired_until = cutoff
+    return cutoff
+
+def get_vote_counts():
+    try:
+        rows = fetch_read(COUNTS_SQL) or []
+        return build_counts((row['category'], row['count']) for row in rows)
+    except Exception as e:
+        storage_error("Database", e)
+        return build_counts([])
+
+# The single-token writes take the epoch as a parameter, read once per
+# transaction with CURRENT_ELECTION_SQL, so all rows of a vote share it
+CAST_VOTE_SQL = 'INSERT INTO votes (epoch, token_hash, category_id) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING'
+
+BALLOT_INSERT_SQL = 'INSERT INTO ballots (epoch, device_token, category_id, candidate_id, client_ip) VALUES (%s, %s, %s, %s, %s)'
+
+IP_VOTE_SQL = 'INSERT INTO ip_votes (epoch, client_ip, category_id) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING'
+
+HAS_VOTED_SQL = 'SELECT 1 FROM votes WHERE epoch = (SELECT max(id) FROM elections) AND token_hash = %s AND category_id = %s'
+
+# A prefix of the primary key, so still an index-only scan
+HAS_TOKEN_SQL = 'SELECT 1 FROM votes WHERE epoch = (SELECT max(id) FROM elections) AND token_hash = %s LIMIT 1'
+
+HAS_IP_VOTED_SQL = 'SELECT 1 FROM ip_votes WHERE epoch = (SELECT max(id) FROM elections) AND client_ip = %s AND category_id = %s'
+
+TALLY_INCREMENT_SQL = '''
+    INSERT INTO vote_tallies (epoch, category_id, candidate_id, shard, votes)
+    VALUES (%s, %s, %s, %s, 1)
+    ON CONFLICT (epoch, category_id, candidate_id, shard)
+    DO UPDATE SET votes = vote_tallies.votes + 1
+'''
+
+# Same shard as the tally row; minutes are UTC, like ballots.created_at
+RATE_INCREMENT_SQL = '''
+    INSERT INTO vote_rates (epoch, minute, category_id, shard, ballots)
+    VALUES (%s, date_trunc('minute', now() AT TIME ZONE 'UTC'), %s, %s, 1)
+    ON CONFLICT (epoch, minute, category_id, shard)
+    DO UPDATE SET ballots = vote_rates.ballots + 1
+'''
+
+# A range of the vote_rates key: at most categories x shards rows per minute
+TIMELINE_SQL = '''
+    SELECT (EXTRACT(EPOCH FROM r.minute) / 60)::bigint AS minute, c.name AS category, SUM(r.ballots)::bigint AS ballots
+    FROM vote_rates r JOIN categories c ON c.id = r.category_id
+    WHERE r.epoch = (SELECT max(id) FROM elections) AND r.minute >= %s AND r.minute < %s
+    GROUP BY r.minute, c.name
+'''
 
 def cast_vote_db(device_token, category, candidate_name, client_ip=None):
+    category_id = category_id_db(category)
+    if category_id is None:
+        return False
     conn = get_db_connection()
     if not conn:
         return False
     
     try:
+        candidate_id = candidate_id_db(conn, category_id, candidate_name)
+        digest = token_hash(device_token)
         with conn.cursor() as cur:
+            cur.execute(CURRENT_ELECTION_SQL)
+            epoch = cur.fetchone()['epoch']
+    
             # Insert device vote
-            cur.execute(
-                'INSERT INTO votes (device_token, category, candidate_name, client_ip) VALUES (%s, %s, %s, %s) ON CONFLICT DO NOTHING',
-                (device_token, category, candidate_name, client_ip)
-            )
-            
+            cur.execute(CAST_VOTE_SQL, (epoch, digest, category_id))
+            inserted = cur.rowcount > 0
+    
+            if inserted:
+                shard = random.randrange(TALLY_SHARDS)
+                cur.execute(BALLOT_INSERT_SQL, (epoch, device_token, category_id, candidate_id, client_ip))
+                cur.execute(TALLY_INCREMENT_SQL, (epoch, category_id, candidate_id or 0, shard))
+                cur.execute(RATE_INCREMENT_SQL, (epoch, category_id, shard))
+    
             # Insert IP vote if provided
             if client_ip:
-                cur.execute(
-                    'INSERT INTO ip_votes (client_ip, category) VALUES (%s, %s) ON CONFLICT DO NOTHING',
-                    (client_ip, category)
-                )
-            
+                cur.execute(IP_VOTE_SQL, (epoch, client_ip, category_id))
+    
             conn.commit()
-            return cur.rowcount > 0
+            if inserted:
+                ballot_decided({"device": digest}, category_id, client_ip, None, False)
+            return inserted
     except Exception as e:
-        print(f"Vote error: {e}")
+        storage_error("Vote", e)
         return False
     finally:
-        conn.close()
+        release_db_connection(conn)
 
-def has_voted_for_category_db(device_token, category):
+# Checks every token hash and the IP for an earlier vote and records the
+# ballot in one statement. Returns None when admitted, otherwise the name of
+# the rule (key of `tokens`, or "ip") that rejected it.
+ADMIT_BALLOT_SQL = '''
+    WITH election AS (
+        SELECT max(id) AS epoch FROM elections
+    ), seen AS (
+        SELECT token_hash FROM votes
+        WHERE epoch = (SELECT epoch FROM election)
+          AND category_id = %(category_id)s::smallint AND token_hash = ANY(%(tokens)s::bytea[])
+    ), ip_seen AS (
+        SELECT client_ip FROM ip_votes
+        WHERE epoch = (SELECT epoch FROM election)
+          AND category_id = %(category_id)s::smallint AND client_ip = %(client_ip)s::varchar
+    ), ballot AS (
+        INSERT INTO votes (epoch, token_hash, category_id)
+        SELECT (SELECT epoch FROM election), token, %(category_id)s::smallint
+        FROM unnest(%(tokens)s::bytea[]) AS token
+        WHERE NOT EXISTS (SELECT 1 FROM seen) AND NOT EXISTS (SELECT 1 FROM ip_seen)
+        ON CONFLICT DO NOTHING
+        RETURNING token_hash
+    ), ip_ballot AS (
+        INSERT INTO ip_votes (epoch, client_ip, category_id)
+        SELECT (SELECT epoch FROM election), %(client_ip)s::varchar, %(category_id)s::smallint
+        WHERE %(client_ip)s::varchar IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM seen) AND NOT EXISTS (SELECT 1 FROM ip_seen)
+        ON CONFLICT DO NOTHING
+        RETURNING client_ip
+    ), audit AS (
+        INSERT INTO ballots (epoch, device_token, category_id, candidate_id, client_ip)
+        SELECT (SELECT epoch FROM election), %(device_token)s::varchar, %(category_id)s::smallint,
+               %(candidate_id)s::integer, %(client_ip)s::varchar
+        WHERE EXISTS (SELECT 1 FROM ballot)
+    ), tally AS (
+        INSERT INTO vote_tallies (epoch, category_id, candidate_id, shard, votes)
+        SELECT (SELECT epoch FROM election), %(category_id)s::smallint, COALESCE(%(candidate_id)s::integer, 0),
+               %(shard)s::smallint, 1
+        WHERE EXISTS (SELECT 1 FROM ballot)
+        ON CONFLICT (epoch, category_id, candidate_id, shard)
+        DO UPDATE SET votes = vote_tallies.votes + 1
+    ), rate AS (
+        INSERT INTO vote_rates (epoch, minute, category_id, shard, ballots)
+        SELECT (SELECT epoch FROM election), date_trunc('minute', now() AT TIME ZONE 'UTC'), %(category_id)s::smallint,
+               %(shard)s::smallint, 1
+        WHERE EXISTS (SELECT 1 FROM ballot)
+        ON CONFLICT (epoch, minute, category_id, shard)
+        DO UPDATE SET ballots = vote_rates.ballots + 1
+    )
+    SELECT
+        ARRAY(SELECT token_hash FROM seen) AS seen_tokens,
+        EXISTS (SELECT 1 FROM ip_seen) AS ip_seen,
+        ARRAY(SELECT token_hash FROM ballot) AS inserted_tokens,
+        EXISTS (SELECT 1 FROM ip_ballot) AS ip_inserted
+'''
+
+# Fast path for ballots the duplicate filter has definitely not seen: no
+# lookups, just the inserts. The primary keys still catch a duplicate
+# (partial insert), which ballot_rejection reports and the caller rolls back.
+FAST_ADMIT_BALLOT_SQL = '''
+    WITH election AS (
+        SELECT max(id) AS epoch FROM elections
+    ), ballot AS (
+        INSERT INTO votes (epoch, token_hash, category_id)
+        SELECT (SELECT epoch FROM election), token, %(category_id)s::smallint
+        FROM unnest(%(tokens)s::bytea[]) AS token
+        ON CONFLICT DO NOTHING
+        RETURNING token_hash
+    ), ip_ballot AS (
+        INSERT INTO ip_votes (epoch, client_ip, category_id)
+        SELECT (SELECT epoch FROM election), %(client_ip)s::varchar, %(category_id)s::smallint
+        WHERE %(client_ip)s::varchar IS NOT NULL
+        ON CONFLICT DO NOTHING
+        RETURNING client_ip
+    ), audit AS (
+        INSERT INTO ballots (epoch, device_token, category_id, candidate_id, client_ip)
+        SELECT (SELECT epoch FROM election), %(device_token)s::varchar, %(category_id)s::smallint,
+               %(candidate_id)s::integer, %(client_ip)s::varchar
+        WHERE EXISTS (SELECT 1 FROM ballot)
+    ), tally AS (
+        INSERT INTO vote_tallies (epoch, category_id, candidate_id, shard, votes)
+        SELECT (SELECT epoch FROM election), %(category_id)s::smallint, COALESCE(%(candidate_id)s::integer, 0),
+               %(shard)s::smallint, 1
+        WHERE EXISTS (SELECT 1 FROM ballot)
+        ON CONFLICT (epoch, category_id, candidate_id, shard)
+        DO UPDATE SET votes = vote_tallies.votes + 1
+    ), rate AS (
+        INSERT INTO vote_rates (epoch, minute, category_id, shard, ballots)
+        SELECT (SELECT epoch FROM election), date_trunc('minute', now() AT TIME ZONE 'UTC'), %(category_id)s::smallint,
+               %(shard)s::smallint, 1
+        WHERE EXISTS (SELECT 1 FROM ballot)
+        ON CONFLICT (epoch, minute, category_id, shard)
+        DO UPDATE SET ballots = vote_rates.ballots + 1
+    )
+    SELECT
+        ARRAY[]::bytea[] AS seen_tokens,
+        FALSE AS ip_seen,
+        ARRAY(SELECT token_hash FROM ballot) AS inserted_tokens,
+        EXISTS (SELECT 1 FROM ip_ballot) AS ip_inserted
+'''
+
+WARM_VOTES_SQL = 'SELECT token_hash, category_id FROM votes WHERE epoch = (SELECT max(id) FROM elections)'
+
+WARM_IPS_SQL = 'SELECT client_ip, category_id FROM ip_votes WHERE epoch = (SELECT max(id) FROM elections)'
+
+# Per-worker Bloom filters over votes / ip_votes (None when DUPLICATE_FILTER=0)
+duplicate_filter = DuplicateFilter() if DUPLICATE_FILTER else None
+
+def ballot_is_new(hashed, category_id, client_ip=None):
+    # True selects FAST_ADMIT_BALLOT_SQL, False the full ADMIT_BALLOT_SQL
+    return duplicate_filter is not None and duplicate_filter.ballot_is_new(hashed, category_id, client_ip)
+
+def ballot_decided(hashed, category_id, client_ip, rejected_by, fast):
+    # Feed the outcome of a committed (or rejected) ballot back into the filter
+    if duplicate_filter is None or rejected_by == "error":
+        return
+    if rejected_by is None:
+        duplicate_filter.record(hashed, category_id, client_ip)
+    elif fast:
+        duplicate_filter.note_conflict()
+
+def warm_duplicate_filter():
+    # Load every stored token hash and IP once at startup, streamed in chunks
+    if duplicate_filter is None:
+        return
+    conn = get_db_connection()
+    if not conn:
+        return
+    
+    try:
+        for sql, add in ((WARM_VOTES_SQL, duplicate_filter.add_token), (WARM_IPS_SQL, duplicate_filter.add_ip)):
+            with conn.cursor(name="warm_duplicate_filter") as cur:
+                cur.itersize = 10000
+                cur.execute(sql)
+                for row in cur:
+                    add(*row.values())
+        conn.rollback()
+    except Exception as e:
+        storage_error("Duplicate filter warm-up", e)
+    finally:
+        release_db_connection(conn)
+
+# One row per ballot, under its device token, from the current election
+# unless an earlier one is asked for
+EXPORT_BALLOTS_SQL = '''
+    SELECT regexp_replace(b.device_token, '^device:', ''), c.name, k.name, b.client_ip, b.created_at
+    FROM ballots b
+    JOIN categories c ON c.id = b.category_id
+    LEFT JOIN candidates k ON k.id = b.candidate_id
+    WHERE b.epoch = COALESCE(%(election)s::integer, (SELECT max(id) FROM elections))
+      AND (%(category)s::varchar IS NULL OR c.name = %(category)s::varchar)
+      AND (%(since)s::timestamp IS NULL OR b.created_at >= %(since)s::timestamp)
+      AND (%(until)s::timestamp IS NULL OR b.created_at < %(until)s::timestamp)
+    ORDER BY b.id
+'''
+
+def iter_ballots_db(category=None, since=None, until=None, fetch_size=5000, election=None):
+    """Lists of up to fetch_size ballot rows from a server-side cursor.
+    
+    The connection is checked out and the query started before this returns,
+    so a failure raises ExportUnavailable while the route can still answer
+    503. The connection is held until the batches are exhausted or closed.
+    """
+    conn = get_db_connection()
+    if not conn:
+        raise ExportUnavailable("no database connection")
+    
+    batches = _ballot_batches(conn, {"category": category, "since": since, "until": until, "election": election}, fetch_size)
+    try:
+        next(batches)
+    except Exception as e:
+        raise ExportUnavailable(str(e)) from e
+    return batches
+
+def _ballot_batches(conn, params, fetch_size):
+    # The first next() runs the query; from then on closing the generator,
+    # or dropping it, releases the connection
+    try:
+        with conn.cursor(name="export_ballots", cursor_factory=psycopg2.extensions.cursor) as cur:
+            cur.execute(EXPORT_BALLOTS_SQL, params)
+            yield None
+            while True:
+                rows = cur.fetchmany(fetch_size)
+                if not rows:
+                    break
+                yield rows
+    except Exception as e:
+        storage_error("Export", e)
+        raise
+    finally:
+        release_db_connection(conn)
+
+def get_duplicate_filter_stats():
+    if duplicate_filter is None:
+        return {"enabled": False}
+    return duplicate_filter.stats()
+
+def ballot_device_token(tokens):
+    # The token the ballot is exported under: main.vote() always sends "device"
+    return tokens.get("device") or next(iter(tokens.values()))
+
+def admit_ballot_params(tokens, hashed, category_id, candidate_id=None, client_ip=None):
+    return {
+        "tokens": list(dict.fromkeys(hashed.values())),
+        "category_id": category_id,
+        "candidate_id": candidate_id,
+        "device_token": ballot_device_token(tokens),
+        "client_ip": client_ip,
+        "shard": random.randrange(TALLY_SHARDS)
+    }
+
+def ballot_rejection(row, hashed, client_ip=None):
+    # Returns the rule that rejected the ballot, or None if every row went in.
+    # bytea comes back as memoryview from psycopg2 and bytes from asyncpg.
+    seen = set(map(bytes, row['seen_tokens']))
+    if seen or row['ip_seen']:
+        return next((rule for rule, digest in hashed.items() if digest in seen), "ip")
+    
+    # A concurrent ballot committed first: ON CONFLICT skipped some rows,
+    # so the partial insert must be undone and reported as that rule
+    inserted = set(map(bytes, row['inserted_tokens']))
+    if len(inserted) < len(set(hashed.values())) or (client_ip and not row['ip_inserted']):
+        return next((rule for rule, digest in hashed.items() if digest not in inserted), "ip")
+    
+    return None
+
+def admit_ballot_db(tokens, category, candidate_name=None, client_ip=None):
+    category_id = category_id_db(category)
+    if category_id is None:
+        return "invalid_category"
+    conn = get_db_connection()
+    if not conn:
+        return "error"
+    
+    try:
+        candidate_id = candidate_id_db(conn, category_id, candidate_name)
+        hashed = hash_tokens(tokens)
+        fast = ballot_is_new(hashed, category_id, client_ip)
+        with conn.cursor() as cur:
+            cur.execute(FAST_ADMIT_BALLOT_SQL if fast else ADMIT_BALLOT_SQL,
+                        admit_ballot_params(tokens, hashed, category_id, candidate_id, client_ip))
+            row = cur.fetchone()
+    
+        rejected_by = ballot_rejection(row, hashed, client_ip)
+        if rejected_by:
+            conn.rollback()
+        else:
+            conn.commit()
+        ballot_decided(hashed, category_id, client_ip, rejected_by, fast)
+        return rejected_by
+    except Exception as e:
+        storage_error("Vote", e)
+        return "error"
+    finally:
+        release_db_connection(conn)
+
+# Group commit: many ballots checked and written in one transaction. Batch
+# writers serialise on an advisory lock so check-then-insert cannot race.
+BATCH_LOCK_SQL = 'SELECT pg_advisory_xact_lock(727001)'
+
+# Every batch statement takes the epoch, read once after the lock, first
+BATCH_SEEN_SQL = '''
+    SELECT v.token_hash, v.category_id
+    FROM votes v
+    JOIN unnest(%s::bytea[], %s::smallint[]) AS b(token_hash, category_id)
+      ON v.epoch = %s AND v.token_hash = b.token_hash AND v.category_id = b.category_id
+'''
+
+BATCH_IP_SEEN_SQL = '''
+    SELECT v.client_ip, v.category_id
+    FROM ip_votes v
+    JOIN unnest(%s::varchar[], %s::smallint[]) AS b(client_ip, category_id)
+      ON v.epoch = %s AND v.client_ip = b.client_ip AND v.category_id = b.category_id
+'''
+
+BATCH_INSERT_VOTES_SQL = '''
+    INSERT INTO votes (epoch, token_hash, category_id)
+    SELECT %s, b.* FROM unnest(%s::bytea[], %s::smallint[]) AS b
+    ON CONFLICT DO NOTHING
+'''
+
+BATCH_INSERT_BALLOTS_SQL = '''
+    INSERT INTO ballots (epoch, device_token, category_id, candidate_id, client_ip)
+    SELECT %s, b.* FROM unnest(%s::varchar[], %s::smallint[], %s::integer[], %s::varchar[]) AS b
+'''
+
+BATCH_INSERT_IPS_SQL = '''
+    INSERT INTO ip_votes (epoch, client_ip, category_id)
+    SELECT %s, b.* FROM unnest(%s::varchar[], %s::smallint[]) AS b
+    ON CONFLICT DO NOTHING
+'''
+
+BATCH_TALLY_SQL = '''
+    INSERT INTO vote_tallies (epoch, category_id, candidate_id, shard, votes)
+    SELECT %s, b.* FROM unnest(%s::smallint[], %s::integer[], %s::smallint[], %s::bigint[]) AS b
+    ON CONFLICT (epoch, category_id, candidate_id, shard)
+    DO UPDATE SET votes = vote_tallies.votes + EXCLUDED.votes
+'''
+
+# The per-minute counts, summed from the same arrays as BATCH_TALLY_SQL
+BATCH_RATE_SQL = '''
+    INSERT INTO vote_rates (epoch, minute, category_id, shard, ballots)
+    SELECT %s, date_trunc('minute', now() AT TIME ZONE 'UTC'), b.category_id, b.shard, SUM(b.votes)
+    FROM unnest(%s::smallint[], %s::integer[], %s::smallint[], %s::bigint[]) AS b(category_id, candidate_id, shard, votes)
+    GROUP BY b.category_id, b.shard
+    ON CONFLICT (epoch, minute, category_id, shard)
+    DO UPDATE SET ballots = vote_rates.ballots + EXCLUDED.ballots
+'''
+
+def resolve_ballots_db(conn, ballots):
+    # (tokens, hashed, category_id, candidate_id, client_ip) per ballot, None for an unknown category
+    resolved = []
+    for tokens, category, candidate_name, client_ip in ballots:
+        category_id = category_id_db(category)
+        if category_id is None:
+            resolved.append(None)
+            continue
+        candidate_id = candidate_id_db(conn, category_id, candidate_name)
+        resolved.append((tokens, hash_tokens(tokens), category_id, candidate_id, client_ip))
+    return resolved
+
+def batch_lookup_params(resolved):
+    # (hashes, category ids) and (ips, category ids) arrays for the duplicate lookups
+    token_pairs = {(digest, ballot[2]) for ballot in resolved if ballot for digest in ballot[1].values()}
+    ip_pairs = {(ballot[4], ballot[2]) for ballot in resolved if ballot and ballot[4]}
+    return (
+        ([pair[0] for pair in token_pairs], [pair[1] for pair in token_pairs]),
+        ([pair[0] for pair in ip_pairs], [pair[1] for pair in ip_pairs])
+    )
+
+def plan_ballot_batch(resolved, seen, ip_seen):
+    """Decide each ballot in arrival order against stored votes and earlier ballots in the batch.
+    
+    Returns the per-ballot rejections (None when admitted) and the insert arrays.
+    """
+    seen = set(seen)
+    ip_seen = set(ip_seen)
+    rejections = []
+    vote_rows = ([], [])
+    ballot_rows = ([], [], [], [])
+    ip_rows = ([], [])
+    tallies = {}
+    
+    for ballot in resolved:
+        if ballot is None:
+            rejections.append("invalid_category")
+            continue
+        tokens, hashed, category_id, candidate_id, client_ip = ballot
+        rejected_by = next((rule for rule, digest in hashed.items() if (digest, category_id) in seen), None)
+        if rejected_by is None and client_ip and (client_ip, category_id) in ip_seen:
+            rejected_by = "ip"
+        rejections.append(rejected_by)
+        if rejected_by:
+            continue
+    
+        for digest in dict.fromkeys(hashed.values()):
+            seen.add((digest, category_id))
+            vote_rows[0].append(digest)
+            vote_rows[1].append(category_id)
+        for column, value in zip(ballot_rows, (ballot_device_token(tokens), category_id, candidate_id, client_ip)):
+            column.append(value)
+        if client_ip:
+            ip_seen.add((client_ip, category_id))
+            ip_rows[0].append(client_ip)
+            ip_rows[1].append(category_id)
+        key = (category_id, candidate_id or 0)
+        tallies[key] = tallies.get(key, 0) + 1
+    
+    tally_rows = (
+        [key[0] for key in tallies],
+        [key[1] for key in tallies],
+        [random.randrange(TALLY_SHARDS) for _ in tallies],
+        list(tallies.values())
+    )
+    return rejections, vote_rows, ballot_rows, ip_rows, tally_rows
+
+def admit_ballots_db(ballots):
+    # Returns one rejection per ballot, or None if a write outside the batch
+    # lock raced us and the caller should fall back to admitting one by one
+    conn = get_db_connection()
+    if not conn:
+        return ["error"] * len(ballots)
+    
+    try:
+        resolved = resolve_ballots_db(conn, ballots)
+        token_params, ip_params = batch_lookup_params(resolved)
+        with conn.cursor() as cur:
+            cur.execute(BATCH_LOCK_SQL)
+            cur.execute(CURRENT_ELECTION_SQL)
+            epoch = cur.fetchone()['epoch']
+            cur.execute(BATCH_SEEN_SQL, token_params + (epoch,))
+            seen = [(bytes(row['token_hash']), row['category_id']) for row in cur.fetchall()]
+            cur.execute(BATCH_IP_SEEN_SQL, ip_params + (epoch,))
+            ip_seen = [(row['client_ip'], row['category_id']) for row in cur.fetchall()]
+    
+            rejections, vote_rows, ballot_rows, ip_rows, tally_rows = plan_ballot_batch(resolved, seen, ip_seen)
+            if vote_rows[0]:
+                cur.execute(BATCH_INSERT_VOTES_SQL, (epoch,) + vote_rows)
+                if cur.rowcount != len(vote_rows[0]):
+                    conn.rollback()
+                    return None
+                cur.execute(BATCH_INSERT_IPS_SQL, (epoch,) + ip_rows)
+                if cur.rowcount != len(ip_rows[0]):
+                    conn.rollback()
+                    return None
+                cur.execute(BATCH_INSERT_BALLOTS_SQL, (epoch,) + ballot_rows)
+                cur.execute(BATCH_TALLY_SQL, (epoch,) + tally_rows)
+                cur.execute(BATCH_RATE_SQL, (epoch,) + tally_rows)
+    
+        conn.commit()
+        for ballot, rejected_by in zip(resolved, rejections):
+            if ballot:
+                ballot_decided(ballot[1], ballot[2], ballot[4], rejected_by, False)
+        return rejections
+    except Exception as e:
+        storage_error("Batch vote", e)
+        return ["error"] * len(ballots)
+    finally:
+        release_db_connection(conn)
+
+SESSIONS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS sessions (
+        token VARCHAR(64) PRIMARY KEY,
+        user_id VARCHAR(64) NOT NULL,
+        email VARCHAR(255) NOT NULL,
+        created_at DOUBLE PRECISION NOT NULL,
+        name VARCHAR(255) NOT NULL DEFAULT ''
+    );
+    ALTER TABLE sessions ADD COLUMN IF NOT EXISTS name VARCHAR(255) NOT NULL DEFAULT ''
+'''
+
+LOAD_SESSIONS_SQL = 'SELECT token, user_id, email, name, created_at FROM sessions'
+
+SAVE_SESSIONS_SQL = '''
+    INSERT INTO sessions (token, user_id, email, name, created_at)
+    SELECT * FROM unnest(%s::varchar[], %s::varchar[], %s::varchar[], %s::varchar[], %s::float8[])
+    ON CONFLICT (token) DO NOTHING
+'''
+
+DELETE_SESSIONS_SQL = 'DELETE FROM sessions WHERE token = ANY(%s)'
+
+def load_sessions_db():
+    conn = get_db_connection()
+    if not conn:
+        return {}
+    
+    try:
+        with conn.cursor() as cur:
+            cur.execute(SESSIONS_TABLE_SQL)
+            conn.commit()
+            cur.execute(LOAD_SESSIONS_SQL)
+            return {row['token']: {"user_id": row['user_id'], "email": row['email'], "name": row['name'], "created_at": row['created_at']}
+                    for row in cur.fetchall()}
+    except Exception as e:
+        storage_error("Session load", e)
+        return {}
+    finally:
+        release_db_connection(conn)
+
+def save_sessions_db(upserts, deletes):
+    # Raises so the session store keeps the changes for its next flush
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError("no database connection")
+    
+    try:
+        with conn.cursor() as cur:
+            if upserts:
+                cur.execute(SAVE_SESSIONS_SQL, (
+                    [token for token, _ in upserts],
+                    [session["user_id"] for _, session in upserts],
+                    [session["email"] for _, session in upserts],
+                    [session.get("name", "") for _, session in upserts],
+                    [session["created_at"] for _, session in upserts]
+                ))
+            if deletes:
+                cur.execute(DELETE_SESSIONS_SQL, (deletes,))
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+
+def has_voted_db(device_token):
     conn = get_db_connection()
     if not conn:
         return False
     
     try:
         with conn.cursor() as cur:
-            cur.execute('SELECT 1 FROM votes WHERE device_token = %s AND category = %s', (device_token, category))
+            cur.execute(HAS_TOKEN_SQL, (token_hash(device_token),))
             return cur.fetchone() is not None
     except Exception as e:
-        print(f"Check vote error: {e}")
+        storage_error("Check vote", e)
         return False
     finally:
-        conn.close()
+        release_db_connection(conn)
 
-def get_results_db():
+def has_voted_for_category_db(device_token, category):
+    category_id = category_id_db(category)
+    if category_id is None:
+        return False
     conn = get_db_connection()
     if not conn:
-        return {}
+        return False
     
     try:
         with conn.cursor() as cur:
-            categories = ["King", "Queen", "Prince", "Princess", "Best Costume Male", "Best Costume Female", "Best Performance Award"]
-            results = {}
-            
-            for category in categories:
-                cur.execute('''
-                    SELECT candidate_name, COUNT(*) as votes 
-                    FROM votes 
-                    WHERE category = %s AND candidate_name IS NOT NULL
-                    GROUP BY candidate_name 
-                    ORDER BY votes DESC
-                ''', (category,))
-                
-                candidates = cur.fetchall()
-                total_votes = sum(c['votes'] for c in candidates)
-                
-                if candidates:
-                    leading = candidates[0]
-                    results[category] = {
-                        "leading_candidate": leading['candidate_name'],
-                        "votes": leading['votes'],
-                        "total_votes": total_votes,
-                        "percentage": round((leading['votes'] / total_votes * 100) if total_votes > 0 else 0, 1),
-                        "all_candidates": {c['candidate_name']: c['votes'] for c in candidates}
-                    }
-                else:
-                    results[category] = {
-                        "leading_candidate": "No votes yet",
-                        "votes": 0,
-                        "total_votes": 0,
-                        "percentage": 0,
-                        "all_candidates": {}
-                    }
-            
-            return results
+            cur.execute(HAS_VOTED_SQL, (token_hash(device_token), category_id))
+            return cur.fetchone() is not None
     except Exception as e:
-        print(f"Results error: {e}")
-        return {}
+        storage_error("Check vote", e)
+        return False
     finally:
-        conn.close()
+        release_db_connection(conn)
+
+def get_results_db():
+    try:
+        # Every category in one grouped read of the tally rows
+        rows = fetch_read(RESULTS_SQL)
+        if rows is None:
+            return {}
+        return build_results((row['category'], row['candidate_name'], row['votes']) for row in rows)
+    except Exception as e:
+        storage_error("Results", e)
+        return {}
+
+def get_timeline_db(first, last):
+    try:
+        rows = fetch_read(TIMELINE_SQL, (minute_start(first), minute_start(last + 1))) or []
+        return build_timeline(((row['minute'], row['category'], row['ballots']) for row in rows), first, last)
+    except Exception as e:
+        storage_error("Timeline", e)
+        return build_timeline([], first, last)
 
 def reset_all_votes_db():
     conn = get_db_connection()
@@ -177,64 +902,63 @@ def reset_all_votes_db():
     
     try:
         with conn.cursor() as cur:
-            cur.execute('DELETE FROM votes')
-            cur.execute('DELETE FROM ip_votes')
-            cur.execute('DELETE FROM active_users')
+            for statement in RESET_SQL:
+                cur.execute(statement)
             conn.commit()
+        presence_seen.clear()
+        if duplicate_filter is not None:
+            duplicate_filter.clear()
     except Exception as e:
-        print(f"Reset error: {e}")
+        storage_error("Reset", e)
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 def update_user_activity_db(device_token):
+    params = presence_touch_params(device_token)
+    if params is None:
+        return
+    
     conn = get_db_connection()
     if not conn:
         return
     
     try:
         with conn.cursor() as cur:
-            cur.execute('''
-                INSERT INTO active_users (device_token, last_seen) 
-                VALUES (%s, CURRENT_TIMESTAMP)
-                ON CONFLICT (device_token) 
-                DO UPDATE SET last_seen = CURRENT_TIMESTAMP
-            ''', (device_token,))
-            
-            # Clean up old users (older than 30 seconds)
-            cur.execute("DELETE FROM active_users WHERE last_seen < NOW() - INTERVAL '30 seconds'")
+            cur.execute(PRESENCE_TOUCH_SQL, params)
             conn.commit()
+            
+            cutoff = presence_expiry_due()
+            if cutoff is not None:
+                for statement in PRESENCE_EXPIRE_SQL:
+                    cur.execute(statement, (cutoff,))
+                conn.commit()
     except Exception as e:
-        print(f"User activity error: {e}")
+        storage_error("User activity", e)
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 def get_concurrent_users_db():
-    conn = get_db_connection()
-    if not conn:
-        return 0
-    
     try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT COUNT(*) as count FROM active_users WHERE last_seen > NOW() - INTERVAL '30 seconds'")
-            result = cur.fetchone()
-            return result['count'] if result else 0
+        rows = fetch_read(CONCURRENT_USERS_SQL, (presence_seen.cutoff(),))
+        return rows[0]['count'] if rows else 0
     except Exception as e:
-        print(f"Concurrent users error: {e}")
+        storage_error("Concurrent users", e)
         return 0
-    finally:
-        conn.close()
 
 def has_ip_voted_for_category_db(client_ip, category):
+    category_id = category_id_db(category)
+    if category_id is None:
+        return False
     conn = get_db_connection()
     if not conn:
         return False
     
     try:
         with conn.cursor() as cur:
-            cur.execute('SELECT 1 FROM ip_votes WHERE client_ip = %s AND category = %s', (client_ip, category))
+            cur.execute(HAS_IP_VOTED_SQL, (client_ip, category_id))
             return cur.fetchone() is not None
     except Exception as e:
-        print(f"Check IP vote error: {e}")
+        storage_error("Check IP vote", e)
         return False
     finally:
-        conn.close()
\ No newline at end of file
+        release_db_connection(conn)
\ No newline at end of file
@@ -0,0 +1,125 @@
+import asyncio
+import os
+import time
+
+# VOTE_INGEST_MODE=batch queues ballots for group commit instead of one transaction each
+VOTE_INGEST_MODE = os.getenv('VOTE_INGEST_MODE', 'direct')
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', '200'))
+INGEST_FLUSH_INTERVAL_MS = float(os.getenv('INGEST_FLUSH_INTERVAL_MS', '10'))
+INGEST_QUEUE_DEPTH = int(os.getenv('INGEST_QUEUE_DEPTH', '5000'))
+
+
+class BallotQueue:
+    """Bounded in-process queue whose flusher writes ballots in batches, one commit per batch"""
+
+    def __init__(self, write_batch, batch_size=INGEST_BATCH_SIZE,
+                 flush_interval_ms=INGEST_FLUSH_INTERVAL_MS, max_depth=INGEST_QUEUE_DEPTH):
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_depth = max_depth
+
+        self._queue = None
+        self._task = None
+        self._counters = {
+            "submitted": 0,
+            "rejected_queue_full": 0,
+            "batches": 0,
+            "ballots_flushed": 0,
+            "flush_errors": 0,
+            "last_batch_size": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "max_depth_seen": 0,
+        }
+
+    def _ensure_started(self):
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.max_depth)
+            self._task = asyncio.create_task(self._run())
+
+    async def submit(self, tokens, category, candidate_name=None, client_ip=None):
+        """Queue a ballot and wait until its batch commits; returns the rejection rule or None"""
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait(((tokens, category, candidate_name, client_ip), future))
+        except asyncio.QueueFull:
+            self._counters["rejected_queue_full"] += 1
+            return "overloaded"
+        self._counters["submitted"] += 1
+        self._counters["max_depth_seen"] = max(self._counters["max_depth_seen"], self._queue.qsize())
+        return await future
+
+    async def _collect(self):
+        # Returns (batch, stop); a None item is the shutdown sentinel from close()
+        item = await self._queue.get()
+        if item is None:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            # Take whatever is already queued without waiting, then wait out the interval
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def _flush(self, batch):
+        started = time.monotonic()
+        try:
+            rejections = await self.write_batch([ballot for ballot, _ in batch])
+        except Exception as e:
+            print(f"Ballot flush error: {e}")
+            self._counters["flush_errors"] += 1
+            rejections = ["error"] * len(batch)
+        elapsed_ms = (time.monotonic() - started) * 1000
+
+        for (_, future), rejected_by in zip(batch, rejections):
+            if not future.done():
+                future.set_result(rejected_by)
+
+        self._counters["batches"] += 1
+        self._counters["ballots_flushed"] += len(batch)
+        self._counters["last_batch_size"] = len(batch)
+        self._counters["last_flush_ms"] = round(elapsed_ms, 3)
+        self._counters["max_flush_ms"] = round(max(self._counters["max_flush_ms"], elapsed_ms), 3)
+
+    async def _run(self):
+        while True:
+            batch, stop = await self._collect()
+            if batch:
+                await self._flush(batch)
+            if stop:
+                return
+
+    async def close(self):
+        """Flush what is already queued and stop the flusher"""
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    def stats(self):
+        stats = dict(self._counters)
+        batches = stats["batches"]
+        stats.update({
+            "mode": "batch",
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue_depth": self.max_depth,
+            "batch_size": self.batch_size,
+            "flush_interval_ms": self.flush_interval * 1000,
+            "avg_batch_size": stats["ballots_flushed"] / batches if batches else 0.0,
+        })
+        return stats
@@ -0,0 +1,538 @@
+"""Append-only journal that makes the in-memory store survive restarts.
+
+Each accepted ballot and each reset is appended to the current segment as a
+length-prefixed, CRC-checked binary record. The write reaches the OS before
+the vote is acknowledged. fsync runs in a background thread every
+VOTE_JOURNAL_FSYNC_MS, so one fsync covers every ballot in that window.
+Once a segment passes VOTE_JOURNAL_SNAPSHOT_BYTES, the journal rotates to a
+new segment, and a compact snapshot of the tallies and token sets is written
+alongside. After that, the older segments are deleted. On startup the store
+loads the snapshot and replays the segments after it.
+
+Replay speed, from backend/:
+
+    python -m app.journal --bench 200000
+"""
+import fcntl
+import gc
+import os
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from itertools import accumulate
+
+from app.metrics import storage_error
+
+VOTE_JOURNAL_DIR = os.getenv('VOTE_JOURNAL_DIR', '')
+# 0 fsyncs every record before the vote is acknowledged
+VOTE_JOURNAL_FSYNC_MS = float(os.getenv('VOTE_JOURNAL_FSYNC_MS', '10'))
+VOTE_JOURNAL_SNAPSHOT_BYTES = int(os.getenv('VOTE_JOURNAL_SNAPSHOT_BYTES', str(64 << 20)))
+
+# payload length, crc32 of payload
+RECORD = struct.Struct("<II")
+U8 = struct.Struct("<B")
+U32 = struct.Struct("<I")
+U64 = struct.Struct("<Q")
+OP_BALLOT = 1
+OP_RESET = 2
+
+# Ballots applied per engine lock acquisition during replay
+REPLAY_BATCH = 10000
+
+SNAPSHOT_MAGIC = b"STISNAP1"
+SNAPSHOT_FILE = "snapshot.bin"
+SEGMENT_PREFIX = "journal."
+SEGMENT_SUFFIX = ".log"
+
+
+def _pack_str(parts, value):
+    data = value.encode() if value else b""
+    parts.append(U32.pack(len(data)))
+    parts.append(data)
+
+
+def _unpack_str(data, offset):
+    length = U32.unpack_from(data, offset)[0]
+    offset += 4
+    return data[offset:offset + length].decode(), offset + length
+
+
+def _lengths(count):
+    lengths = _LENGTHS.get(count)
+    if lengths is None:
+        lengths = _LENGTHS[count] = struct.Struct(f"<{count}I")
+    return lengths
+
+
+_LENGTHS = {}
+
+
+def encode_ballot(tokens, category, candidate_name=None, client_ip=None):
+    """Payload of a ballot record; tokens are the token values, the rule names are not needed to replay.
+
+    op, token count, then the length in characters of every field, then all
+    fields as one UTF-8 string, so decoding is one decode() and a few slices.
+    """
+    fields = [category, candidate_name or "", client_ip or ""]
+    fields.extend(dict.fromkeys(tokens))
+    return b"".join((
+        U8.pack(OP_BALLOT),
+        U8.pack(len(fields) - 3),
+        _lengths(len(fields)).pack(*map(len, fields)),
+        "".join(fields).encode()
+    ))
+
+
+def decode_ballot(payload):
+    """(tokens, category, candidate_name, client_ip) from a ballot payload"""
+    lengths = _lengths(payload[1] + 3)
+    text = payload[2 + lengths.size:].decode()
+    ends = list(accumulate(lengths.unpack_from(payload, 2)))
+    fields = [text[start:end] for start, end in zip([0] + ends, ends)]
+    return fields[3:], fields[0], fields[1] or None, fields[2] or None
+
+
+def read_records(data):
+    """Yield (payload, end offset) for each intact record; stops at a torn or corrupt tail"""
+    offset = 0
+    while offset + RECORD.size <= len(data):
+        length, crc = RECORD.unpack_from(data, offset)
+        start = offset + RECORD.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return
+        offset = start + length
+        yield payload, offset
+
+
+def _remap_mask(mask, bit_map):
+    remapped = 0
+    for old_bit, new_bit in bit_map:
+        if mask & old_bit:
+            remapped |= new_bit
+    return remapped
+
+
+def write_snapshot(path, state, categories, next_seq):
+    """Write a dump() of the engine that covers every segment before next_seq; atomic via rename"""
+    tokens, ips, ballots, candidates = state
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb", buffering=1 << 20) as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(U64.pack(next_seq))
+        f.write(U32.pack(len(categories)))
+        for category, total, rows in zip(categories, ballots, candidates):
+            parts = []
+            _pack_str(parts, category)
+            parts.append(U64.pack(total))
+            parts.append(U32.pack(len(rows)))
+            for name, votes in rows:
+                _pack_str(parts, name)
+                parts.append(U64.pack(votes))
+            f.write(b"".join(parts))
+        for keys in (tokens, ips):
+            f.write(U64.pack(len(keys)))
+            for key, mask in keys.items():
+                data = key.encode()
+                f.write(U32.pack(len(data)))
+                f.write(data)
+                f.write(U64.pack(mask))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def read_snapshot(path, categories):
+    """(next_seq, state) from a snapshot, with category bits remapped to `categories`"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:8] != SNAPSHOT_MAGIC:
+        raise ValueError(f"{path} is not a vote snapshot")
+    next_seq = U64.unpack_from(data, 8)[0]
+    offset = 16
+    ids = {category: index for index, category in enumerate(categories)}
+    ballots = [0] * len(categories)
+    candidates = [[] for _ in categories]
+    bit_map = []
+    count = U32.unpack_from(data, offset)[0]
+    offset += 4
+    for old_id in range(count):
+        category, offset = _unpack_str(data, offset)
+        total = U64.unpack_from(data, offset)[0]
+        rows_count = U32.unpack_from(data, offset + 8)[0]
+        offset += 12
+        rows = []
+        for _ in range(rows_count):
+            name, offset = _unpack_str(data, offset)
+            rows.append((name, U64.unpack_from(data, offset)[0]))
+            offset += 8
+        new_id = ids.get(category)
+        if new_id is not None:
+            ballots[new_id] = total
+            candidates[new_id] = rows
+            bit_map.append((1 << old_id, 1 << new_id))
+    identity = all(old == new for old, new in bit_map) and len(bit_map) == count
+
+    key_sets = []
+    for _ in range(2):
+        keys = {}
+        key_count = U64.unpack_from(data, offset)[0]
+        offset += 8
+        for _ in range(key_count):
+            key, offset = _unpack_str(data, offset)
+            mask = U64.unpack_from(data, offset)[0]
+            offset += 8
+            if not identity:
+                mask = _remap_mask(mask, bit_map)
+            if mask:
+                keys[key] = mask
+        key_sets.append(keys)
+    return next_seq, (key_sets[0], key_sets[1], ballots, candidates)
+
+
+class JournalGate:
+    """Any number of ballots at once, or one reset or snapshot alone.
+
+    Ballots commute, so concurrent ones may be journaled in any order; a
+    reset, and the point where a snapshot rotates the segment, must fall
+    between ballots. A waiting exclusive holder keeps new ballots out so a
+    steady stream of them cannot starve it.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._waiting = 0
+
+    @contextmanager
+    def shared(self):
+        with self._cond:
+            while self._exclusive or self._waiting:
+                self._cond.wait()
+            self._shared += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._shared -= 1
+                if not self._shared:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self._cond:
+            self._waiting += 1
+            while self._exclusive or self._shared:
+                self._cond.wait()
+            self._waiting -= 1
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._exclusive = False
+                self._cond.notify_all()
+
+
+class VoteJournal:
+    """Durable log for a MemoryVoteEngine.
+
+    Callers hold `gate` shared around admitting a ballot and recording it,
+    and exclusive around a reset, so a reset is journaled between the same
+    ballots the engine saw on either side. A snapshot dumps the engine with
+    the gate held exclusive, which makes the rotation point exact. `lock`
+    only serializes writes to the segment file.
+    """
+
+    def __init__(self, engine, directory=VOTE_JOURNAL_DIR, fsync_ms=VOTE_JOURNAL_FSYNC_MS,
+                 snapshot_bytes=VOTE_JOURNAL_SNAPSHOT_BYTES):
+        self.engine = engine
+        self.directory = directory
+        self.fsync_ms = fsync_ms
+        self.snapshot_bytes = snapshot_bytes
+        self.gate = JournalGate()
+        self.lock = threading.Lock()
+        self._lock_file = None
+        self._fd = None
+        self._seq = 0
+        self._segment_bytes = 0
+        self._dirty = False
+        self._snapshot_thread = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._counters = {
+            "records": 0, "fsyncs": 0, "write_errors": 0, "snapshots": 0, "snapshot_seconds": 0.0,
+            "replayed_records": 0, "replay_seconds": 0.0
+        }
+
+    def _segment_path(self, seq):
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{seq:010d}{SEGMENT_SUFFIX}")
+
+    def _segments(self):
+        return sorted(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+
+    def open(self):
+        """Lock the directory, restore snapshot plus journal tail, and start a fresh segment"""
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock_file = open(os.path.join(self.directory, "lock"), "a+b")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            raise RuntimeError(f"journal directory {self.directory} is in use by another process")
+
+        try:
+            replayed = self._restore()
+        except BaseException:
+            # Leave the files untouched for inspection; the store runs without a journal
+            self._lock_file.close()
+            self._lock_file = None
+            raise
+        self._thread = threading.Thread(target=self._run, name="vote-journal", daemon=True)
+        self._thread.start()
+        return replayed
+
+    def _restore(self):
+        started = time.perf_counter()
+        # Restoring creates millions of objects and no cycles; collector passes would only slow it down
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            next_seq = 0
+            snapshot_path = os.path.join(self.directory, SNAPSHOT_FILE)
+            if os.path.exists(snapshot_path):
+                next_seq, state = read_snapshot(snapshot_path, self.engine.categories)
+                self.engine.restore(*state)
+            segments = [seq for seq in self._segments() if seq >= next_seq]
+            replayed = sum(self.replay_segment(seq) for seq in segments)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        elapsed = time.perf_counter() - started
+        self._counters["replayed_records"] = replayed
+        self._counters["replay_seconds"] = round(elapsed, 3)
+
+        self._open_segment(max(segments + [next_seq - 1]) + 1)
+        return replayed
+
+    def replay_segment(self, seq):
+        """Apply one segment's records to the engine; returns how many were read"""
+        path = self._segment_path(seq)
+        with open(path, "rb") as f:
+            data = f.read()
+        records = 0
+        end = 0
+        batch = []
+        for payload, end in read_records(data):
+            records += 1
+            if payload[0] == OP_BALLOT:
+                batch.append(decode_ballot(payload))
+                if len(batch) >= REPLAY_BATCH:
+                    self.engine.replay(batch)
+                    batch = []
+            elif payload[0] == OP_RESET:
+                batch = []
+                self.engine.reset()
+        self.engine.replay(batch)
+        if end < len(data):
+            # A crash mid-write leaves a torn record; later segments are still replayed
+            storage_error("Journal replay", f"{path} has {len(data) - end} unreadable bytes after record {records}")
+        return records
+
+    def _open_segment(self, seq):
+        self._seq = seq
+        self._fd = os.open(self._segment_path(seq), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._segment_bytes = 0
+        self._fsync_directory()
+
+    def _fsync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _frame(payload):
+        return RECORD.pack(len(payload), zlib.crc32(payload)) + payload
+
+    def _append(self, data, count=1):
+        """Write one or more framed records; raises OSError if they were not journaled"""
+        with self.lock:
+            try:
+                os.write(self._fd, data)
+                if self.fsync_ms <= 0:
+                    os.fsync(self._fd)
+                    self._counters["fsyncs"] += 1
+            except OSError as e:
+                self._counters["write_errors"] += 1
+                storage_error("Journal", e)
+                try:
+                    # Drop a partial write so the records after it still replay
+                    os.ftruncate(self._fd, self._segment_bytes)
+                except OSError:
+                    pass
+                raise
+            self._segment_bytes += len(data)
+            self._counters["records"] += count
+            self._dirty = self.fsync_ms > 0
+
+    def record_ballot(self, tokens, category, candidate_name=None, client_ip=None):
+        self._append(self._frame(encode_ballot(tokens.values(), category, candidate_name, client_ip)))
+
+    def record_ballots(self, ballots):
+        """Journal (tokens, category, candidate_name, client_ip) ballots with one write"""
+        if ballots:
+            self._append(b"".join(self._frame(encode_ballot(tokens.values(), category, candidate_name, client_ip))
+                                  for tokens, category, candidate_name, client_ip in ballots), len(ballots))
+
+    def record_reset(self):
+        self._append(self._frame(U8.pack(OP_RESET)))
+
+    def sync(self):
+        """fsync the current segment if anything was written since the last call"""
+        with self.lock:
+            if not self._dirty or self._fd is None:
+                return
+            self._dirty = False
+            fd = self._fd
+        # Outside the lock, so ballots keep being appended while the disk flushes
+        os.fsync(fd)
+        self._counters["fsyncs"] += 1
+
+    def snapshot(self):
+        """Rotate to a new segment and write a snapshot of everything before it"""
+        if self._snapshot_thread is not None and self._snapshot_thread.is_alive():
+            return
+        with self.gate.exclusive(), self.lock:
+            state = self.engine.dump()
+            os.fsync(self._fd)
+            os.close(self._fd)
+            self._dirty = False
+            self._open_segment(self._seq + 1)
+            next_seq = self._seq
+        self._snapshot_thread = threading.Thread(target=self._write_snapshot, args=(state, next_seq),
+                                                 name="vote-journal-snapshot", daemon=True)
+        self._snapshot_thread.start()
+
+    def _write_snapshot(self, state, next_seq):
+        started = time.perf_counter()
+        try:
+            write_snapshot(os.path.join(self.directory, SNAPSHOT_FILE), state, self.engine.categories, next_seq)
+            self._fsync_directory()
+            for seq in self._segments():
+                if seq < next_seq:
+                    os.remove(self._segment_path(seq))
+            self._counters["snapshots"] += 1
+            self._counters["snapshot_seconds"] = round(time.perf_counter() - started, 3)
+        except Exception as e:
+            storage_error("Journal snapshot", e)
+
+    def _run(self):
+        interval = self.fsync_ms / 1000 if self.fsync_ms > 0 else 0.1
+        while not self._stop.wait(interval):
+            try:
+                self.sync()
+                if self._segment_bytes >= self.snapshot_bytes:
+                    self.snapshot()
+            except Exception as e:
+                storage_error("Journal", e)
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+        if self._fd is not None:
+            self.sync()
+            os.close(self._fd)
+            self._fd = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def stats(self):
+        return dict(
+            self._counters,
+            enabled=True,
+            segment=self._seq,
+            segment_bytes=self._segment_bytes,
+            fsync_ms=self.fsync_ms
+        )
+
+
+def benchmark(ballots=200000):
+    """Journal `ballots` synthetic five-token ballots, then time replay from the journal and from a snapshot"""
+    import shutil
+    import tempfile
+    from app.memory_engine import MemoryVoteEngine
+
+    def reopen():
+        engine = MemoryVoteEngine()
+        journal = VoteJournal(engine, directory)
+        started = time.perf_counter()
+        journal.open()
+        return engine, journal, time.perf_counter() - started
+
+    directory = tempfile.mkdtemp(prefix="vote-journal-")
+    try:
+        engine = MemoryVoteEngine()
+        journal = VoteJournal(engine, directory)
+        journal.open()
+        started = time.perf_counter()
+        for index in range(ballots):
+            device = f"{index:08d}-0000-4000-8000-000000000000"
+            client_ip = f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}"
+            tokens = {
+                "enhanced": f"{device}:{client_ip}",
+                "fingerprint": f"fp:{index:016x}",
+                "device": f"device:{device}",
+                "browser": f"browser:{index * 7919}",
+                "session": f"session:{index:032x}"
+            }
+            category = engine.categories[index % len(engine.categories)]
+            candidate_name = f"Candidate {index % 10}"
+            with journal.gate.shared():
+                if engine.admit(tokens, category, candidate_name, client_ip) is None:
+                    journal.record_ballot(tokens, category, candidate_name, client_ip)
+        append_seconds = time.perf_counter() - started
+        journal.close()
+        journal_bytes = sum(os.path.getsize(journal._segment_path(seq)) for seq in journal._segments())
+
+        replayed, journal, replay_seconds = reopen()
+        assert replayed.totals() == engine.totals()
+        journal.snapshot()
+        journal.close()
+        snapshot_bytes = os.path.getsize(os.path.join(directory, SNAPSHOT_FILE))
+
+        restored, journal, restore_seconds = reopen()
+        assert restored.totals() == engine.totals()
+        journal.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        "ballots": ballots,
+        "append_ballots_per_second": int(ballots / append_seconds),
+        "journal_bytes": journal_bytes,
+        "journal_replay_seconds": round(replay_seconds, 3),
+        "journal_replay_ballots_per_second": int(ballots / replay_seconds),
+        "snapshot_bytes": snapshot_bytes,
+        "snapshot_load_seconds": round(restore_seconds, 3),
+        "snapshot_load_ballots_per_second": int(ballots / restore_seconds)
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Benchmark vote journal replay")
+    parser.add_argument("--bench", type=int, default=200000, metavar="BALLOTS")
+    print(json.dumps(benchmark(parser.parse_args().bench), indent=2))
@@ -0,0 +1,10 @@
+"""Password hashing run in the KDF process pool.
+
+Pool workers are started with spawn and import this module afresh, so it
+must stay free of side effects: no settings, sessions or storage here.
+"""
+import hashlib
+
+
+def pbkdf2(password: str, salt: str, iterations: int) -> str:
+    return hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), iterations).hex()
@@ -0,0 +1,208 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+STREAM_POLL_INTERVAL = float(os.getenv('STREAM_POLL_INTERVAL', '0.5'))
+STREAM_HEARTBEAT_INTERVAL = float(os.getenv('STREAM_HEARTBEAT_INTERVAL', '15'))
+STREAM_MAX_SUBSCRIBERS = int(os.getenv('STREAM_MAX_SUBSCRIBERS', '1000'))
+STREAM_CLIENT_BUFFER = int(os.getenv('STREAM_CLIENT_BUFFER', '8'))
+# Seconds the producer keeps refreshing after the last dashboard poll
+STREAM_IDLE_TIMEOUT = float(os.getenv('STREAM_IDLE_TIMEOUT', '10'))
+
+
+def format_event(event, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, separators=(',', ':'))}")
+    return "\n".join(lines) + "\n\n"
+
+
+def snapshot_etag(snapshot):
+    # From the content, so every worker holding the same totals sends the same tag
+    canonical = json.dumps(snapshot, sort_keys=True, separators=(',', ':')).encode()
+    return f'"{hashlib.blake2b(canonical, digest_size=12).hexdigest()}"'
+
+
+def diff_snapshot(old, new):
+    """Return only the sections (and keys within dict sections) that changed between two snapshots"""
+    delta = {}
+    for section, value in new.items():
+        before = old.get(section)
+        if isinstance(value, dict):
+            before = before or {}
+            changed = {key: item for key, item in value.items() if before.get(key) != item}
+            if changed:
+                delta[section] = changed
+        elif before != value:
+            delta[section] = value
+    return delta
+
+
+class Subscriber:
+    def __init__(self, buffer_size):
+        self.queue = asyncio.Queue(maxsize=buffer_size)
+        self.dropped = 0
+
+    def push(self, message, snapshot_message):
+        # A client that cannot keep up skips the backlog and resyncs from the latest snapshot
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(snapshot_message)
+
+
+class LiveResults:
+    """Single producer that watches the tallies and fans deltas out to every stream subscriber.
+
+    The producer runs while there are subscribers or dashboard polls in the
+    last `idle_timeout` seconds, refreshing every `poll_interval` and right
+    after a local write. Dashboard polls are answered from its snapshot, so
+    they never wait on storage once it is running.
+    """
+
+    def __init__(self, load_snapshot, poll_interval=STREAM_POLL_INTERVAL,
+                 heartbeat_interval=STREAM_HEARTBEAT_INTERVAL,
+                 max_subscribers=STREAM_MAX_SUBSCRIBERS, client_buffer=STREAM_CLIENT_BUFFER,
+                 idle_timeout=STREAM_IDLE_TIMEOUT):
+        self.load_snapshot = load_snapshot
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.max_subscribers = max_subscribers
+        self.client_buffer = client_buffer
+        self.idle_timeout = idle_timeout
+
+        # Per process, for SSE event ids; the dashboard ETag comes from the content
+        self.version = 0
+        self.snapshot = None
+        self.etag = None
+        self.body = None
+        self.refreshed_at = 0.0
+        self.polled_at = 0.0
+        self._dirty = False
+        self.subscribers = set()
+        self._task = None
+        self._loop = None
+        self._wakeup = None
+        self._refresh_lock = None
+
+    def _snapshot_message(self):
+        return format_event("snapshot", dict(self.snapshot, version=self.version), self.version)
+
+    def is_fresh(self):
+        return (self.snapshot is not None and not self._dirty
+                and time.monotonic() - self.refreshed_at < self.poll_interval)
+
+    async def current(self):
+        """ETag and JSON body of the latest snapshot for a dashboard poll.
+
+        Storage is read here only for the first poll after an idle spell;
+        from then on the producer keeps the snapshot current.
+        """
+        self.polled_at = time.monotonic()
+        if self._task is None:
+            await self.refresh(only_if_stale=True)
+            self._start()
+        return self.etag, self.body
+
+    async def refresh(self, only_if_stale=False):
+        """Reload the snapshot; bump the version and publish a delta if anything changed"""
+        if self._refresh_lock is None:
+            self._refresh_lock = asyncio.Lock()
+        async with self._refresh_lock:
+            # Callers queued behind another refresh reuse its result
+            if only_if_stale and self.is_fresh():
+                return False
+            self._dirty = False
+            snapshot = await self.load_snapshot()
+            self.refreshed_at = time.monotonic()
+            if snapshot == self.snapshot:
+                return False
+            delta = diff_snapshot(self.snapshot or {}, snapshot)
+            self.snapshot = snapshot
+            self.etag = snapshot_etag(snapshot)
+            self.body = json.dumps(snapshot, ensure_ascii=False, separators=(',', ':')).encode()
+            self.version += 1
+            if self.subscribers:
+                message = format_event("delta", dict(delta, version=self.version), self.version)
+                snapshot_message = self._snapshot_message()
+                for subscriber in self.subscribers:
+                    subscriber.push(message, snapshot_message)
+            return True
+
+    def notify(self):
+        """Mark the snapshot stale and wake the producer, e.g. after a ballot; safe to call from any thread"""
+        self._dirty = True
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _wanted(self):
+        return bool(self.subscribers) or time.monotonic() - self.polled_at < self.idle_timeout
+
+    def _start(self):
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self._wanted():
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Live results error: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+        self._task = None
+
+    async def subscribe(self):
+        if len(self.subscribers) >= self.max_subscribers:
+            return None
+        if self.snapshot is None:
+            await self.refresh()
+        subscriber = Subscriber(self.client_buffer)
+        subscriber.queue.put_nowait(self._snapshot_message())
+        self.subscribers.add(subscriber)
+        self._start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    async def stream(self, subscriber):
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscriber.queue.get(), self.heartbeat_interval)
+                except asyncio.TimeoutError:
+                    message = ": heartbeat\n\n"
+                yield message
+        finally:
+            self.unsubscribe(subscriber)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "producer_running": int(self._task is not None),
+            "subscribers": len(self.subscribers),
+            "max_subscribers": self.max_subscribers,
+            "dropped_to_snapshot": sum(s.dropped for s in self.subscribers),
+        }
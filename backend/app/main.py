@@ -1,18 +1,100 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from app.storage import get_counts, cast_vote, has_voted, has_voted_for_category, get_results, reset_all_votes, update_user_activity, get_concurrent_users, has_ip_voted_for_category
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from app.admission import AdmissionMiddleware, admission, client_ip as request_client_ip
+from app.export import EXPORT_FETCH_SIZE, EXPORT_MEDIA_TYPES, ExportUnavailable, export_chunks, parse_time
+from app.live import LiveResults
+from app.metrics import MetricsMiddleware, metrics
+from app.timeline import timeline_range
+from app.ingest import BallotQueue, VOTE_INGEST_MODE
+from app.async_storage import get_counts, admit_ballot, admit_ballots, get_results, reset_all_votes, update_user_activity, get_concurrent_users, get_pool_stats, get_cache_stats, get_storage_backend, get_filter_stats, get_replica_stats, get_journal_stats, get_registry_stats, get_categories, get_timeline, iter_ballots, close_pool, close_storage
 try:
-    from app.auth import create_user, authenticate_user, verify_session, logout_user
+    from app.auth import create_user, authenticate_user, verify_session, logout_user, shutdown_kdf_pool, get_kdf_stats, start_session_sweeper, stop_session_sweeper, get_session_stats
     AUTH_ENABLED = True
 except ImportError:
     AUTH_ENABLED = False
-    def create_user(*args): return {"success": False, "message": "Auth not available"}
-    def authenticate_user(*args): return {"success": False, "message": "Auth not available"}
+    async def create_user(*args): return {"success": False, "message": "Auth not available"}
+    async def authenticate_user(*args): return {"success": False, "message": "Auth not available"}
     def verify_session(*args): return None
     def logout_user(*args): return False
+    def shutdown_kdf_pool(): pass
+    def get_kdf_stats(): return {}
+    def start_session_sweeper(): pass
+    async def stop_session_sweeper(): pass
+    def get_session_stats(): return {}
+import asyncio
+import hmac
+import os
 import uuid
 
-app = FastAPI()
+# Admin endpoints (the ballot export) stay disabled until ADMIN_TOKEN is set
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+
+# Group-commit ingestion is opt-in: VOTE_INGEST_MODE=batch
+ballot_queue = BallotQueue(admit_ballots) if VOTE_INGEST_MODE == "batch" else None
+
+@asynccontextmanager
+async def lifespan(app):
+    start_session_sweeper()
+    yield
+    await stop_session_sweeper()
+    await live_results.close()
+    if ballot_queue:
+        await ballot_queue.close()
+    await close_pool()
+    close_storage()
+    shutdown_kdf_pool()
+
+# Storage routes are async and use app.async_storage. Register/login await
+# PBKDF2 from the auth process pool; the other auth routes are cheap and sync
+app = FastAPI(lifespan=lifespan)
+
+REJECTION_MESSAGES = {
+    "enhanced": "Already voted for this category",
+    "fingerprint": "This device has already voted for this category",
+    "device": "This device has already voted for this category",
+    "browser": "This browser has already voted for this category",
+    "session": "This session has already voted for this category",
+    "ip": "This network/IP has already voted for this category",
+    "invalid_category": "Invalid category",
+    "invalid_candidate": "Candidate name is too long",
+    "overloaded": "Voting is very busy right now, please try again",
+    "error": "Could not record vote, please try again"
+}
+
+async def load_live_snapshot():
+    counts, results, concurrent_users = await asyncio.gather(get_counts(), get_results(), get_concurrent_users())
+    return {"counts": counts, "results": results, "concurrent_users": concurrent_users}
+
+live_results = LiveResults(load_live_snapshot)
+
+metrics.register_rejection_rules(REJECTION_MESSAGES)
+metrics.add_gauges("voting_pool", get_pool_stats)
+metrics.add_gauges("voting_replicas", get_replica_stats)
+metrics.add_gauges("voting_read_cache", get_cache_stats)
+metrics.add_gauges("voting_duplicate_filter", get_filter_stats)
+metrics.add_gauges("voting_journal", get_journal_stats)
+metrics.add_gauges("voting_registry", get_registry_stats)
+metrics.add_gauges("voting_admission", admission.stats)
+metrics.add_gauges("voting_stream", live_results.stats)
+metrics.add_gauges("voting_kdf", get_kdf_stats)
+metrics.add_gauges("voting_sessions", get_session_stats)
+if ballot_queue:
+    metrics.add_gauges("voting_ingest", ballot_queue.stats)
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+# Innermost of the three: preflights are answered by CORS without using
+# a token, refusals still get CORS headers, and metrics count the 429s
+app.add_middleware(AdmissionMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -27,50 +109,143 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(MetricsMiddleware)
+
 @app.get("/")
 def read_root():
     return {"message": "Voting Dashboard API"}
 
 @app.get("/api/v1/create-demo-account")
-def create_demo_account():
+async def create_demo_account():
     if not AUTH_ENABLED:
         return {"success": False, "message": "Auth system not available"}
-    result = create_user("demo@test.com", "123456", "Demo User")
+    result = await create_user("demo@test.com", "123456", "Demo User")
     return result
 
 @app.post("/api/v1/register-device")
-def register_device(device: dict):
+async def register_device(device: dict):
     device_id = str(uuid.uuid4())
-    update_user_activity(device_id)
+    await update_user_activity(device_id)
     return {"device_id": device_id, "display_name": device.get("display_name")}
 
 @app.get("/api/v1/users")
-def get_user_stats():
+async def get_user_stats():
+    concurrent_users, counts = await asyncio.gather(get_concurrent_users(), get_counts())
     return {
-        "concurrent_users": get_concurrent_users(),
-        "total_votes": get_counts().get('total', 0)
+        "concurrent_users": concurrent_users,
+        "total_votes": counts.get('total', 0)
     }
 
+@app.get("/api/v1/categories")
+async def list_categories():
+    return {"categories": await get_categories()}
+
+@app.get("/api/v1/dashboard")
+async def get_dashboard(request: Request):
+    etag, body = await live_results.current()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+@app.get("/api/v1/pool-stats")
+async def get_connection_pool_stats():
+    return {"backend": get_storage_backend(), "pool": get_pool_stats(), "replicas": get_replica_stats()}
+
+@app.get("/api/v1/filter-stats")
+async def get_duplicate_filter_stats():
+    return get_filter_stats()
+
+@app.get("/api/v1/journal-stats")
+async def get_vote_journal_stats():
+    return get_journal_stats()
+
+@app.get("/api/v1/admission-stats")
+async def get_admission_stats():
+    return admission.stats()
+
+@app.get("/api/v1/cache-stats")
+async def get_read_cache_stats():
+    return get_cache_stats()
+
+@app.get("/api/v1/ingest-stats")
+async def get_ingest_stats():
+    if not ballot_queue:
+        return {"mode": VOTE_INGEST_MODE}
+    return ballot_queue.stats()
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/api/v1/counts")
-def get_vote_counts():
-    return get_counts()
+async def get_vote_counts():
+    return await get_counts()
 
 @app.get("/api/v1/results")
-def get_live_results():
-    return get_results()
+async def get_live_results():
+    return await get_results()
+
+@app.get("/api/v1/timeline")
+async def get_vote_timeline(minutes: int = None, since: str = None, until: str = None):
+    try:
+        first, last = timeline_range(minutes, parse_time(since), parse_time(until))
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"success": False, "message": f"Invalid range: {e}"})
+    return await get_timeline(first, last)
+
+@app.get("/api/v1/stream")
+async def stream_live_results():
+    subscriber = await live_results.subscribe()
+    if subscriber is None:
+        return JSONResponse(
+            status_code=503,
+            content={"success": False, "message": "Too many live viewers, poll /api/v1/results instead"},
+            headers={"Retry-After": "5"}
+        )
+    return StreamingResponse(
+        live_results.stream(subscriber),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def is_admin(request: Request):
+    token = request.headers.get("x-admin-token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+@app.get("/api/v1/admin/export")
+async def export_ballots(request: Request, format: str = "csv", category: str = None, since: str = None, until: str = None, election: int = None):
+    if not is_admin(request):
+        return JSONResponse(status_code=403, content={"success": False, "message": "Admin token required"})
+    if format not in EXPORT_MEDIA_TYPES:
+        return JSONResponse(status_code=400, content={"success": False, "message": "format must be csv or ndjson"})
+    try:
+        since, until = parse_time(since), parse_time(until)
+    except ValueError:
+        return JSONResponse(status_code=400, content={"success": False, "message": "since and until must be ISO 8601 times"})
+    try:
+        batches = await iter_ballots(category, since, until, EXPORT_FETCH_SIZE, election)
+    except NotImplementedError as e:
+        return JSONResponse(status_code=501, content={"success": False, "message": f"Export unavailable: {e}"})
+    except ExportUnavailable:
+        return JSONResponse(status_code=503, content={"success": False, "message": "Ballot store unavailable, please try again shortly"}, headers={"Retry-After": "5"})
+    
+    return StreamingResponse(
+        export_chunks(batches, format),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="ballots.{format}"', "Cache-Control": "no-store"}
+    )
 
 @app.post("/api/v1/vote")
-def vote(vote_data: dict, request: Request):
+async def vote(vote_data: dict, request: Request):
     device_token = vote_data.get("device_token")
     category = vote_data.get("category")
     candidate_name = vote_data.get("candidate_name")
     security_data = vote_data.get("security", {})
     user_data = vote_data.get("user", {})
     
-    # Get client IP address
-    client_ip = request.client.host
-    if "x-forwarded-for" in request.headers:
-        client_ip = request.headers["x-forwarded-for"].split(",")[0].strip()
+    # Get client IP address, as the trusted proxy saw it
+    client_ip = request_client_ip(request.scope)
     
     # No security validation - allow all votes
     import time
@@ -96,39 +271,30 @@ def vote(vote_data: dict, request: Request):
     session_token = f"session:{session_key[:32]}"
     
     # Track user activity
-    update_user_activity(enhanced_token)
+    await update_user_activity(enhanced_token)
     
-    # Multiple checks to prevent VPN bypass and browser switching
-    if has_voted_for_category(enhanced_token, category):
-        return {"success": False, "message": "Already voted for this category"}
-    
-    if has_voted_for_category(fingerprint_token, category):
-        return {"success": False, "message": "This device has already voted for this category"}
-    
-    if has_voted_for_category(device_only_token, category):
-        return {"success": False, "message": "This device has already voted for this category"}
-    
-    if has_voted_for_category(browser_token, category):
-        return {"success": False, "message": "This browser has already voted for this category"}
-    
-    if has_voted_for_category(session_token, category):
-        return {"success": False, "message": "This session has already voted for this category"}
-    
-    if has_ip_voted_for_category(client_ip, category):
-        return {"success": False, "message": "This network/IP has already voted for this category"}
-    
-    if cast_vote(enhanced_token, category, candidate_name, client_ip):
-        # Record with all tokens to prevent any bypass method
-        cast_vote(fingerprint_token, category, candidate_name, client_ip)
-        cast_vote(device_only_token, category, candidate_name, client_ip)
-        cast_vote(browser_token, category, candidate_name, client_ip)
-        cast_vote(session_token, category, candidate_name, client_ip)
-        return {"success": True, "message": "Vote recorded", "category": category, "candidate": candidate_name, "user": user_email}
+    # Multiple checks to prevent VPN bypass and browser switching, evaluated
+    # in this order together with the IP check and the insert in one transaction
+    tokens = {
+        "enhanced": enhanced_token,
+        "fingerprint": fingerprint_token,
+        "device": device_only_token,
+        "browser": browser_token,
+        "session": session_token
+    }
+    if ballot_queue:
+        rejected_by = await ballot_queue.submit(tokens, category, candidate_name, client_ip)
     else:
-        return {"success": False, "message": "Invalid category"}
+        rejected_by = await admit_ballot(tokens, category, candidate_name, client_ip)
+    metrics.ballot(rejected_by)
+    if rejected_by:
+        return {"success": False, "message": REJECTION_MESSAGES.get(rejected_by, "Invalid category")}
+    
+    live_results.notify()
+    return {"success": True, "message": "Vote recorded", "category": category, "candidate": candidate_name, "user": user_email}
 
 @app.post("/api/v1/register")
-def register(user_data: dict):
+async def register(user_data: dict):
     if not AUTH_ENABLED:
         return {"success": False, "message": "Auth system not available"}
     
@@ -142,10 +308,10 @@ def register(user_data: dict):
     if len(password) < 6:
         return {"success": False, "message": "Password must be at least 6 characters"}
     
-    return create_user(email, password, name)
+    return await create_user(email, password, name)
 
 @app.post("/api/v1/login")
-def login(login_data: dict):
+async def login(login_data: dict):
     if not AUTH_ENABLED:
         return {"success": False, "message": "Auth system not available"}
     
@@ -155,7 +321,7 @@ def login(login_data: dict):
     if not email or not password:
         return {"success": False, "message": "Email and password are required"}
     
-    return authenticate_user(email, password)
+    return await authenticate_user(email, password)
 
 @app.post("/api/v1/logout")
 def logout(logout_data: dict):
@@ -180,10 +346,11 @@ def verify_token(token_data: dict):
         return {"success": False, "message": "Invalid or expired session"}
 
 @app.post("/api/v1/reset")
-def reset_votes():
+async def reset_votes():
     try:
-        reset_all_votes()
-        current_counts = get_counts()
+        await reset_all_votes()
+        live_results.notify()
+        current_counts = await get_counts()
         return {
             "success": True, 
             "message": "All votes have been reset",
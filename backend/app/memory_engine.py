@@ -0,0 +1,250 @@
+import threading
+from array import array
+from contextlib import contextmanager
+
+from app.registry import registry
+from app.timeline import MinuteRing
+
+LOCK_STRIPES = 64
+
+
+class MemoryVoteEngine:
+    """Thread-safe in-memory vote store for the no-DATABASE_URL path.
+
+    Categories get small integer ids, so the categories a token (or IP) has
+    voted in are one int bitmask instead of a set of strings. Candidates are
+    interned to ids and counted in one array per category. Duplicate checks
+    lock only the stripes their keys hash to; tallies have a lock per category.
+    Per-minute ballot counts for the timeline live in a MinuteRing; ballots
+    replayed from the journal carry no time, so it restarts empty.
+
+    Measured with `python -m app.memory_engine` (CPython 3.11, 64-bit): about
+    123 MB per million distinct 43-character tokens, against about 340 MB for
+    the old dict-of-sets layout. Nearly all of it is the token strings and
+    their dict slots; the bitmasks are small cached ints.
+    """
+
+    def __init__(self, categories=None, lock_stripes=LOCK_STRIPES):
+        self.categories = list(categories or registry.names())
+        self.category_ids = {name: index for index, name in enumerate(self.categories)}
+        self._stripes = [threading.Lock() for _ in range(lock_stripes)]
+        self._category_locks = [threading.Lock() for _ in self.categories]
+        self._timeline_lock = threading.Lock()
+        self._init_state()
+
+    def _init_state(self):
+        self._tokens = {}
+        self._ips = {}
+        self._ballots = array('q', [0] * len(self.categories))
+        self._candidate_ids = [{} for _ in self.categories]
+        self._candidate_names = [[] for _ in self.categories]
+        self._candidate_votes = [array('q') for _ in self.categories]
+        self._timeline = MinuteRing.allocate(len(self.categories))
+
+    def _locks_for(self, keys):
+        # Sorted stripe order so two ballots can never wait on each other
+        indexes = sorted({hash(key) % len(self._stripes) for key in keys})
+        return [self._stripes[index] for index in indexes]
+
+    def admit(self, tokens, category, candidate_name=None, client_ip=None, check_ip=True):
+        """Check and record a ballot atomically; returns the rejecting rule or None"""
+        category_id = self.category_ids.get(category)
+        if category_id is None:
+            return "invalid_category"
+        bit = 1 << category_id
+
+        keys = list(tokens.values())
+        if client_ip:
+            keys.append(("ip", client_ip))
+        locks = self._locks_for(keys)
+        for lock in locks:
+            lock.acquire()
+        try:
+            for rule, token in tokens.items():
+                if self._tokens.get(token, 0) & bit:
+                    return rule
+            if check_ip and client_ip and self._ips.get(client_ip, 0) & bit:
+                return "ip"
+
+            for token in tokens.values():
+                self._tokens[token] = self._tokens.get(token, 0) | bit
+            if client_ip:
+                self._ips[client_ip] = self._ips.get(client_ip, 0) | bit
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+        with self._category_locks[category_id]:
+            self._ballots[category_id] += 1
+            if candidate_name:
+                candidate_id = self._candidate_ids[category_id].get(candidate_name)
+                if candidate_id is None:
+                    candidate_id = len(self._candidate_names[category_id])
+                    self._candidate_ids[category_id][candidate_name] = candidate_id
+                    self._candidate_names[category_id].append(candidate_name)
+                    self._candidate_votes[category_id].append(0)
+                self._candidate_votes[category_id][candidate_id] += 1
+        with self._timeline_lock:
+            self._timeline.add(category_id)
+        return None
+
+    def retract(self, tokens, category, candidate_name=None, client_ip=None):
+        """Undo an admit() that returned None, for a ballot that could not be journaled.
+
+        Pass client_ip only if that admit() checked it: otherwise the IP may
+        have been recorded by an earlier ballot and stays recorded.
+        """
+        category_id = self.category_ids[category]
+        bit = 1 << category_id
+
+        keys = list(tokens.values())
+        if client_ip:
+            keys.append(("ip", client_ip))
+        locks = self._locks_for(keys)
+        for lock in locks:
+            lock.acquire()
+        try:
+            for token in tokens.values():
+                remaining = self._tokens.get(token, 0) & ~bit
+                if remaining:
+                    self._tokens[token] = remaining
+                else:
+                    self._tokens.pop(token, None)
+            if client_ip:
+                remaining = self._ips.get(client_ip, 0) & ~bit
+                if remaining:
+                    self._ips[client_ip] = remaining
+                else:
+                    self._ips.pop(client_ip, None)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+        with self._category_locks[category_id]:
+            self._ballots[category_id] -= 1
+            if candidate_name:
+                candidate_id = self._candidate_ids[category_id][candidate_name]
+                self._candidate_votes[category_id][candidate_id] -= 1
+        with self._timeline_lock:
+            self._timeline.add(category_id, -1)
+
+    def replay(self, ballots):
+        """Record already-accepted (tokens, category, candidate_name, client_ip) ballots in bulk.
+
+        No duplicate checks and one lock acquisition for the whole batch; used
+        to rebuild the state from the vote journal.
+        """
+        applied = 0
+        with self._all_locked():
+            known_tokens = self._tokens
+            known_ips = self._ips
+            for tokens, category, candidate_name, client_ip in ballots:
+                category_id = self.category_ids.get(category)
+                if category_id is None:
+                    continue
+                bit = 1 << category_id
+                for token in tokens:
+                    known_tokens[token] = known_tokens.get(token, 0) | bit
+                if client_ip:
+                    known_ips[client_ip] = known_ips.get(client_ip, 0) | bit
+                self._ballots[category_id] += 1
+                if candidate_name:
+                    candidate_id = self._candidate_ids[category_id].get(candidate_name)
+                    if candidate_id is None:
+                        candidate_id = len(self._candidate_names[category_id])
+                        self._candidate_ids[category_id][candidate_name] = candidate_id
+                        self._candidate_names[category_id].append(candidate_name)
+                        self._candidate_votes[category_id].append(0)
+                    self._candidate_votes[category_id][candidate_id] += 1
+                applied += 1
+        return applied
+
+    def has_token(self, token):
+        return token in self._tokens
+
+    def has_voted(self, token, category):
+        category_id = self.category_ids.get(category)
+        return category_id is not None and bool(self._tokens.get(token, 0) & (1 << category_id))
+
+    def has_ip_voted(self, client_ip, category):
+        category_id = self.category_ids.get(category)
+        return category_id is not None and bool(self._ips.get(client_ip, 0) & (1 << category_id))
+
+    def totals(self):
+        return {category: self._ballots[index] for index, category in enumerate(self.categories)}
+
+    def timeline_rows(self, first, last):
+        """(minute, category, ballots) rows for build_timeline"""
+        with self._timeline_lock:
+            rows = self._timeline.rows(first, last)
+        return [(minute, self.categories[category_id], ballots) for minute, category_id, ballots in rows]
+
+    def candidate_rows(self):
+        """(category, candidate_name, votes) rows for build_results"""
+        rows = []
+        for index, category in enumerate(self.categories):
+            with self._category_locks[index]:
+                rows.extend(zip([category] * len(self._candidate_names[index]),
+                                self._candidate_names[index],
+                                self._candidate_votes[index]))
+        return rows
+
+    @contextmanager
+    def _all_locked(self):
+        locks = self._stripes + self._category_locks + [self._timeline_lock]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def reset(self):
+        with self._all_locked():
+            self._init_state()
+
+    def dump(self):
+        """Consistent copy of the state: (tokens, ips, ballots, [[(candidate, votes)] per category])"""
+        with self._all_locked():
+            return (dict(self._tokens), dict(self._ips), list(self._ballots),
+                    [list(zip(names, votes)) for names, votes in zip(self._candidate_names, self._candidate_votes)])
+
+    def restore(self, tokens, ips, ballots, candidates):
+        """Replace the state with one from dump(); category bitmasks must use this engine's order"""
+        with self._all_locked():
+            self._init_state()
+            self._tokens = tokens
+            self._ips = ips
+            self._ballots = array('q', ballots)
+            for category_id, rows in enumerate(candidates):
+                self._candidate_names[category_id] = [name for name, _ in rows]
+                self._candidate_ids[category_id] = {name: index for index, (name, _) in enumerate(rows)}
+                self._candidate_votes[category_id] = array('q', [votes for _, votes in rows])
+
+    def stats(self):
+        return {
+            "tokens": len(self._tokens),
+            "ips": len(self._ips),
+            "candidates": sum(len(names) for names in self._candidate_names),
+        }
+
+
+def measure_memory(token_count=1_000_000):
+    """Bytes allocated by an engine holding `token_count` tokens spread over the categories"""
+    import tracemalloc
+
+    engine = MemoryVoteEngine()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for index in range(token_count):
+        token = f"device:{index:08d}-0000-4000-8000-000000000000"
+        engine.admit({"device": token}, engine.categories[index % len(engine.categories)], f"Candidate {index % 10}")
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used
+
+
+if __name__ == "__main__":
+    used = measure_memory()
+    print(f"{used / 1_000_000:.1f} MB per million tokens ({used / 1_000_000:.0f} bytes/token)")
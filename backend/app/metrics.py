@@ -0,0 +1,219 @@
+import functools
+import time
+from bisect import bisect_left
+
+# Seconds; an observation lands in the first bucket whose bound it does not exceed
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(**labels):
+    return ",".join(f'{key}="{str(value)}"'.replace("\n", " ") for key, value in labels.items())
+
+
+class Histogram:
+    """Cumulative-on-render latency histogram; observe() is a bisect and three increments"""
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels, lines):
+        running = 0
+        for bound, count in zip(self.bounds, self.counts):
+            running += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {running}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum:.6f}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+
+
+class RouteMetrics:
+    __slots__ = ("labels", "latency", "statuses")
+
+    def __init__(self, method, route):
+        self.labels = _labels(method=method, route=route)
+        self.latency = Histogram()
+        self.statuses = {}
+
+    def observe(self, elapsed, status):
+        self.latency.observe(elapsed)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+
+class StorageMetrics:
+    __slots__ = ("labels", "latency", "exceptions")
+
+    def __init__(self, name):
+        self.labels = _labels(function=name)
+        self.latency = Histogram()
+        self.exceptions = 0
+
+
+class Metrics:
+    """Process-wide counters rendered in the Prometheus text format.
+
+    Every series is allocated when its route, storage function or rejection
+    rule is registered, so the hot path only does dict lookups and integer
+    increments. Values are per worker; Prometheus sums them across workers.
+    Increments from threadpool threads are not locked, as counters tolerate a
+    rare lost update better than the request path tolerates a lock.
+    """
+
+    def __init__(self):
+        self.in_flight = 0
+        self.routes = {}
+        self.unmatched = RouteMetrics("*", "unmatched")
+        self.storage = {}
+        self.storage_errors = {}
+        self.ballots_accepted = 0
+        self.rejections = {}
+        self.gauge_sources = []
+
+    def register_routes(self, routes):
+        for route in routes:
+            for method in getattr(route, "methods", None) or ():
+                self.routes.setdefault((method, route.path), RouteMetrics(method, route.path))
+
+    def register_rejection_rules(self, rules):
+        for rule in rules:
+            self.rejections.setdefault(rule, 0)
+
+    def add_gauges(self, prefix, source):
+        """Report every numeric value of source() as a gauge named prefix_key at scrape time"""
+        self.gauge_sources.append((prefix, source))
+
+    def route(self, method, path):
+        # Unknown paths share one series so scanners cannot blow up cardinality
+        return self.routes.get((method, path), self.unmatched)
+
+    def timed(self, name):
+        """Decorator counting calls, latency and raised exceptions of an async storage function"""
+        series = self.storage.setdefault(name, StorageMetrics(name))
+
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except BaseException:
+                    series.exceptions += 1
+                    raise
+                finally:
+                    series.latency.observe(time.perf_counter() - started)
+            return wrapper
+        return decorator
+
+    def storage_error(self, operation):
+        self.storage_errors[operation] = self.storage_errors.get(operation, 0) + 1
+
+    def ballot(self, rejected_by):
+        if rejected_by is None:
+            self.ballots_accepted += 1
+        else:
+            self.rejections[rejected_by] = self.rejections.get(rejected_by, 0) + 1
+
+    def render(self):
+        lines = [
+            "# HELP voting_http_requests_in_flight Requests being handled, including open streams",
+            "# TYPE voting_http_requests_in_flight gauge",
+            f"voting_http_requests_in_flight {self.in_flight}",
+            "# HELP voting_http_request_duration_seconds Time to response start per route",
+            "# TYPE voting_http_request_duration_seconds histogram",
+        ]
+        routes = list(self.routes.values()) + [self.unmatched]
+        for route in routes:
+            route.latency.render("voting_http_request_duration_seconds", route.labels, lines)
+
+        lines += ["# HELP voting_http_responses_total Responses per route and status code",
+                  "# TYPE voting_http_responses_total counter"]
+        for route in routes:
+            for status, count in list(route.statuses.items()):
+                lines.append(f'voting_http_responses_total{{{route.labels},status="{status}"}} {count}')
+
+        lines += ["# HELP voting_storage_call_duration_seconds Storage call latency per function",
+                  "# TYPE voting_storage_call_duration_seconds histogram"]
+        for series in self.storage.values():
+            series.latency.render("voting_storage_call_duration_seconds", series.labels, lines)
+
+        lines += ["# HELP voting_storage_exceptions_total Exceptions raised out of storage functions",
+                  "# TYPE voting_storage_exceptions_total counter"]
+        for series in self.storage.values():
+            lines.append(f"voting_storage_exceptions_total{{{series.labels}}} {series.exceptions}")
+
+        lines += ["# HELP voting_storage_errors_total Storage errors handled and logged, per operation",
+                  "# TYPE voting_storage_errors_total counter"]
+        for operation, count in list(self.storage_errors.items()):
+            lines.append(f"voting_storage_errors_total{{{_labels(operation=operation)}}} {count}")
+
+        lines += ["# HELP voting_ballots_accepted_total Ballots recorded",
+                  "# TYPE voting_ballots_accepted_total counter",
+                  f"voting_ballots_accepted_total {self.ballots_accepted}",
+                  "# HELP voting_ballots_rejected_total Ballots rejected, per rule",
+                  "# TYPE voting_ballots_rejected_total counter"]
+        for rule, count in list(self.rejections.items()):
+            lines.append(f"voting_ballots_rejected_total{{{_labels(rule=rule)}}} {count}")
+
+        for prefix, source in self.gauge_sources:
+            try:
+                values = source()
+            except Exception as e:
+                print(f"Metrics source error: {e}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f"# TYPE {prefix}_{key} gauge")
+                    lines.append(f"{prefix}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def storage_error(operation, e):
+    """Log a handled storage error and count it under its operation name"""
+    print(f"{operation} error: {e}")
+    metrics.storage_error(operation)
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing each request to its response start and tracking in-flight requests"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        if not metrics.routes:
+            metrics.register_routes(scope["app"].routes)
+        route = metrics.route(scope["method"], scope["path"])
+        started = time.perf_counter()
+        responded = False
+
+        async def send_timed(message):
+            nonlocal responded
+            if message["type"] == "http.response.start":
+                responded = True
+                route.observe(time.perf_counter() - started, message["status"])
+            await send(message)
+
+        metrics.in_flight += 1
+        try:
+            await self.app(scope, receive, send_timed)
+        except BaseException:
+            if not responded:
+                route.observe(time.perf_counter() - started, 500)
+            raise
+        finally:
+            metrics.in_flight -= 1
@@ -0,0 +1,324 @@
+"""Versioned Postgres schema migrations, applied in order by init_database().
+
+Each migration runs once, recorded in schema_migrations, inside the startup
+transaction and under an advisory lock, so workers starting together apply
+it exactly once and a failed migration leaves the old schema untouched.
+"""
+
+MIGRATION_LOCK_SQL = 'SELECT pg_advisory_xact_lock(727002)'
+
+MIGRATIONS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        description VARCHAR(255) NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+# Version 1: the original free-text schema. Databases created before
+# migrations were versioned already have it; every statement is idempotent.
+TEXT_SCHEMA_SQL = [
+    '''
+    CREATE TABLE IF NOT EXISTS votes (
+        id SERIAL PRIMARY KEY,
+        device_token VARCHAR(255) NOT NULL,
+        category VARCHAR(100) NOT NULL,
+        candidate_name VARCHAR(255),
+        client_ip VARCHAR(45),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(device_token, category)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS ip_votes (
+        id SERIAL PRIMARY KEY,
+        client_ip VARCHAR(45) NOT NULL,
+        category VARCHAR(100) NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(client_ip, category)
+    )
+    ''',
+    # Active devices: the time bucket each was last seen in, plus a
+    # per-bucket count so the active total is a few-row sum
+    '''
+    CREATE TABLE IF NOT EXISTS presence (
+        device_token VARCHAR(255) PRIMARY KEY,
+        bucket BIGINT NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS presence_bucket_idx ON presence (bucket)',
+    '''
+    CREATE TABLE IF NOT EXISTS presence_counts (
+        bucket BIGINT PRIMARY KEY,
+        users INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    # Running totals per ballot, maintained in the same transaction as the vote
+    '''
+    CREATE TABLE IF NOT EXISTS vote_tallies (
+        category VARCHAR(100) NOT NULL,
+        candidate_name VARCHAR(255) NOT NULL DEFAULT '',
+        shard SMALLINT NOT NULL DEFAULT 0,
+        votes BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (category, candidate_name, shard)
+    )
+    ''',
+    # Backfill from existing votes once; every ballot has exactly one device: row
+    '''
+    INSERT INTO vote_tallies (category, candidate_name, shard, votes)
+    SELECT category, COALESCE(candidate_name, ''), 0, COUNT(*)
+    FROM votes
+    WHERE device_token LIKE 'device:%'
+      AND NOT EXISTS (SELECT 1 FROM vote_tallies)
+    GROUP BY category, COALESCE(candidate_name, '')
+    ON CONFLICT DO NOTHING
+    '''
+]
+
+# Version 2: categories and candidates get integer ids. votes shrinks to the
+# (token hash, category id) duplicate index and each ballot is stored once in
+# ballots instead of once per token. No foreign keys on the hot tables: the
+# KEY SHARE locks they take would make every ballot touch its category row.
+REGISTRY_SQL = [
+    '''
+    CREATE TABLE IF NOT EXISTS categories (
+        id SMALLSERIAL PRIMARY KEY,
+        name VARCHAR(100) NOT NULL UNIQUE,
+        position SMALLINT NOT NULL DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS candidates (
+        id SERIAL PRIMARY KEY,
+        category_id SMALLINT NOT NULL REFERENCES categories (id),
+        name VARCHAR(255) NOT NULL,
+        UNIQUE (category_id, name)
+    )
+    '''
+]
+
+SEED_CATEGORIES_SQL = '''
+    INSERT INTO categories (name, position)
+    SELECT name, position FROM unnest(%s::varchar[]) WITH ORDINALITY AS c(name, position)
+    ON CONFLICT (name) DO NOTHING
+'''
+
+NORMALIZE_SQL = [
+    'ALTER TABLE votes RENAME TO votes_v1',
+    'ALTER TABLE ip_votes RENAME TO ip_votes_v1',
+    'ALTER TABLE vote_tallies RENAME TO vote_tallies_v1',
+    # Keep whatever categories were voted in, after the configured ones
+    '''
+    INSERT INTO categories (name, position)
+    SELECT DISTINCT category, 32767 FROM votes_v1
+    ON CONFLICT (name) DO NOTHING
+    ''',
+    '''
+    INSERT INTO candidates (category_id, name)
+    SELECT DISTINCT c.id, v.candidate_name
+    FROM votes_v1 v JOIN categories c ON c.name = v.category
+    WHERE v.candidate_name IS NOT NULL
+    ON CONFLICT DO NOTHING
+    ''',
+    '''
+    CREATE TABLE ballots (
+        id BIGSERIAL PRIMARY KEY,
+        device_token VARCHAR(255) NOT NULL,
+        category_id SMALLINT NOT NULL,
+        candidate_id INTEGER,
+        client_ip VARCHAR(45),
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    # Export filters and time-bucketed reads by category
+    'CREATE INDEX ballots_category_created_idx ON ballots (category_id, created_at)',
+    # The primary key is the whole row, so duplicate checks are index-only scans
+    '''
+    CREATE TABLE votes (
+        token_hash BYTEA NOT NULL,
+        category_id SMALLINT NOT NULL,
+        CONSTRAINT votes_token_category_pkey PRIMARY KEY (token_hash, category_id)
+    )
+    ''',
+    '''
+    CREATE TABLE ip_votes (
+        client_ip VARCHAR(45) NOT NULL,
+        category_id SMALLINT NOT NULL,
+        CONSTRAINT ip_votes_ip_category_pkey PRIMARY KEY (client_ip, category_id)
+    )
+    ''',
+    # candidate_id 0 is a ballot without a candidate
+    '''
+    CREATE TABLE vote_tallies (
+        category_id SMALLINT NOT NULL,
+        candidate_id INTEGER NOT NULL DEFAULT 0,
+        shard SMALLINT NOT NULL DEFAULT 0,
+        votes BIGINT NOT NULL DEFAULT 0,
+        CONSTRAINT vote_tallies_shard_pkey PRIMARY KEY (category_id, candidate_id, shard)
+    )
+    ''',
+    '''
+    INSERT INTO ballots (device_token, category_id, candidate_id, client_ip, created_at)
+    SELECT v.device_token, c.id, k.id, v.client_ip, COALESCE(v.created_at, CURRENT_TIMESTAMP)
+    FROM votes_v1 v
+    JOIN categories c ON c.name = v.category
+    LEFT JOIN candidates k ON k.category_id = c.id AND k.name = v.candidate_name
+    WHERE v.device_token LIKE 'device:%'
+    ORDER BY v.id
+    ''',
+    # md5() of the UTF-8 text, the same key app.registry.token_hash computes
+    '''
+    INSERT INTO votes (token_hash, category_id)
+    SELECT decode(md5(v.device_token), 'hex'), c.id
+    FROM votes_v1 v JOIN categories c ON c.name = v.category
+    ON CONFLICT DO NOTHING
+    ''',
+    '''
+    INSERT INTO ip_votes (client_ip, category_id)
+    SELECT v.client_ip, c.id
+    FROM ip_votes_v1 v JOIN categories c ON c.name = v.category
+    ON CONFLICT DO NOTHING
+    ''',
+    '''
+    INSERT INTO vote_tallies (category_id, candidate_id, shard, votes)
+    SELECT category_id, COALESCE(candidate_id, 0), 0, COUNT(*)
+    FROM ballots
+    GROUP BY category_id, COALESCE(candidate_id, 0)
+    ''',
+    'DROP TABLE votes_v1, ip_votes_v1, vote_tallies_v1'
+]
+
+# Version 3: election epochs. Every vote, IP, tally and ballot row belongs to
+# an election (round); a reset opens the next one instead of deleting rows,
+# and the primary keys lead with the epoch so the current round is a range
+# of each index. Existing rows become election 1.
+EPOCH_SQL = [
+    '''
+    CREATE TABLE elections (
+        id SERIAL PRIMARY KEY,
+        opened_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    'INSERT INTO elections DEFAULT VALUES',
+    'ALTER TABLE votes ADD COLUMN epoch INTEGER NOT NULL DEFAULT 1',
+    'ALTER TABLE votes DROP CONSTRAINT votes_token_category_pkey',
+    'ALTER TABLE votes ADD CONSTRAINT votes_epoch_token_category_pkey PRIMARY KEY (epoch, token_hash, category_id)',
+    'ALTER TABLE ip_votes ADD COLUMN epoch INTEGER NOT NULL DEFAULT 1',
+    'ALTER TABLE ip_votes DROP CONSTRAINT ip_votes_ip_category_pkey',
+    'ALTER TABLE ip_votes ADD CONSTRAINT ip_votes_epoch_ip_category_pkey PRIMARY KEY (epoch, client_ip, category_id)',
+    'ALTER TABLE vote_tallies ADD COLUMN epoch INTEGER NOT NULL DEFAULT 1',
+    'ALTER TABLE vote_tallies DROP CONSTRAINT vote_tallies_shard_pkey',
+    'ALTER TABLE vote_tallies ADD CONSTRAINT vote_tallies_epoch_shard_pkey PRIMARY KEY (epoch, category_id, candidate_id, shard)',
+    'ALTER TABLE ballots ADD COLUMN epoch INTEGER NOT NULL DEFAULT 1',
+    'DROP INDEX ballots_category_created_idx',
+    'CREATE INDEX ballots_epoch_category_created_idx ON ballots (epoch, category_id, created_at)',
+    # No defaults from here on: every write names its election
+    'ALTER TABLE votes ALTER COLUMN epoch DROP DEFAULT',
+    'ALTER TABLE ip_votes ALTER COLUMN epoch DROP DEFAULT',
+    'ALTER TABLE vote_tallies ALTER COLUMN epoch DROP DEFAULT',
+    'ALTER TABLE ballots ALTER COLUMN epoch DROP DEFAULT'
+]
+
+# Version 4: ballots per category per minute for the timeline, bumped with
+# the tally by every write and sharded the same way. The key leads with the
+# epoch and minute, so a time range is one index range. Filled from the
+# ballots already recorded.
+RATES_SQL = [
+    '''
+    CREATE TABLE vote_rates (
+        epoch INTEGER NOT NULL,
+        minute TIMESTAMP NOT NULL,
+        category_id SMALLINT NOT NULL,
+        shard SMALLINT NOT NULL DEFAULT 0,
+        ballots BIGINT NOT NULL DEFAULT 0,
+        CONSTRAINT vote_rates_epoch_minute_pkey PRIMARY KEY (epoch, minute, category_id, shard)
+    )
+    ''',
+    '''
+    INSERT INTO vote_rates (epoch, minute, category_id, shard, ballots)
+    SELECT epoch, date_trunc('minute', created_at), category_id, 0, COUNT(*)
+    FROM ballots
+    GROUP BY epoch, date_trunc('minute', created_at), category_id
+    '''
+]
+
+# Version 5: ballot times in UTC, the zone export bounds and the timeline
+# use. CURRENT_TIMESTAMP stamped them in the session's time zone; existing
+# rows are converted from the zone the server runs in now.
+UTC_BALLOTS_SQL = [
+    '''
+    UPDATE ballots
+    SET created_at = (created_at AT TIME ZONE current_setting('TimeZone')) AT TIME ZONE 'UTC'
+    ''',
+    "ALTER TABLE ballots ALTER COLUMN created_at SET DEFAULT (now() AT TIME ZONE 'UTC')",
+    "ALTER TABLE elections ALTER COLUMN opened_at SET DEFAULT (now() AT TIME ZONE 'UTC')"
+]
+
+# Version 6: vote_rates minutes in UTC. They were truncated from the session's
+# local time; rebuilt from the ballots, which migration 5 put in UTC.
+UTC_RATES_SQL = [
+    'DELETE FROM vote_rates',
+    '''
+    INSERT INTO vote_rates (epoch, minute, category_id, shard, ballots)
+    SELECT epoch, date_trunc('minute', created_at), category_id, 0, COUNT(*)
+    FROM ballots
+    GROUP BY epoch, date_trunc('minute', created_at), category_id
+    '''
+]
+
+
+def create_text_schema(cur, categories):
+    for statement in TEXT_SCHEMA_SQL:
+        cur.execute(statement)
+
+
+def normalize_schema(cur, categories):
+    for statement in REGISTRY_SQL:
+        cur.execute(statement)
+    cur.execute(SEED_CATEGORIES_SQL, (categories,))
+    for statement in NORMALIZE_SQL:
+        cur.execute(statement)
+
+
+def add_election_epochs(cur, categories):
+    for statement in EPOCH_SQL:
+        cur.execute(statement)
+
+
+def add_vote_rates(cur, categories):
+    for statement in RATES_SQL:
+        cur.execute(statement)
+
+
+def stamp_ballots_in_utc(cur, categories):
+    for statement in UTC_BALLOTS_SQL:
+        cur.execute(statement)
+
+
+def rebuild_vote_rates_in_utc(cur, categories):
+    for statement in UTC_RATES_SQL:
+        cur.execute(statement)
+
+
+MIGRATIONS = [
+    (1, "free-text votes, ip_votes and vote_tallies", create_text_schema),
+    (2, "category and candidate ids, hashed token index, one ballots row per ballot", normalize_schema),
+    (3, "election epochs on votes, ip_votes, vote_tallies and ballots", add_election_epochs),
+    (4, "per-minute ballot counts in vote_rates", add_vote_rates),
+    (5, "ballot times in UTC", stamp_ballots_in_utc),
+    (6, "vote_rates minutes in UTC", rebuild_vote_rates_in_utc)
+]
+
+
+def run_migrations(cur, categories):
+    """Apply every migration not yet recorded; the caller commits"""
+    cur.execute(MIGRATION_LOCK_SQL)
+    cur.execute(MIGRATIONS_TABLE_SQL)
+    cur.execute('SELECT version FROM schema_migrations')
+    applied = {row['version'] for row in cur.fetchall()}
+    for version, description, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        migrate(cur, categories)
+        cur.execute('INSERT INTO schema_migrations (version, description) VALUES (%s, %s)', (version, description))
+        print(f"Applied schema migration {version}: {description}")
@@ -0,0 +1,195 @@
+import threading
+import time
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import RealDictCursor
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Thread-safe psycopg2 connection pool shared by the storage functions"""
+
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=5.0, max_uses=1000,
+                 check_interval=0.0, cursor_factory=RealDictCursor, connect_timeout=None):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = max(maxconn, minconn, 1)
+        self.timeout = timeout
+        self.max_uses = max_uses
+        self.check_interval = check_interval
+        self.cursor_factory = cursor_factory
+        # Seconds; None leaves it to the DSN (and libpq's default of waiting indefinitely)
+        self.connect_kwargs = {"connect_timeout": connect_timeout} if connect_timeout else {}
+
+        self._cond = threading.Condition()
+        self._idle = []
+        self._uses = {}
+        self._last_used = {}
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+
+        self._counters = {
+            "connections_opened": 0,
+            "connections_closed": 0,
+            "checkouts": 0,
+            "timeouts": 0,
+            "failed_health_checks": 0,
+            "recycled": 0,
+            "wait_time_total": 0.0,
+        }
+
+        for _ in range(minconn):
+            try:
+                conn = self._connect()
+            except Exception as e:
+                print(f"Pool prefill failed: {e}")
+                break
+            with self._cond:
+                self._size += 1
+                self._counters["connections_opened"] += 1
+                self._idle.append(conn)
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, cursor_factory=self.cursor_factory, **self.connect_kwargs)
+        self._uses[id(conn)] = 0
+        self._last_used[id(conn)] = time.monotonic()
+        return conn
+
+    def _discard(self, conn):
+        self._uses.pop(id(conn), None)
+        self._last_used.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self._counters["connections_closed"] += 1
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        # A server restart or failover leaves no trace on the client side, so
+        # by default every checkout pings; check_interval > 0 trusts recently
+        # used connections instead
+        idle_for = time.monotonic() - self._last_used.get(id(conn), 0)
+        if idle_for < self.check_interval:
+            return True
+        try:
+            # In autocommit the ping is one round trip, with no ROLLBACK after it
+            conn.autocommit = True
+            try:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT 1')
+            finally:
+                conn.autocommit = False
+            return True
+        except Exception:
+            return False
+
+    def getconn(self):
+        """Check out a connection, waiting up to `timeout` seconds for a free slot"""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        while True:
+            conn = None
+            opened = False
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolTimeout("Connection pool is closed")
+                    if self._idle:
+                        conn = self._idle.pop()
+                        break
+                    if self._size < self.maxconn:
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters["timeouts"] += 1
+                        raise PoolTimeout(f"Timed out after {self.timeout}s waiting for a database connection")
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+                self._in_use += 1
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                    opened = True
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._in_use -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._is_healthy(conn):
+                with self._cond:
+                    self._counters["failed_health_checks"] += 1
+                    self._discard(conn)
+                    self._size -= 1
+                    self._in_use -= 1
+                    self._cond.notify()
+                continue
+
+            with self._cond:
+                if opened:
+                    self._counters["connections_opened"] += 1
+                self._counters["checkouts"] += 1
+                self._counters["wait_time_total"] += time.monotonic() - started
+            return conn
+
+    def putconn(self, conn):
+        """Return a connection; it is rolled back if dirty and recycled after `max_uses` checkouts"""
+        keep = not conn.closed and not self._closed
+        if keep and conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                keep = False
+
+        with self._cond:
+            self._in_use -= 1
+            uses = self._uses.get(id(conn), 0) + 1
+            if keep and self.max_uses and uses >= self.max_uses:
+                self._counters["recycled"] += 1
+                keep = False
+            if keep:
+                self._uses[id(conn)] = uses
+                self._last_used[id(conn)] = time.monotonic()
+                self._idle.append(conn)
+            else:
+                self._discard(conn)
+                self._size -= 1
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                self._discard(self._idle.pop())
+                self._size -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counters)
+            stats.update({
+                "min_size": self.minconn,
+                "max_size": self.maxconn,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "waiting": self._waiting,
+                "timeout": self.timeout,
+                "max_uses": self.max_uses,
+            })
+        checkouts = stats["checkouts"]
+        stats["wait_time_avg"] = stats["wait_time_total"] / checkouts if checkouts else 0.0
+        return stats
@@ -0,0 +1,62 @@
+import os
+import threading
+import time
+
+PRESENCE_WINDOW = int(os.getenv('PRESENCE_WINDOW', '30'))
+PRESENCE_BUCKET_SECONDS = int(os.getenv('PRESENCE_BUCKET_SECONDS', '5'))
+
+
+def current_bucket(bucket_seconds=PRESENCE_BUCKET_SECONDS, now=None):
+    # Wall-clock buckets so every worker (and the database) agrees on numbering
+    return int((time.time() if now is None else now) // bucket_seconds)
+
+
+class PresenceTracker:
+    """Sliding-window count of active devices kept in fixed time buckets.
+
+    Each device lives only in the bucket it was last seen in, so the active
+    count is the sum of a handful of bucket sizes and whole buckets drop off
+    the end of the window at once.
+    """
+
+    def __init__(self, window=PRESENCE_WINDOW, bucket_seconds=PRESENCE_BUCKET_SECONDS):
+        self.bucket_seconds = bucket_seconds
+        self.bucket_count = max(1, window // bucket_seconds)
+        self._lock = threading.Lock()
+        self._latest = {}
+        self._members = {}
+
+    def cutoff(self, bucket=None):
+        """Oldest bucket still inside the window"""
+        if bucket is None:
+            bucket = current_bucket(self.bucket_seconds)
+        return bucket - self.bucket_count + 1
+
+    def _expire(self, cutoff):
+        for bucket in [bucket for bucket in self._members if bucket < cutoff]:
+            for token in self._members.pop(bucket):
+                del self._latest[token]
+
+    def touch(self, device_token, now=None):
+        """Record activity; returns False if the device was already seen in the current bucket"""
+        bucket = current_bucket(self.bucket_seconds, now)
+        with self._lock:
+            previous = self._latest.get(device_token)
+            if previous == bucket:
+                return False
+            if previous is not None:
+                self._members[previous].discard(device_token)
+            self._latest[device_token] = bucket
+            self._members.setdefault(bucket, set()).add(device_token)
+            self._expire(self.cutoff(bucket))
+        return True
+
+    def count(self, now=None):
+        with self._lock:
+            self._expire(self.cutoff(current_bucket(self.bucket_seconds, now)))
+            return sum(len(members) for members in self._members.values())
+
+    def clear(self):
+        with self._lock:
+            self._latest.clear()
+            self._members.clear()
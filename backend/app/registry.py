@@ -0,0 +1,74 @@
+"""Voting categories and candidates, each with a small integer id.
+
+The categories come from VOTING_CATEGORIES and, on Postgres, from the
+categories table, so a new category needs no code change: add it to the
+variable, or insert it into the table and workers pick it up the next time a
+ballot names it. Candidates get an id the first time a ballot names them.
+"""
+import hashlib
+import os
+import threading
+import time
+
+DEFAULT_CATEGORIES = ["King", "Queen", "Prince", "Princess", "Best Costume Male", "Best Costume Female", "Best Performance Award"]
+
+VOTING_CATEGORIES = [name.strip() for name in os.getenv('VOTING_CATEGORIES', '').split(',') if name.strip()] or DEFAULT_CATEGORIES
+# Unknown category names reload the registry from the database at most this often
+REGISTRY_REFRESH_SECONDS = float(os.getenv('REGISTRY_REFRESH_SECONDS', '5'))
+
+
+def token_hash(value):
+    """16-byte key a token (or IP) is stored and filtered under.
+
+    md5 only as a fast fixed-width key, matching md5() in the migration SQL;
+    nothing relies on it being hard to invert.
+    """
+    return hashlib.md5(value.encode(), usedforsecurity=False).digest()
+
+
+def hash_tokens(tokens):
+    return {rule: token_hash(token) for rule, token in tokens.items()}
+
+
+class Registry:
+    """Name <-> id maps for categories and candidates, shared by every request in the process"""
+
+    def __init__(self, categories=VOTING_CATEGORIES):
+        self._lock = threading.Lock()
+        self._refreshed_at = 0.0
+        self.load([(index + 1, name) for index, name in enumerate(categories)], [])
+
+    def load(self, categories, candidates):
+        """Replace the contents with (id, name) categories in display order and (id, category_id, name) candidates"""
+        with self._lock:
+            self._names = [name for _, name in categories]
+            self._category_ids = {name: category_id for category_id, name in categories}
+            self._candidate_ids = {(category_id, name): candidate_id for candidate_id, category_id, name in candidates}
+            self._refreshed_at = time.monotonic()
+
+    def names(self):
+        return self._names
+
+    def category_id(self, name):
+        return self._category_ids.get(name)
+
+    def candidate_id(self, category_id, name):
+        return self._candidate_ids.get((category_id, name))
+
+    def add_candidate(self, candidate_id, category_id, name):
+        with self._lock:
+            self._candidate_ids[(category_id, name)] = candidate_id
+
+    def refresh_due(self):
+        """True for one caller once REGISTRY_REFRESH_SECONDS have passed since the last load"""
+        with self._lock:
+            if time.monotonic() - self._refreshed_at < REGISTRY_REFRESH_SECONDS:
+                return False
+            self._refreshed_at = time.monotonic()
+            return True
+
+    def stats(self):
+        return {"categories": len(self._names), "candidates": len(self._candidate_ids)}
+
+
+registry = Registry()
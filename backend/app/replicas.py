@@ -0,0 +1,217 @@
+import itertools
+import os
+import threading
+import time
+from collections import deque
+
+from app.pool import ConnectionPool
+
+# Comma-separated Postgres DSNs of streaming replicas for the polled reads
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+REPLICA_MAX_LAG_SECONDS = float(os.getenv('REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_CHECK_INTERVAL = float(os.getenv('REPLICA_CHECK_INTERVAL', '2'))
+REPLICA_POOL_MAX = int(os.getenv('REPLICA_POOL_MAX', '5'))
+REPLICA_CONNECT_TIMEOUT = int(os.getenv('REPLICA_CONNECT_TIMEOUT', '2'))
+
+# The replica's side of a lag check. Positions are WAL bytes, compared with
+# the primary's pg_current_wal_lsn() sampled just before. A standby whose WAL
+# receiver is not streaming is stale however much it has replayed. Seeing
+# pg_stat_wal_receiver needs pg_read_all_stats (or pg_monitor).
+REPLICA_STATUS_SQL = '''
+    SELECT pg_is_in_recovery() AS in_recovery,
+           pg_wal_lsn_diff(pg_last_wal_replay_lsn(), '0/0')::bigint AS replayed,
+           EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())::float8 AS replay_age,
+           EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') AS streaming
+'''
+
+PRIMARY_POSITION_SQL = "SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), '0/0')::bigint AS position"
+
+
+class Replica:
+    def __init__(self, dsn, index):
+        self.dsn = dsn
+        self.name = f"replica{index}"
+        self.pool = ConnectionPool(
+            dsn,
+            minconn=0,
+            maxconn=REPLICA_POOL_MAX,
+            timeout=REPLICA_CONNECT_TIMEOUT,
+            connect_timeout=REPLICA_CONNECT_TIMEOUT
+        )
+        # Checks run in the health thread while reads from any request
+        # thread update the counters and can take the replica out
+        self._lock = threading.Lock()
+        self.healthy = False
+        self.streaming = None
+        self.lag = None
+        self.counters = {"reads": 0, "read_errors": 0, "checks": 0, "failed_checks": 0}
+
+    def check(self, max_lag, lag_of):
+        """Query the replica's status; lag_of(replayed, replay_age) turns it into seconds behind the primary"""
+        try:
+            conn = self.pool.getconn()
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(REPLICA_STATUS_SQL)
+                    row = cur.fetchone()
+            finally:
+                self.pool.putconn(conn)
+        except Exception as e:
+            with self._lock:
+                was_healthy = self.healthy
+                self.counters["checks"] += 1
+                self.counters["failed_checks"] += 1
+                self.healthy = False
+            if was_healthy:
+                print(f"Replica {self.name} unavailable: {e}")
+            return
+
+        if row['in_recovery']:
+            streaming = row['streaming']
+            lag = lag_of(row['replayed'], row['replay_age'])
+        else:
+            # Not a standby (a promoted one, or the primary itself): nothing to lag behind
+            streaming, lag = None, 0.0
+        healthy = streaming is not False and lag <= max_lag
+        with self._lock:
+            was_healthy = self.healthy
+            self.counters["checks"] += 1
+            self.streaming = streaming
+            self.lag = lag
+            self.healthy = healthy
+        if was_healthy and not healthy:
+            reason = "WAL receiver not streaming" if streaming is False else f"{lag:.1f}s behind"
+            print(f"Replica {self.name} out of rotation: {reason}")
+
+    def fetch(self, sql, params=None):
+        """Rows of a read-only query, or None (and out of rotation until its next check) on any error"""
+        try:
+            conn = self.pool.getconn()
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(sql, params)
+                    rows = cur.fetchall()
+            finally:
+                self.pool.putconn(conn)
+        except Exception as e:
+            self.failed(e)
+            return None
+        self.served()
+        return rows
+
+    def served(self):
+        with self._lock:
+            self.counters["reads"] += 1
+
+    def failed(self, e):
+        print(f"Replica {self.name} read error: {e}")
+        with self._lock:
+            self.counters["read_errors"] += 1
+            self.healthy = False
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, name=self.name, healthy=self.healthy, streaming=self.streaming,
+                        lag_seconds=self.lag)
+
+
+class ReplicaSet:
+    """Round-robin over the replicas that passed their last health check.
+
+    A background thread checks each replica every REPLICA_CHECK_INTERVAL
+    seconds and takes it out of rotation while it is unreachable or more
+    than REPLICA_MAX_LAG_SECONDS behind. A read error also takes it out
+    until the next good check. With no usable replica, reads go to the
+    primary. Only idempotent reads of published totals come here; anything
+    that decides a ballot reads the primary.
+    """
+
+    def __init__(self, dsns=DATABASE_REPLICA_URLS, max_lag=REPLICA_MAX_LAG_SECONDS,
+                 check_interval=REPLICA_CHECK_INTERVAL, primary_position=None):
+        self.replicas = [Replica(dsn, index) for index, dsn in enumerate(dsns)]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        # Callable returning the primary's WAL position in bytes, or None when unreachable
+        self.primary_position = primary_position
+        # (monotonic time, primary position) from recent checks, oldest first
+        self._samples = deque()
+        self._lock = threading.Lock()
+        self.primary_fallbacks = 0
+        self._turn = itertools.count()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if not self.replicas or self._thread is not None:
+            return
+        # One synchronous round so reads use the replicas from the first request
+        self.check_all()
+        self._thread = threading.Thread(target=self._run, name="replica-health", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.check_interval):
+            self.check_all()
+
+    def check_all(self):
+        # The primary first, so a replica that has replayed up to this sample is current
+        now = time.monotonic()
+        position = None
+        if self.primary_position is not None:
+            try:
+                position = self.primary_position()
+            except Exception as e:
+                print(f"Replica check: primary position unavailable: {e}")
+        if position is not None:
+            self._samples.append((now, position))
+            # Keep one sample older than max_lag, enough to tell a replica is past it
+            while len(self._samples) > 1 and self._samples[1][0] <= now - self.max_lag:
+                self._samples.popleft()
+        for replica in self.replicas:
+            replica.check(self.max_lag, lambda replayed, replay_age: self._lag(replayed, replay_age, now))
+
+    def _lag(self, replayed, replay_age, now):
+        """Seconds since the primary was last at a position the replica has replayed"""
+        if replayed is not None:
+            for sampled_at, position in reversed(self._samples):
+                if position <= replayed:
+                    return now - sampled_at
+        # Behind every sample, or no primary to sample: at least as old as the
+        # oldest sample, and the last replayed commit is an upper bound
+        oldest = now - self._samples[0][0] if self._samples else 0.0
+        return max(oldest, replay_age or 0.0)
+
+    def choose(self):
+        """The next usable replica, or None to read the primary"""
+        usable = [replica for replica in self.replicas if replica.healthy]
+        if not usable:
+            if self.replicas:
+                self.fell_back()
+            return None
+        return usable[next(self._turn) % len(usable)]
+
+    def fell_back(self):
+        with self._lock:
+            self.primary_fallbacks += 1
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for replica in self.replicas:
+            replica.pool.closeall()
+
+    def stats(self):
+        replicas = [replica.stats() for replica in self.replicas]
+        lags = [replica["lag_seconds"] for replica in replicas if replica["lag_seconds"] is not None]
+        return {
+            "configured": len(replicas),
+            "usable": sum(replica["healthy"] for replica in replicas),
+            "max_lag_seconds": self.max_lag,
+            "worst_lag_seconds": max(lags, default=0.0),
+            "replica_reads": sum(replica["reads"] for replica in replicas),
+            "replica_read_errors": sum(replica["read_errors"] for replica in replicas),
+            "primary_fallbacks": self.primary_fallbacks,
+            "replicas": replicas
+        }
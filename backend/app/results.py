@@ -0,0 +1,56 @@
+from app.registry import registry
+
+def build_counts(rows, categories=None):
+    """Build the /counts payload from (category, count) rows"""
+    counts = {category: 0 for category in categories or registry.names()}
+    for category, count in rows:
+        if category in counts:
+            counts[category] = count
+    counts["total"] = sum(counts.values())
+    return counts
+
+def build_results(rows, totals=None, categories=None):
+    """Build the /results payload from (category, candidate_name, votes) rows in one pass.
+
+    Rows with an empty candidate name count towards the category total only.
+    If `totals` is given it supplies the per-category ballot totals instead.
+    """
+    results = {}
+    leaders = {}
+    for category in categories or registry.names():
+        results[category] = {
+            "leading_candidate": "No votes yet",
+            "votes": 0,
+            "total_votes": totals.get(category, 0) if totals is not None else 0,
+            "percentage": 0,
+            "all_candidates": {}
+        }
+        leaders[category] = []
+    
+    for category, candidate_name, votes in rows:
+        result = results.get(category)
+        if result is None:
+            continue
+        if totals is None:
+            result["total_votes"] += votes
+        if not candidate_name:
+            continue
+        result["all_candidates"][candidate_name] = votes
+        if votes > result["votes"]:
+            result["votes"] = votes
+            leaders[category] = [candidate_name]
+        elif votes == result["votes"]:
+            leaders[category].append(candidate_name)
+    
+    for category, tied_candidates in leaders.items():
+        if not tied_candidates:
+            continue
+        result = results[category]
+        if len(tied_candidates) == 1:
+            result["leading_candidate"] = tied_candidates[0]
+        else:
+            result["leading_candidate"] = f"Tie: {', '.join(tied_candidates)}"
+        total_votes = result["total_votes"]
+        result["percentage"] = round((result["votes"] / total_votes * 100) if total_votes > 0 else 0, 1)
+    
+    return results
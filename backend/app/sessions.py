@@ -0,0 +1,270 @@
+import asyncio
+import fcntl
+import heapq
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from starlette.concurrency import run_in_threadpool
+
+SESSION_TTL = int(os.getenv('SESSION_TTL', '86400'))
+SESSION_MAX = int(os.getenv('SESSION_MAX', '100000'))
+SESSION_SWEEP_INTERVAL = float(os.getenv('SESSION_SWEEP_INTERVAL', '1'))
+SESSION_SWEEP_BUDGET_MS = float(os.getenv('SESSION_SWEEP_BUDGET_MS', '2'))
+SESSION_FLUSH_INTERVAL = float(os.getenv('SESSION_FLUSH_INTERVAL', '5'))
+# '' keeps sessions in memory only; 'file' or 'database' (Postgres) survive restarts
+SESSION_PERSIST = os.getenv('SESSION_PERSIST', '')
+SESSION_FILE = os.getenv('SESSION_FILE', 'sessions.json')
+
+
+class FileSessionPersistence:
+    """JSON file shared by every worker; each flush merges its changes in under an flock"""
+
+    snapshot = False
+
+    def __init__(self, path=SESSION_FILE, ttl=SESSION_TTL):
+        self.path = path
+        self.ttl = ttl
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def flush(self, sessions, upserts, deletes):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with open(f"{self.path}.lock", "a") as lock_file:
+            # Other workers flush into the same file, so re-read it and apply
+            # only this worker's changes rather than overwriting theirs
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                merged = self.load()
+                for token in deletes:
+                    merged.pop(token, None)
+                merged.update(sessions)
+                # Sessions left behind by a worker that has since exited
+                cutoff = time.time() - self.ttl
+                merged = {token: session for token, session in merged.items() if session["created_at"] >= cutoff}
+                fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".sessions-", suffix=".tmp")
+                try:
+                    with os.fdopen(fd, "w") as f:
+                        json.dump(merged, f, separators=(',', ':'))
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(temp_path, self.path)
+                except BaseException:
+                    os.unlink(temp_path)
+                    raise
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class DatabaseSessionPersistence:
+    """Sessions table in Postgres, written as the changes since the last flush"""
+
+    snapshot = False
+
+    def load(self):
+        from app.database import load_sessions_db
+        return load_sessions_db()
+
+    def flush(self, sessions, upserts, deletes):
+        from app.database import save_sessions_db
+        save_sessions_db([(token, sessions[token]) for token in upserts if token in sessions], list(deletes))
+
+
+def create_persistence(kind=SESSION_PERSIST):
+    if kind == 'file':
+        return FileSessionPersistence()
+    if kind == 'database':
+        if os.getenv('DATABASE_URL'):
+            return DatabaseSessionPersistence()
+        print("SESSION_PERSIST=database needs DATABASE_URL, keeping sessions in memory")
+    elif kind:
+        print(f"Unknown SESSION_PERSIST '{kind}', keeping sessions in memory")
+    return None
+
+
+class SessionStore:
+    """Login sessions with an expiry heap, an LRU cap and write-behind persistence.
+
+    Expired sessions are removed by sweep(), which pops the heap for at most a
+    time budget per call, so a backlog is worked off in short slices instead
+    of one long pause. Past `max_sessions` the least recently used session is
+    evicted. Persistence is written by the sweeper every `flush_interval`
+    seconds and on shutdown, never on the request path.
+    """
+
+    def __init__(self, ttl=SESSION_TTL, max_sessions=SESSION_MAX, persistence=None, on_remove=None):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.persistence = persistence
+        self.on_remove = on_remove
+        self._sessions = OrderedDict()
+        # (expires_at, token); entries for removed sessions are skipped when popped
+        self._expiry = []
+        self._lock = threading.Lock()
+        self._upserts = set()
+        self._deletes = set()
+        self._flushed_at = time.monotonic()
+        self._task = None
+        self._counters = {"created": 0, "expired": 0, "evicted": 0, "deleted": 0, "flushes": 0, "flush_errors": 0}
+
+    def _expires_at(self, session):
+        return session["created_at"] + self.ttl
+
+    def _remove(self, token, counter):
+        # Caller holds the lock
+        self._sessions.pop(token, None)
+        self._counters[counter] += 1
+        if self.persistence:
+            self._upserts.discard(token)
+            self._deletes.add(token)
+        if self.on_remove:
+            self.on_remove(token)
+
+    def _insert(self, token, session):
+        self._sessions[token] = session
+        heapq.heappush(self._expiry, (self._expires_at(session), token))
+        while len(self._sessions) > self.max_sessions:
+            oldest = next(iter(self._sessions))
+            self._remove(oldest, "evicted")
+
+    def create(self, token, session):
+        with self._lock:
+            self._insert(token, session)
+            self._counters["created"] += 1
+            if self.persistence:
+                self._deletes.discard(token)
+                self._upserts.add(token)
+
+    def get(self, token):
+        """The session, or None if unknown or expired; marks it recently used"""
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None:
+                return None
+            if time.time() > self._expires_at(session):
+                self._remove(token, "expired")
+                return None
+            self._sessions.move_to_end(token)
+            return session
+
+    def delete(self, token):
+        with self._lock:
+            if token not in self._sessions:
+                return False
+            self._remove(token, "deleted")
+            return True
+
+    def __contains__(self, token):
+        return self.get(token) is not None
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _compact(self):
+        # Logged-out and evicted sessions leave stale heap entries behind; rebuild
+        # once they outnumber the live ones so the heap stays O(sessions)
+        if len(self._expiry) > 2 * len(self._sessions) + 1024:
+            self._expiry = [(self._expires_at(session), token) for token, session in self._sessions.items()]
+            heapq.heapify(self._expiry)
+
+    def sweep(self, budget_ms=SESSION_SWEEP_BUDGET_MS):
+        """Remove expired sessions for up to budget_ms; returns True if more are due"""
+        deadline = time.perf_counter() + budget_ms / 1000
+        now = time.time()
+        with self._lock:
+            self._compact()
+        while True:
+            with self._lock:
+                # A few pops per lock hold so requests are not kept waiting
+                for _ in range(64):
+                    if not self._expiry or self._expiry[0][0] > now:
+                        return False
+                    expires_at, token = heapq.heappop(self._expiry)
+                    session = self._sessions.get(token)
+                    if session is not None and self._expires_at(session) == expires_at:
+                        self._remove(token, "expired")
+            if time.perf_counter() >= deadline:
+                return True
+
+    def load(self):
+        if not self.persistence:
+            return
+        try:
+            sessions = self.persistence.load()
+        except Exception as e:
+            print(f"Session load error: {e}")
+            return
+        now = time.time()
+        with self._lock:
+            for token, session in sorted(sessions.items(), key=lambda item: item[1]["created_at"]):
+                if now <= self._expires_at(session):
+                    self._insert(token, session)
+
+    def flush(self):
+        """Write the changes since the last flush; runs in a thread, not on the event loop"""
+        if not self.persistence:
+            return
+        with self._lock:
+            if not self._upserts and not self._deletes:
+                return
+            upserts, self._upserts = self._upserts, set()
+            deletes, self._deletes = self._deletes, set()
+            if self.persistence.snapshot:
+                sessions = dict(self._sessions)
+            else:
+                sessions = {token: self._sessions[token] for token in upserts if token in self._sessions}
+        try:
+            self.persistence.flush(sessions, upserts, deletes)
+            self._counters["flushes"] += 1
+        except Exception as e:
+            print(f"Session flush error: {e}")
+            self._counters["flush_errors"] += 1
+            with self._lock:
+                # Retry on the next flush unless newer changes superseded them
+                self._upserts |= upserts - self._deletes
+                self._deletes |= deletes - self._upserts
+
+    async def _run(self, interval):
+        while True:
+            try:
+                # Sweep in slices, yielding to requests between them
+                while self.sweep():
+                    await asyncio.sleep(0)
+                if time.monotonic() - self._flushed_at >= SESSION_FLUSH_INTERVAL:
+                    self._flushed_at = time.monotonic()
+                    await run_in_threadpool(self.flush)
+            except Exception as e:
+                print(f"Session sweep error: {e}")
+            await asyncio.sleep(interval)
+
+    def start(self, interval=SESSION_SWEEP_INTERVAL):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run(interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await run_in_threadpool(self.flush)
+
+    def stats(self):
+        return dict(
+            self._counters,
+            sessions=len(self._sessions),
+            max_sessions=self.max_sessions,
+            expiry_index=len(self._expiry),
+            pending_writes=len(self._upserts) + len(self._deletes),
+            persistence=SESSION_PERSIST if self.persistence else "memory"
+        )
@@ -0,0 +1,438 @@
+import fcntl
+import hashlib
+import os
+import struct
+import tempfile
+import threading
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+
+from app.metrics import storage_error
+from app.presence import PRESENCE_BUCKET_SECONDS, PRESENCE_WINDOW, current_bucket
+from app.registry import registry
+from app.timeline import TIMELINE_MINUTES, MinuteRing
+
+SHARED_MEMORY_NAME = os.getenv('SHARED_MEMORY_NAME', 'sti_voting')
+SHARED_TOKEN_SLOTS = int(os.getenv('SHARED_TOKEN_SLOTS', str(1 << 20)))
+SHARED_MAX_CANDIDATES = int(os.getenv('SHARED_MAX_CANDIDATES', '64'))
+# Open addressing degrades sharply when nearly full, so stop admitting before that
+SHARED_MAX_LOAD = float(os.getenv('SHARED_MAX_LOAD', '0.9'))
+# Devices per presence bucket (8 bytes each, one table per bucket in the window)
+SHARED_PRESENCE_SLOTS = int(os.getenv('SHARED_PRESENCE_SLOTS', str(1 << 16)))
+
+MAGIC = b"STIVOTE3"
+# magic, categories, candidates per category, token slots, used slots, generation, timeline minutes
+HEADER = struct.Struct("<8sIIQQQI")
+HEADER_SIZE = 64
+COUNTER = struct.Struct("<q")
+# Bytes of UTF-8 per candidate name: 64 Burmese characters. Longer names are
+# refused, never cut, so two names cannot share a slot
+NAME_SIZE = 192
+CANDIDATE = struct.Struct(f"<{NAME_SIZE}sq")
+SLOT = struct.Struct("<16sQ")
+EMPTY_KEY = bytes(16)
+
+PRESENCE_MAGIC = b"STIPRES1"
+# magic, bucket seconds, buckets kept, slots per bucket
+PRESENCE_HEADER = struct.Struct("<8sIIQ")
+# bucket number, devices last seen in it, used slots
+PRESENCE_ROW = struct.Struct("<qqq")
+PRESENCE_SLOT = struct.Struct("<Q")
+# Set on a slot whose device has been seen again in a later bucket
+MOVED = 1 << 63
+
+
+def segment_size(category_count, max_candidates, slots, minutes=TIMELINE_MINUTES):
+    return (HEADER_SIZE
+            + COUNTER.size * category_count
+            + (COUNTER.size + CANDIDATE.size * max_candidates) * category_count
+            + SLOT.size * slots
+            + MinuteRing.size(category_count, minutes))
+
+
+def attach_segment(name, size):
+    """Create the named segment, or attach to it if another worker already has; returns (shm, created)"""
+    try:
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        created = True
+    except FileExistsError:
+        shm = shared_memory.SharedMemory(name=name)
+        created = False
+    # Outlive whichever worker created it; `python -m app.shared_engine --unlink` removes it
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm, created
+
+
+@contextmanager
+def file_locked(thread_lock, lock_file):
+    # A thread lock for this process, then an flock for the others
+    with thread_lock:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _key(kind, value):
+    # 128-bit digest of the token (or IP); the all-zero key marks an empty slot
+    digest = hashlib.blake2b(f"{kind}\0{value}".encode(), digest_size=16).digest()
+    return digest if digest != EMPTY_KEY else b"\x01" + digest[1:]
+
+
+class SharedVoteEngine:
+    """MemoryVoteEngine counterpart kept in one shared-memory segment, so every
+    worker process on the host sees the same tallies and duplicate set.
+
+    Layout (fixed at creation): a header, one ballot counter per category, a
+    fixed table of (name, votes) candidate slots per category, an
+    open-addressing hash table of (token digest, category bitmask) slots that
+    holds both tokens and IPs, then the MinuteRing of per-minute counts. Writers take a thread lock and an flock on a
+    lock file, so one ballot's checks and writes are atomic across threads and
+    processes. Reads are lock-free and may see a ballot half-applied.
+    """
+
+    def __init__(self, categories=None, name=SHARED_MEMORY_NAME, slots=SHARED_TOKEN_SLOTS,
+                 max_candidates=SHARED_MAX_CANDIDATES, lock_path=None, minutes=TIMELINE_MINUTES):
+        self.categories = list(categories or registry.names())
+        self.category_ids = {category: index for index, category in enumerate(self.categories)}
+        self.name = name
+        self.slots = slots
+        self.max_candidates = max_candidates
+        self.minutes = minutes
+        self.lock_path = lock_path or os.path.join(tempfile.gettempdir(), f"{name}.lock")
+
+        self._thread_lock = threading.Lock()
+        self._lock_file = open(self.lock_path, "a+b")
+        with self._locked():
+            self.shm = self._attach(segment_size(len(self.categories), max_candidates, slots, minutes))
+        self.buf = self.shm.buf
+
+        self._ballots_offset = HEADER_SIZE
+        self._candidates_offset = self._ballots_offset + COUNTER.size * len(self.categories)
+        self._category_stride = COUNTER.size + CANDIDATE.size * max_candidates
+        self._slots_offset = self._candidates_offset + self._category_stride * len(self.categories)
+        self.timeline = MinuteRing(self.buf, len(self.categories), minutes, self._slots_offset + SLOT.size * slots)
+
+    def _attach(self, size):
+        # The first worker creates and formats the segment; the rest attach to it
+        shm, created = attach_segment(self.name, size)
+        if created:
+            HEADER.pack_into(shm.buf, 0, MAGIC, len(self.categories), self.max_candidates, self.slots, 0, 0, self.minutes)
+        else:
+            magic, categories, candidates, slots, _, _, minutes = HEADER.unpack_from(shm.buf, 0)
+            if (magic, categories, candidates, slots, minutes) != (MAGIC, len(self.categories), self.max_candidates, self.slots, self.minutes):
+                shm.close()
+                raise RuntimeError(f"Shared memory segment '{self.name}' has a different layout; unlink it first")
+        return shm
+
+    def _locked(self):
+        return file_locked(self._thread_lock, self._lock_file)
+
+    def _header(self):
+        return HEADER.unpack_from(self.buf, 0)
+
+    def _set_used(self, used):
+        magic, categories, candidates, slots, _, generation, minutes = self._header()
+        HEADER.pack_into(self.buf, 0, magic, categories, candidates, slots, used, generation, minutes)
+
+    def _find(self, key):
+        # Offset of the key's slot, or of the empty slot where it would go
+        index = int.from_bytes(key[:8], "little") % self.slots
+        for _ in range(self.slots):
+            offset = self._slots_offset + index * SLOT.size
+            slot_key, _ = SLOT.unpack_from(self.buf, offset)
+            if slot_key == key or slot_key == EMPTY_KEY:
+                return offset, slot_key
+            index = (index + 1) % self.slots
+        return None, None
+
+    def _mask(self, key):
+        offset, slot_key = self._find(key)
+        if offset is None or slot_key == EMPTY_KEY:
+            return 0
+        return SLOT.unpack_from(self.buf, offset)[1]
+
+    def _set_bit(self, key, bit):
+        offset, slot_key = self._find(key)
+        if slot_key == EMPTY_KEY:
+            self._set_used(self._header()[4] + 1)
+            SLOT.pack_into(self.buf, offset, key, bit)
+        else:
+            SLOT.pack_into(self.buf, offset, key, SLOT.unpack_from(self.buf, offset)[1] | bit)
+
+    def _candidate_slot(self, category_id, name):
+        # Offset of the candidate's (name, votes) slot, adding it if there is room
+        base = self._candidates_offset + self._category_stride * category_id
+        count = COUNTER.unpack_from(self.buf, base)[0]
+        for index in range(count):
+            offset = base + COUNTER.size + CANDIDATE.size * index
+            if CANDIDATE.unpack_from(self.buf, offset)[0].rstrip(b"\0") == name:
+                return offset
+        if count >= self.max_candidates:
+            return None
+        offset = base + COUNTER.size + CANDIDATE.size * count
+        CANDIDATE.pack_into(self.buf, offset, name, 0)
+        COUNTER.pack_into(self.buf, base, count + 1)
+        return offset
+
+    def _increment(self, offset, counter=COUNTER, field=0):
+        values = list(counter.unpack_from(self.buf, offset))
+        values[field] += 1
+        counter.pack_into(self.buf, offset, *values)
+
+    def admit(self, tokens, category, candidate_name=None, client_ip=None, check_ip=True):
+        """Check and record a ballot atomically across processes; returns the rejecting rule or None"""
+        category_id = self.category_ids.get(category)
+        if category_id is None:
+            return "invalid_category"
+        bit = 1 << category_id
+        name = candidate_name.encode() if candidate_name else None
+        if name is not None and len(name) > NAME_SIZE:
+            return "invalid_candidate"
+        token_keys = {rule: _key("token", token) for rule, token in tokens.items()}
+        ip_key = _key("ip", client_ip) if client_ip else None
+
+        with self._locked():
+            for rule, key in token_keys.items():
+                if self._mask(key) & bit:
+                    return rule
+            if check_ip and ip_key and self._mask(ip_key) & bit:
+                return "ip"
+
+            new_keys = len(token_keys) + (1 if ip_key else 0)
+            if self._header()[4] + new_keys > self.slots * SHARED_MAX_LOAD:
+                storage_error("Shared memory", f"token table '{self.name}' is full")
+                return "error"
+            candidate_offset = None
+            if name:
+                candidate_offset = self._candidate_slot(category_id, name)
+                if candidate_offset is None:
+                    storage_error("Shared memory", f"no candidate slots left in {category}")
+                    return "error"
+
+            for key in token_keys.values():
+                self._set_bit(key, bit)
+            if ip_key:
+                self._set_bit(ip_key, bit)
+            self._increment(self._ballots_offset + COUNTER.size * category_id)
+            if candidate_offset is not None:
+                self._increment(candidate_offset, CANDIDATE, 1)
+            self.timeline.add(category_id)
+        return None
+
+    def has_token(self, token):
+        return self._mask(_key("token", token)) != 0
+
+    def has_voted(self, token, category):
+        category_id = self.category_ids.get(category)
+        return category_id is not None and bool(self._mask(_key("token", token)) & (1 << category_id))
+
+    def has_ip_voted(self, client_ip, category):
+        category_id = self.category_ids.get(category)
+        return category_id is not None and bool(self._mask(_key("ip", client_ip)) & (1 << category_id))
+
+    def totals(self):
+        return {category: COUNTER.unpack_from(self.buf, self._ballots_offset + COUNTER.size * index)[0]
+                for index, category in enumerate(self.categories)}
+
+    def timeline_rows(self, first, last):
+        """(minute, category, ballots) rows for build_timeline"""
+        return [(minute, self.categories[category_id], ballots)
+                for minute, category_id, ballots in self.timeline.rows(first, last)]
+
+    def candidate_rows(self):
+        """(category, candidate_name, votes) rows for build_results"""
+        rows = []
+        for category_id, category in enumerate(self.categories):
+            base = self._candidates_offset + self._category_stride * category_id
+            for index in range(COUNTER.unpack_from(self.buf, base)[0]):
+                name, votes = CANDIDATE.unpack_from(self.buf, base + COUNTER.size + CANDIDATE.size * index)
+                rows.append((category, name.rstrip(b"\0").decode(), votes))
+        return rows
+
+    def reset(self):
+        with self._locked():
+            magic, categories, candidates, slots, _, generation, minutes = self._header()
+            self.buf[HEADER_SIZE:] = bytes(len(self.buf) - HEADER_SIZE)
+            HEADER.pack_into(self.buf, 0, magic, categories, candidates, slots, 0, generation + 1, minutes)
+
+    def stats(self):
+        used, generation = self._header()[4:6]
+        return {
+            "segment": self.name,
+            "segment_bytes": self.shm.size,
+            "token_slots": self.slots,
+            "used_slots": used,
+            "load_factor": round(used / self.slots, 4),
+            "generation": generation,
+            "candidates": len(self.candidate_rows()),
+        }
+
+    def close(self):
+        self.shm.close()
+        self._lock_file.close()
+
+
+class SharedPresenceTracker:
+    """PresenceTracker counterpart in its own shared-memory segment, so every
+    worker on the host counts the same active devices.
+
+    One row per bucket of the window (plus the current one) holds the bucket
+    number, the devices last seen in it and its slot count. Each row has an
+    insert-only hash table of 64-bit device digests, wiped when the row is
+    taken over by a new bucket, so probes never meet deleted slots. A device
+    seen again is marked MOVED in its older bucket's table and counted in the
+    new one, so it is counted once, in the bucket it was last seen in.
+    Touches are O(window / bucket) and take a separate lock from the ballots;
+    each worker skips devices it already recorded in the current bucket.
+    """
+
+    def __init__(self, name=f"{SHARED_MEMORY_NAME}_presence", window=PRESENCE_WINDOW,
+                 bucket_seconds=PRESENCE_BUCKET_SECONDS, slots=SHARED_PRESENCE_SLOTS, lock_path=None):
+        self.name = name
+        self.bucket_seconds = bucket_seconds
+        self.bucket_count = max(1, window // bucket_seconds)
+        # One spare row so the bucket leaving the window is not overwritten mid-count
+        self.rows = self.bucket_count + 1
+        self.slots = slots
+        self.lock_path = lock_path or os.path.join(tempfile.gettempdir(), f"{name}.lock")
+        self.dropped = 0
+        self._seen_bucket = None
+        self._seen = set()
+
+        self._thread_lock = threading.Lock()
+        self._lock_file = open(self.lock_path, "a+b")
+        self._table_size = PRESENCE_SLOT.size * slots
+        size = HEADER_SIZE + (PRESENCE_ROW.size + self._table_size) * self.rows
+        with self._locked():
+            self.shm, created = attach_segment(name, size)
+            layout = (PRESENCE_MAGIC, bucket_seconds, self.rows, slots)
+            if created:
+                PRESENCE_HEADER.pack_into(self.shm.buf, 0, *layout)
+            elif PRESENCE_HEADER.unpack_from(self.shm.buf, 0) != layout:
+                self.shm.close()
+                raise RuntimeError(f"Shared memory segment '{name}' has a different layout; unlink it first")
+        self.buf = self.shm.buf
+        self._tables_offset = HEADER_SIZE + PRESENCE_ROW.size * self.rows
+
+    def _locked(self):
+        return file_locked(self._thread_lock, self._lock_file)
+
+    def cutoff(self, bucket=None):
+        """Oldest bucket still inside the window"""
+        if bucket is None:
+            bucket = current_bucket(self.bucket_seconds)
+        return bucket - self.bucket_count + 1
+
+    def _row_offset(self, bucket):
+        return HEADER_SIZE + PRESENCE_ROW.size * (bucket % self.rows)
+
+    def _find(self, bucket, key):
+        # Offset of the key's slot in the bucket's table, or of the empty slot where it would go
+        table = self._tables_offset + self._table_size * (bucket % self.rows)
+        index = key % self.slots
+        for _ in range(self.slots):
+            offset = table + PRESENCE_SLOT.size * index
+            slot = PRESENCE_SLOT.unpack_from(self.buf, offset)[0]
+            if slot == key or slot == 0:
+                return offset, slot
+            index = (index + 1) % self.slots
+        return None, None
+
+    def touch(self, device_token, now=None):
+        """Record activity; returns False if the device was already seen in the current bucket"""
+        bucket = current_bucket(self.bucket_seconds, now)
+        if bucket != self._seen_bucket:
+            self._seen_bucket = bucket
+            self._seen = set()
+        if device_token in self._seen:
+            return False
+        self._seen.add(device_token)
+
+        digest = hashlib.blake2b(device_token.encode(), digest_size=8).digest()
+        # The top bit is the MOVED flag and 0 marks an empty slot
+        key = (int.from_bytes(digest, "little") & (MOVED - 1)) or 1
+        with self._locked():
+            row = self._row_offset(bucket)
+            stamp, users, used = PRESENCE_ROW.unpack_from(self.buf, row)
+            if stamp != bucket:
+                if stamp > bucket:
+                    # The clock stepped back onto a newer bucket
+                    return False
+                table = self._tables_offset + self._table_size * (bucket % self.rows)
+                self.buf[table:table + self._table_size] = bytes(self._table_size)
+                stamp, users, used = bucket, 0, 0
+
+            offset, slot = self._find(bucket, key)
+            if slot == key:
+                PRESENCE_ROW.pack_into(self.buf, row, stamp, users, used)
+                return False
+            if offset is None or used + 1 > self.slots * SHARED_MAX_LOAD:
+                self.dropped += 1
+                PRESENCE_ROW.pack_into(self.buf, row, stamp, users, used)
+                return False
+            PRESENCE_SLOT.pack_into(self.buf, offset, key)
+            PRESENCE_ROW.pack_into(self.buf, row, stamp, users + 1, used + 1)
+
+            # A device lives in one bucket only: take it out of the one it was last seen in
+            for earlier in range(bucket - 1, self.cutoff(bucket) - 1, -1):
+                earlier_row = self._row_offset(earlier)
+                earlier_stamp, earlier_users, earlier_used = PRESENCE_ROW.unpack_from(self.buf, earlier_row)
+                if earlier_stamp != earlier:
+                    continue
+                offset, slot = self._find(earlier, key)
+                if slot == key:
+                    PRESENCE_SLOT.pack_into(self.buf, offset, key | MOVED)
+                    PRESENCE_ROW.pack_into(self.buf, earlier_row, earlier_stamp, earlier_users - 1, earlier_used)
+                    break
+        return True
+
+    def count(self, now=None):
+        bucket = current_bucket(self.bucket_seconds, now)
+        total = 0
+        for counted in range(self.cutoff(bucket), bucket + 1):
+            stamp, users, _ = PRESENCE_ROW.unpack_from(self.buf, self._row_offset(counted))
+            if stamp == counted:
+                total += users
+        return total
+
+    def clear(self):
+        with self._locked():
+            self.buf[HEADER_SIZE:] = bytes(len(self.buf) - HEADER_SIZE)
+        self._seen = set()
+
+    def stats(self):
+        return {"presence_slots_per_bucket": self.slots, "presence_dropped": self.dropped}
+
+    def close(self):
+        self.shm.close()
+        self._lock_file.close()
+
+
+def unlink(name=SHARED_MEMORY_NAME):
+    """Remove the segments, e.g. before changing SHARED_TOKEN_SLOTS; every worker must be stopped"""
+    shm = shared_memory.SharedMemory(name=name)
+    shm.close()
+    shm.unlink()
+    try:
+        presence = shared_memory.SharedMemory(name=f"{name}_presence")
+    except FileNotFoundError:
+        return
+    presence.close()
+    presence.unlink()
+
+
+if __name__ == "__main__":
+    import sys
+
+    if "--unlink" in sys.argv:
+        try:
+            unlink()
+            print(f"Removed shared memory segment '{SHARED_MEMORY_NAME}'")
+        except FileNotFoundError:
+            print(f"No shared memory segment '{SHARED_MEMORY_NAME}'")
+    else:
+        engine = SharedVoteEngine()
+        print(engine.stats())
+        engine.close()
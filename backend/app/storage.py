@@ -1,195 +1,98 @@
 import os
-from app.database import (
-    get_vote_counts as get_vote_counts_db,
-    cast_vote_db,
-    has_voted_for_category_db,
-    get_results_db,
-    reset_all_votes_db,
-    update_user_activity_db,
-    get_concurrent_users_db,
-    has_ip_voted_for_category_db,
-    init_database
-)
-
-# Initialize database on startup (safe)
+from app.backends import create_backend
+from app.cache import ReadCache
+
+# Chosen once at startup from STORAGE_BACKEND (defaults to postgres when
+# DATABASE_URL is set, in-memory otherwise)
+backend = create_backend()
+
+# Initialize storage on startup (safe)
 try:
-    init_database()
+    backend.init()
 except Exception as e:
-    print(f"Database initialization failed, using in-memory storage: {e}")
-
-# Fallback in-memory storage for local development
-vote_counts = {
-    "King": 0,
-    "Queen": 0,
-    "Prince": 0,
-    "Princess": 0,
-    "Best Costume Male": 0,
-    "Best Costume Female": 0,
-    "Best Performance Award": 0
-}
-
-candidate_votes = {
-    "King": {},
-    "Queen": {},
-    "Prince": {},
-    "Princess": {},
-    "Best Costume Male": {},
-    "Best Costume Female": {},
-    "Best Performance Award": {}
-}
-
-votes = {}
-ip_votes = {}
-active_users = set()
-last_seen = {}
+    print(f"Storage initialization failed ({backend.name}): {e}")
 
+# Micro-cache in front of the polled reads; writes below invalidate it
+read_cache = ReadCache(float(os.getenv('READ_CACHE_TTL', '0.25')))
+
+@read_cache.cached("counts")
 def get_counts():
-    # Use database if available, otherwise fallback to in-memory
-    if os.getenv('DATABASE_URL'):
-        return get_vote_counts_db()
-    
-    total = sum(vote_counts.values())
-    return {
-        "King": vote_counts["King"],
-        "Queen": vote_counts["Queen"],
-        "Prince": vote_counts["Prince"],
-        "Princess": vote_counts["Princess"],
-        "Best Costume Male": vote_counts["Best Costume Male"],
-        "Best Costume Female": vote_counts["Best Costume Female"],
-        "Best Performance Award": vote_counts["Best Performance Award"],
-        "total": total
-    }
+    return backend.get_counts()
+
+def get_timeline(first: int, last: int):
+    # Range-keyed, so not cached; each backend reads it in one small lookup
+    return backend.get_timeline(first, last)
 
 def cast_vote(device_token: str, category: str, candidate_name: str = None, client_ip: str = None):
-    # Use database if available
-    if os.getenv('DATABASE_URL'):
-        return cast_vote_db(device_token, category, candidate_name, client_ip)
-    
-    # Fallback to in-memory
-    if category not in vote_counts:
-        return False
-    
-    if device_token not in votes:
-        votes[device_token] = set()
-    
-    if category in votes[device_token]:
-        return False
-    
-    votes[device_token].add(category)
-    vote_counts[category] += 1
-    
-    if client_ip:
-        if client_ip not in ip_votes:
-            ip_votes[client_ip] = set()
-        ip_votes[client_ip].add(category)
-    
-    if candidate_name:
-        if candidate_name not in candidate_votes[category]:
-            candidate_votes[category][candidate_name] = 0
-        candidate_votes[category][candidate_name] += 1
-    
-    return True
+    if backend.cast_vote(device_token, category, candidate_name, client_ip):
+        read_cache.invalidate()
+        return True
+    return False
+
+def admit_ballot(tokens: dict, category: str, candidate_name: str = None, client_ip: str = None):
+    # Atomic per ballot, one count per ballot
+    rejected_by = backend.admit_ballot(tokens, category, candidate_name, client_ip)
+    if rejected_by is None:
+        read_cache.invalidate()
+    return rejected_by
+
+def admit_ballots(ballots: list):
+    # Group commit of (tokens, category, candidate_name, client_ip) ballots,
+    # decided in order exactly as if admitted one at a time
+    rejections = backend.admit_ballots(ballots)
+    if None in rejections:
+        read_cache.invalidate()
+    return rejections
 
 def has_voted(device_token: str):
-    return device_token in votes
+    return backend.has_voted(device_token)
 
 def has_voted_for_category(device_token: str, category: str):
-    # Use database if available
-    if os.getenv('DATABASE_URL'):
-        return has_voted_for_category_db(device_token, category)
-    
-    # Fallback to in-memory
-    return device_token in votes and category in votes[device_token]
+    return backend.has_voted_for_category(device_token, category)
 
 def reset_all_votes():
-    # Use database if available
-    if os.getenv('DATABASE_URL'):
-        reset_all_votes_db()
-        return
-    
-    # Fallback to in-memory
-    global vote_counts, candidate_votes, votes, ip_votes
-    for category in vote_counts:
-        vote_counts[category] = 0
-    for category in candidate_votes:
-        candidate_votes[category] = {}
-    votes = {}
-    ip_votes = {}
+    backend.reset_all_votes()
+    read_cache.invalidate()
 
 def has_ip_voted_for_category(client_ip: str, category: str):
-    # Use database if available
-    if os.getenv('DATABASE_URL'):
-        return has_ip_voted_for_category_db(client_ip, category)
-    
-    # Fallback to in-memory
-    return client_ip in ip_votes and category in ip_votes[client_ip]
+    return backend.has_ip_voted_for_category(client_ip, category)
 
 def update_user_activity(device_token: str):
-    # Use database if available
-    if os.getenv('DATABASE_URL'):
-        update_user_activity_db(device_token)
-        return
-    
-    # Fallback to in-memory
-    import time
-    active_users.add(device_token)
-    last_seen[device_token] = time.time()
-    
-    current_time = time.time()
-    inactive_users = [token for token, last_time in last_seen.items() 
-                     if current_time - last_time > 30]
-    for token in inactive_users:
-        active_users.discard(token)
-        del last_seen[token]
+    backend.update_user_activity(device_token)
 
+@read_cache.cached("concurrent_users")
 def get_concurrent_users():
-    # Use database if available
-    if os.getenv('DATABASE_URL'):
-        return get_concurrent_users_db()
-    
-    # Fallback to in-memory
-    import time
-    current_time = time.time()
-    inactive_users = [token for token, last_time in last_seen.items() 
-                     if current_time - last_time > 30]
-    for token in inactive_users:
-        active_users.discard(token)
-        del last_seen[token]
-    return len(active_users)
+    return backend.get_concurrent_users()
 
+@read_cache.cached("results")
 def get_results():
-    # Use database if available
-    if os.getenv('DATABASE_URL'):
-        return get_results_db()
-    
-    # Fallback to in-memory
-    results = {}
-    for category in vote_counts:
-        if candidate_votes[category]:
-            max_votes = max(candidate_votes[category].values())
-            tied_candidates = [name for name, votes in candidate_votes[category].items() if votes == max_votes]
-            
-            if len(tied_candidates) == 1:
-                leading_text = tied_candidates[0]
-            else:
-                leading_text = f"Tie: {', '.join(tied_candidates)}"
-            
-            percentage = (max_votes / vote_counts[category] * 100) if vote_counts[category] > 0 else 0
-            
-            results[category] = {
-                "leading_candidate": leading_text,
-                "votes": max_votes,
-                "total_votes": vote_counts[category],
-                "percentage": round(percentage, 1),
-                "all_candidates": dict(candidate_votes[category])
-            }
-        else:
-            results[category] = {
-                "leading_candidate": "No votes yet",
-                "votes": 0,
-                "total_votes": vote_counts[category],
-                "percentage": 0,
-                "all_candidates": {}
-            }
-    
-    return results
\ No newline at end of file
+    return backend.get_results()
+
+def iter_ballots(category: str = None, since=None, until=None, fetch_size: int = 5000, election: int = None):
+    # Uncached and unbatched: a blocking iterator for the audit export
+    return backend.iter_ballots(category, since, until, fetch_size, election)
+
+def get_categories():
+    return backend.get_categories()
+
+def get_pool_stats():
+    return backend.get_pool_stats()
+
+def get_replica_stats():
+    return backend.get_replica_stats()
+
+def get_filter_stats():
+    return backend.get_filter_stats()
+
+def get_journal_stats():
+    return backend.get_journal_stats()
+
+def get_registry_stats():
+    return backend.get_registry_stats()
+
+def close():
+    # Flushes anything the backend buffers (the memory store's vote journal)
+    backend.close()
+
+def get_cache_stats():
+    return read_cache.stats()
@@ -0,0 +1,127 @@
+"""Per-minute ballot counts for GET /api/v1/timeline.
+
+Every accepted ballot adds one to the counter of its category and minute,
+so reading a range never touches the ballots themselves. Postgres and
+SQLite keep the counters in a `vote_rates` table written in the ballot's
+transaction; the memory and shared backends keep the last TIMELINE_MINUTES
+minutes in a MinuteRing.
+"""
+import os
+import struct
+import time
+from datetime import datetime, timedelta
+
+from app.registry import registry
+
+# Minutes kept by the in-memory ring, and the longest range one request may ask for
+TIMELINE_MINUTES = int(os.getenv('TIMELINE_MINUTES', '1440'))
+TIMELINE_DEFAULT_MINUTES = int(os.getenv('TIMELINE_DEFAULT_MINUTES', '60'))
+
+UNIX_EPOCH = datetime(1970, 1, 1)
+COUNTER = struct.Struct("<q")
+
+
+def current_minute(now=None):
+    # Wall-clock minute number, the same in every worker and in the database
+    return int((time.time() if now is None else now) // 60)
+
+
+def minute_start(minute):
+    """Naive UTC datetime at the start of a minute number"""
+    return UNIX_EPOCH + timedelta(minutes=minute)
+
+
+def minute_of(moment):
+    """Minute number of a naive UTC datetime"""
+    return int((moment - UNIX_EPOCH).total_seconds() // 60)
+
+
+def timeline_range(minutes=None, since=None, until=None, now=None):
+    """First and last minute numbers (inclusive) of a request.
+
+    `since` and `until` are naive UTC datetimes, rounded down to the minute;
+    `until` is exclusive and defaults to the end of the current minute.
+    Without `since`, the range is the last `minutes` minutes.
+    Raises ValueError for an empty range or one over TIMELINE_MINUTES.
+    """
+    last = minute_of(until) - 1 if until else current_minute(now)
+    if since:
+        first = minute_of(since)
+    else:
+        first = last - (minutes or TIMELINE_DEFAULT_MINUTES) + 1
+    if last < first:
+        raise ValueError("the range is empty")
+    if last - first + 1 > TIMELINE_MINUTES:
+        raise ValueError(f"at most {TIMELINE_MINUTES} minutes per request")
+    return first, last
+
+
+def build_timeline(rows, first, last, categories=None):
+    """Build the /timeline payload from (minute, category, ballots) rows for minutes first..last"""
+    span = last - first + 1
+    series = {category: [0] * span for category in categories or registry.names()}
+    for minute, category, ballots in rows:
+        counts = series.get(category)
+        if counts is not None and first <= minute <= last:
+            counts[minute - first] += ballots
+    return {
+        "interval_seconds": 60,
+        "since": minute_start(first).isoformat() + "Z",
+        "until": minute_start(last + 1).isoformat() + "Z",
+        "minutes": [minute_start(minute).isoformat() + "Z" for minute in range(first, last + 1)],
+        "categories": series,
+        "total": [sum(column) for column in zip(*series.values())] if series else [0] * span
+    }
+
+
+class MinuteRing:
+    """Ballot counts per category for the last `minutes` minutes in a fixed buffer.
+
+    Row `minute % minutes` holds the minute number it belongs to, then one
+    int64 counter per category. The first ballot of a new minute zeroes the
+    row it takes over, so recording is O(1) and the buffer never grows.
+    Callers serialize writes; the buffer can be a slice of shared memory.
+    """
+
+    def __init__(self, buffer, category_count, minutes=TIMELINE_MINUTES, offset=0):
+        self.buffer = buffer
+        self.offset = offset
+        self.minutes = minutes
+        self.row = struct.Struct(f"<{category_count + 1}q")
+
+    @staticmethod
+    def size(category_count, minutes=TIMELINE_MINUTES):
+        """Bytes of buffer needed"""
+        return COUNTER.size * (category_count + 1) * minutes
+
+    @classmethod
+    def allocate(cls, category_count, minutes=TIMELINE_MINUTES):
+        return cls(bytearray(cls.size(category_count, minutes)), category_count, minutes)
+
+    def _row_offset(self, minute):
+        return self.offset + (minute % self.minutes) * self.row.size
+
+    def add(self, category_id, count=1, minute=None):
+        if minute is None:
+            minute = current_minute()
+        buffer = self.buffer
+        base = self._row_offset(minute)
+        stamp = COUNTER.unpack_from(buffer, base)[0]
+        if stamp != minute:
+            if stamp > minute:
+                # A clock step backwards onto a newer row: drop rather than corrupt it
+                return
+            buffer[base:base + self.row.size] = bytes(self.row.size)
+            COUNTER.pack_into(buffer, base, minute)
+        counter = base + COUNTER.size * (1 + category_id)
+        COUNTER.pack_into(buffer, counter, COUNTER.unpack_from(buffer, counter)[0] + count)
+
+    def rows(self, first, last):
+        """(minute, category_id, ballots) for the non-zero counters of minutes first..last"""
+        rows = []
+        for minute in range(max(first, last - self.minutes + 1), last + 1):
+            stamp, *counts = self.row.unpack_from(self.buffer, self._row_offset(minute))
+            if stamp != minute:
+                continue
+            rows.extend((minute, category_id, ballots) for category_id, ballots in enumerate(counts) if ballots)
+        return rows
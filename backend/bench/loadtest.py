@@ -0,0 +1,284 @@
+"""Election-night load test for the voting API.
+
+Drives the app with synthetic voters (each with its own device token,
+fingerprint, session key, IP and User-Agent) casting a ballot in every
+category, results pollers on the 2 second cadence of ResultsPage, and one
+reset part-way through. Latency percentiles and throughput per endpoint are
+printed and written as JSON so runs can be compared.
+
+Run from backend/:
+
+    python -m bench.loadtest                           # in-process, storage from the environment
+    DATABASE_URL=postgresql://... python -m bench.loadtest
+    python -m bench.loadtest --url http://127.0.0.1:8000 --duration 120 --voters 20000
+
+Without --url the app is imported and called over ASGI, so STORAGE_BACKEND,
+DATABASE_URL, VOTE_INGEST_MODE etc. apply exactly as for the server.
+"""
+import argparse
+import asyncio
+import json
+import math
+import platform
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+CANDIDATES = [f"Candidate {index}" for index in range(1, 9)]
+POLL_ENDPOINTS = ["/api/v1/dashboard", "/api/v1/results"]
+POLL_INTERVAL = 2.0
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{v}.0 Safari/537.36",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_{v} like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148",
+    "Mozilla/5.0 (Linux; Android 14; SM-A{v}) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Mobile Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_{v}) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15",
+]
+# Ballots per bucket when relating /api/v1/results latency to table size
+GROWTH_BUCKET = 1000
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed):
+    values = sorted(latencies)
+    return {
+        "requests": len(values),
+        "throughput_rps": round(len(values) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": percentile(values, 0.50),
+        "p95_ms": percentile(values, 0.95),
+        "p99_ms": percentile(values, 0.99),
+        "max_ms": values[-1] if values else None,
+        "mean_ms": round(sum(values) / len(values), 3) if values else None,
+    }
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+        self.errors = {}
+        self.ballots_accepted = 0
+        # Ballots in storage right now, which drops back to 0 at the reset
+        self.ballots_stored = 0
+        self.ballots_rejected = 0
+        self.results_growth = {}
+
+    def record(self, name, started, status=None, error=None):
+        elapsed_ms = round((time.perf_counter() - started) * 1000, 3)
+        self.latencies.setdefault(name, []).append(elapsed_ms)
+        if error is not None:
+            self.errors.setdefault(name, {})
+            self.errors[name][error] = self.errors[name].get(error, 0) + 1
+        else:
+            counts = self.statuses.setdefault(name, {})
+            counts[str(status)] = counts.get(str(status), 0) + 1
+        return elapsed_ms
+
+
+def synthetic_voter(index):
+    device_token = str(uuid.uuid4())
+    return {
+        "device_token": device_token,
+        "fingerprint": uuid.uuid4().hex,
+        "session_key": uuid.uuid4().hex + uuid.uuid4().hex,
+        "ip": f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}",
+        "user_agent": random.choice(USER_AGENTS).format(v=index % 97 + 3),
+    }
+
+
+async def request(client, recorder, name, method, path, **kwargs):
+    started = time.perf_counter()
+    try:
+        response = await client.request(method, path, **kwargs)
+    except Exception as e:
+        recorder.record(name, started, error=type(e).__name__)
+        return None
+    recorder.record(name, started, status=response.status_code)
+    return response
+
+
+async def run_voter(client, recorder, voter, categories):
+    headers = {"x-forwarded-for": voter["ip"], "user-agent": voter["user_agent"], "accept-language": "en-US"}
+    await request(client, recorder, "POST /api/v1/register-device", "POST", "/api/v1/register-device",
+                  json={"display_name": voter["device_token"][:8]})
+    for category in categories:
+        response = await request(client, recorder, "POST /api/v1/vote", "POST", "/api/v1/vote", headers=headers, json={
+            "device_token": voter["device_token"],
+            "category": category,
+            "candidate_name": random.choice(CANDIDATES),
+            "security": {"fingerprint": voter["fingerprint"], "sessionKey": voter["session_key"]},
+        })
+        if response is not None and response.status_code == 200 and response.json().get("success"):
+            recorder.ballots_accepted += 1
+            recorder.ballots_stored += 1
+        else:
+            recorder.ballots_rejected += 1
+
+
+async def voters(client, recorder, total, concurrency, deadline, categories):
+    next_index = iter(range(total))
+
+    async def worker():
+        for index in next_index:
+            if time.monotonic() >= deadline:
+                return
+            await run_voter(client, recorder, synthetic_voter(index), categories)
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+
+async def poller(client, recorder, deadline, endpoints, interval, index):
+    # Staggered start so pollers do not all fire in the same instant
+    await asyncio.sleep(random.uniform(0, interval))
+    etags = {}
+    # Each results page is its own viewer, with its own admission budget
+    ip = f"172.16.{index >> 8 & 255}.{index & 255}"
+    while time.monotonic() < deadline:
+        for path in endpoints:
+            headers = {"x-forwarded-for": ip}
+            if path in etags:
+                headers["If-None-Match"] = etags[path]
+            started = time.perf_counter()
+            response = await request(client, recorder, f"GET {path}", "GET", path, headers=headers)
+            if response is not None and "etag" in response.headers:
+                etags[path] = response.headers["etag"]
+            if path == "/api/v1/results" and response is not None:
+                bucket = recorder.ballots_stored // GROWTH_BUCKET * GROWTH_BUCKET
+                recorder.results_growth.setdefault(bucket, []).append(round((time.perf_counter() - started) * 1000, 3))
+        await asyncio.sleep(interval)
+
+
+async def reset_later(client, recorder, delay):
+    await asyncio.sleep(delay)
+    await request(client, recorder, "POST /api/v1/reset", "POST", "/api/v1/reset")
+    recorder.ballots_stored = 0
+
+
+async def run(args):
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout,
+                                   limits=httpx.Limits(max_connections=args.concurrency + args.pollers + 4))
+        lifespan = None
+    else:
+        from app.main import app
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app, client=("10.255.255.254", 50000)),
+                                   base_url="http://loadtest", timeout=args.timeout)
+        lifespan = app.router.lifespan_context(app)
+        await lifespan.__aenter__()
+
+    recorder = Recorder()
+    try:
+        backend = (await client.get("/api/v1/pool-stats")).json().get("backend")
+        categories = (await client.get("/api/v1/categories")).json()["categories"]
+        await client.post("/api/v1/reset")
+
+        started = time.monotonic()
+        deadline = started + args.duration
+        tasks = [voters(client, recorder, args.voters, args.concurrency, deadline, categories)]
+        tasks += [poller(client, recorder, deadline, args.endpoints, args.poll_interval, index) for index in range(args.pollers)]
+        if args.reset_at is not None:
+            tasks.append(reset_later(client, recorder, args.reset_at))
+        await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - started
+    finally:
+        await client.aclose()
+        if lifespan is not None:
+            await lifespan.__aexit__(None, None, None)
+
+    return {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "target": args.url or "asgi",
+        "backend": backend,
+        "python": platform.python_version(),
+        "config": {
+            "voters": args.voters,
+            "concurrency": args.concurrency,
+            "pollers": args.pollers,
+            "poll_interval": args.poll_interval,
+            "duration": args.duration,
+            "reset_at": args.reset_at,
+            "endpoints": args.endpoints,
+        },
+        "elapsed_s": round(elapsed, 3),
+        "ballots_accepted": recorder.ballots_accepted,
+        "ballots_rejected": recorder.ballots_rejected,
+        "ballots_per_s": round(recorder.ballots_accepted / elapsed, 2) if elapsed else 0.0,
+        "endpoints": {
+            name: dict(summarize(latencies, elapsed),
+                       statuses=recorder.statuses.get(name, {}),
+                       errors=recorder.errors.get(name, {}))
+            for name, latencies in sorted(recorder.latencies.items())
+        },
+        "results_latency_by_ballots": [
+            dict(summarize(latencies, 0), ballots_from=bucket)
+            for bucket, latencies in sorted(recorder.results_growth.items())
+        ],
+    }
+
+
+def print_report(report):
+    print(f"{report['target']} ({report['backend']}): {report['ballots_accepted']} ballots in "
+          f"{report['elapsed_s']}s = {report['ballots_per_s']} ballots/s, {report['ballots_rejected']} rejected")
+    print(f"{'endpoint':<32}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}  errors")
+    for name, stats in report["endpoints"].items():
+        print(f"{name:<32}{stats['requests']:>10}{stats['throughput_rps']:>10}{stats['p50_ms']:>10}"
+              f"{stats['p95_ms']:>10}{stats['p99_ms']:>10}  {sum(stats['errors'].values())}")
+    if report["results_latency_by_ballots"]:
+        print("/api/v1/results p95 by ballots recorded: " + ", ".join(
+            f"{row['ballots_from']}+: {row['p95_ms']} ms" for row in report["results_latency_by_ballots"]))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", help="base URL of a running server; default calls the app in-process over ASGI")
+    parser.add_argument("--voters", type=int, default=2000, help="synthetic voters, each voting in every category")
+    parser.add_argument("--concurrency", type=int, default=50, help="voters in flight at once")
+    parser.add_argument("--pollers", type=int, default=100, help="simulated results pages")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL)
+    parser.add_argument("--endpoints", nargs="+", default=POLL_ENDPOINTS, help="paths each poller reads")
+    parser.add_argument("--duration", type=float, default=30, help="seconds before voters and pollers stop")
+    parser.add_argument("--reset-at", type=float, default=None,
+                        help="seconds into the run to POST /api/v1/reset (default: half the duration)")
+    parser.add_argument("--no-reset", action="store_true")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", default="bench_results.json", help="JSON report path ('-' for stdout only)")
+    args = parser.parse_args(argv)
+    if args.no_reset:
+        args.reset_at = None
+    elif args.reset_at is None:
+        args.reset_at = args.duration / 2
+    return args
+
+
+def main(argv=None):
+    if httpx is None:
+        sys.exit("The load test needs httpx: pip install httpx")
+    args = parse_args(argv)
+    if args.seed is not None:
+        random.seed(args.seed)
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.output != "-":
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
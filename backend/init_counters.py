@@ -4,15 +4,15 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+from app.registry import VOTING_CATEGORIES
+
 dynamodb = boto3.client('dynamodb',
     aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
     aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
     region_name=os.getenv('AWS_REGION', 'us-east-1')
 )
 
-categories = ["King", "Queen", "option_a", "option_b"]
-
-for category in categories:
+for category in VOTING_CATEGORIES:
     try:
         dynamodb.put_item(
             TableName='VoteCounts',
@@ -0,0 +1,88 @@
+"""Fixtures shared by the backend tests.
+
+The Postgres tests need TEST_DATABASE_URL, a server where the user may
+create databases; each test gets a fresh one, dropped afterwards. Without
+it they are skipped. The memory, shared and sqlite stores run in process.
+"""
+import os
+import uuid
+from functools import partial
+
+import psycopg2
+import pytest
+
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+
+
+@pytest.fixture
+def pg_url():
+    """DSN of an empty database"""
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    name = f"voting_test_{uuid.uuid4().hex[:12]}"
+    admin = psycopg2.connect(TEST_DATABASE_URL)
+    admin.autocommit = True
+    try:
+        with admin.cursor() as cur:
+            cur.execute(f'CREATE DATABASE "{name}"')
+        yield psycopg2.extensions.make_dsn(TEST_DATABASE_URL, dbname=name)
+        with admin.cursor() as cur:
+            cur.execute(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)')
+    finally:
+        admin.close()
+
+
+@pytest.fixture
+def pg_conn(pg_url):
+    """Autocommit connection to the test database, for setup and checks"""
+    from psycopg2.extras import RealDictCursor
+    conn = psycopg2.connect(pg_url, cursor_factory=RealDictCursor)
+    conn.autocommit = True
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def database(pg_url, monkeypatch):
+    """app.database pointed at the test database, before init_database()"""
+    from app import database
+    monkeypatch.setattr(database, "DATABASE_URL", pg_url)
+    monkeypatch.setattr(database, "_pool", None)
+    if database.duplicate_filter is not None:
+        database.duplicate_filter.clear()
+    database.presence_seen.clear()
+    yield database
+    if database._pool is not None:
+        database._pool.closeall()
+
+
+@pytest.fixture
+def db(database):
+    """app.database on a migrated test database"""
+    database.init_database()
+    return database
+
+
+@pytest.fixture(params=["memory", "shared", "sqlite"])
+def backend(request, tmp_path, monkeypatch):
+    """Each in-process store, initialized and empty"""
+    if request.param == "memory":
+        from app.backends.memory import MemoryBackend
+        store = MemoryBackend()
+    elif request.param == "shared":
+        from app.backends import shared
+        from app.shared_engine import SharedPresenceTracker, SharedVoteEngine, unlink
+        name = f"voting_test_{uuid.uuid4().hex[:12]}"
+        monkeypatch.setattr(shared, "SharedVoteEngine",
+                            partial(SharedVoteEngine, name=name, slots=1 << 12, lock_path=str(tmp_path / "votes.lock")))
+        monkeypatch.setattr(shared, "SharedPresenceTracker",
+                            partial(SharedPresenceTracker, name=f"{name}_presence", lock_path=str(tmp_path / "presence.lock")))
+        store = shared.SharedMemoryBackend()
+        request.addfinalizer(partial(unlink, name))
+    else:
+        from app.backends.sqlite import SQLiteBackend
+        store = SQLiteBackend(path=str(tmp_path / "votes.db"))
+    store.init()
+    yield store
+    store.close()
+
@@ -0,0 +1,49 @@
+def ballot(device, category="King", candidate_name="Aung", client_ip=None, **tokens):
+    """(tokens, category, candidate_name, client_ip) as main.vote() builds it"""
+    return dict(tokens, device=f"device:{device}"), category, candidate_name, client_ip
+
+
+def test_batch_rejects_a_token_repeated_within_the_batch(db):
+    rejections = db.admit_ballots_db([
+        ballot("a", fingerprint="fingerprint:shared"),
+        ballot("b", fingerprint="fingerprint:shared"),
+        ballot("a"),
+        ballot("a", category="Queen"),
+    ])
+    assert rejections == [None, "fingerprint", "device", None]
+    counts = db.get_vote_counts()
+    assert (counts["King"], counts["Queen"]) == (1, 1)
+
+
+def test_batch_rejects_an_ip_repeated_within_the_batch(db):
+    rejections = db.admit_ballots_db([
+        ballot("a", client_ip="10.0.0.1"),
+        ballot("b", client_ip="10.0.0.1"),
+        ballot("c", client_ip="10.0.0.2"),
+        ballot("d", category="Queen", client_ip="10.0.0.1"),
+    ])
+    assert rejections == [None, "ip", None, None]
+    assert db.get_vote_counts()["King"] == 2
+    assert db.has_ip_voted_for_category_db("10.0.0.1", "King")
+
+
+def test_batch_sees_earlier_ballots(db):
+    assert db.admit_ballot_db(*ballot("a", client_ip="10.0.0.1")) is None
+    rejections = db.admit_ballots_db([
+        ballot("a"),
+        ballot("b", client_ip="10.0.0.1"),
+        ballot("c", client_ip="10.0.0.3"),
+        ballot("d", category="Nobody"),
+    ])
+    assert rejections == ["device", "ip", None, "invalid_category"]
+
+
+def test_batch_writes_ballots_tallies_and_rates(db, pg_conn):
+    db.admit_ballots_db([ballot("a"), ballot("b", candidate_name="Min"), ballot("c", candidate_name="Min")])
+
+    assert db.get_results_db()["King"]["all_candidates"] == {"Min": 2, "Aung": 1}
+    with pg_conn.cursor() as cur:
+        cur.execute('SELECT COUNT(*) AS ballots FROM ballots')
+        assert cur.fetchone()['ballots'] == 3
+        cur.execute('SELECT SUM(ballots)::int AS ballots FROM vote_rates')
+        assert cur.fetchone()['ballots'] == 3
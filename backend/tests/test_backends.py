@@ -0,0 +1,64 @@
+"""The same rules on every in-process store: memory, shared and sqlite."""
+
+
+def ballot(device, category="King", candidate_name="Aung", client_ip=None, **tokens):
+    """(tokens, category, candidate_name, client_ip) as main.vote() builds it"""
+    return dict(tokens, device=f"device:{device}"), category, candidate_name, client_ip
+
+
+def test_duplicate_token_and_ip_are_rejected(backend):
+    assert backend.admit_ballot(*ballot("a", fingerprint="fingerprint:1", client_ip="10.0.0.1")) is None
+    assert backend.admit_ballot(*ballot("a")) == "device"
+    assert backend.admit_ballot(*ballot("b", fingerprint="fingerprint:1")) == "fingerprint"
+    assert backend.admit_ballot(*ballot("c", client_ip="10.0.0.1")) == "ip"
+    assert backend.admit_ballot(*ballot("a", category="Queen", client_ip="10.0.0.1")) is None
+    assert backend.admit_ballot(*ballot("d", category="Nobody")) == "invalid_category"
+
+    assert backend.has_voted_for_category("device:a", "King")
+    assert not backend.has_voted_for_category("device:b", "King")
+    assert backend.has_ip_voted_for_category("10.0.0.1", "Queen")
+    counts = backend.get_counts()
+    assert (counts["King"], counts["Queen"], counts["total"]) == (1, 1, 2)
+
+
+def test_batch_rejects_repeats_within_the_batch(backend):
+    rejections = backend.admit_ballots([
+        ballot("a", client_ip="10.0.0.1"),
+        ballot("a"),
+        ballot("b", client_ip="10.0.0.1"),
+        ballot("c", candidate_name="Min"),
+    ])
+    assert rejections == [None, "device", "ip", None]
+    assert backend.get_results()["King"]["all_candidates"] == {"Aung": 1, "Min": 1}
+
+
+def test_results_rank_candidates(backend):
+    for index, candidate_name in enumerate(["Min", "Aung", "Min"]):
+        backend.admit_ballot(*ballot(f"voter{index}", candidate_name=candidate_name))
+
+    king = backend.get_results()["King"]
+    assert king["leading_candidate"] == "Min"
+    assert (king["votes"], king["total_votes"]) == (2, 3)
+
+
+def test_reset_clears_votes_and_duplicate_rules(backend):
+    backend.admit_ballot(*ballot("a", client_ip="10.0.0.1"))
+    backend.reset_all_votes()
+
+    assert backend.get_counts()["total"] == 0
+    assert backend.get_results()["King"]["all_candidates"] == {}
+    assert not backend.has_voted_for_category("device:a", "King")
+    assert backend.admit_ballot(*ballot("a", candidate_name="Min", client_ip="10.0.0.1")) is None
+    assert backend.get_results()["King"]["all_candidates"] == {"Min": 1}
+
+
+def test_timeline_counts_ballots_in_the_current_minute(backend):
+    from app.timeline import current_minute
+
+    before = current_minute()
+    backend.admit_ballot(*ballot("a"))
+    backend.admit_ballots([ballot("b"), ballot("c", category="Queen"), ballot("a")])
+    timeline = backend.get_timeline(before, current_minute())
+
+    assert sum(timeline["categories"]["King"]) == 2
+    assert sum(timeline["categories"]["Queen"]) == 1
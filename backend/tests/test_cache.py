@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from app.cache import AsyncReadCache
+
+
+def test_followers_take_over_from_a_cancelled_leader():
+    async def scenario():
+        cache = AsyncReadCache(0)
+        loads = []
+
+        async def loader():
+            loads.append(1)
+            await asyncio.sleep(0.05)
+            return len(loads)
+
+        leader = asyncio.create_task(cache.get("results", loader))
+        await asyncio.sleep(0.01)
+        followers = [asyncio.create_task(cache.get("results", loader)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        values = await asyncio.gather(*followers)
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return values, len(loads), cache.stats()["in_flight"]
+
+    values, loads, in_flight = asyncio.run(scenario())
+    assert values == [2, 2, 2]
+    assert (loads, in_flight) == (2, 0)
+
+
+def test_loader_errors_reach_every_follower():
+    async def scenario():
+        cache = AsyncReadCache(0)
+
+        async def loader():
+            await asyncio.sleep(0.02)
+            raise ValueError("database down")
+
+        leader = asyncio.create_task(cache.get("results", loader))
+        await asyncio.sleep(0.005)
+        follower = asyncio.create_task(cache.get("results", loader))
+        return await asyncio.gather(leader, follower, return_exceptions=True), cache.stats()["errors"]
+
+    outcomes, errors = asyncio.run(scenario())
+    assert [type(outcome) for outcome in outcomes] == [ValueError, ValueError]
+    assert errors == 1
@@ -0,0 +1,123 @@
+"""Vote journal recovery: replay, a torn last record, and snapshot plus tail."""
+import os
+
+from app.backends import memory
+from app.journal import SNAPSHOT_FILE, VoteJournal
+from app.memory_engine import MemoryVoteEngine
+
+
+def ballot(device, category="King", candidate_name="Aung", client_ip=None, **tokens):
+    """(tokens, category, candidate_name, client_ip) as main.vote() builds it"""
+    return dict(tokens, device=f"device:{device}"), category, candidate_name, client_ip
+
+
+def open_journal(directory):
+    engine = MemoryVoteEngine()
+    journal = VoteJournal(engine, str(directory), fsync_ms=0)
+    journal.open()
+    return engine, journal
+
+
+def record(engine, journal, *ballots):
+    with journal.gate.shared():
+        for tokens, category, candidate_name, client_ip in ballots:
+            assert engine.admit(tokens, category, candidate_name, client_ip) is None
+            journal.record_ballot(tokens, category, candidate_name, client_ip)
+
+
+def reset(engine, journal):
+    with journal.gate.exclusive():
+        journal.record_reset()
+        engine.reset()
+
+
+def test_replay_restores_totals_and_duplicates_after_a_reset(tmp_path):
+    engine, journal = open_journal(tmp_path)
+    record(engine, journal, ballot("old", client_ip="10.0.0.9"))
+    reset(engine, journal)
+    record(engine, journal,
+           ballot("a", fingerprint="fingerprint:1", client_ip="10.0.0.1"),
+           ballot("b", candidate_name="Min"),
+           ballot("a", category="Queen"))
+    journal.close()
+
+    replayed, journal = open_journal(tmp_path)
+    try:
+        assert replayed.totals() == engine.totals()
+        assert replayed.candidate_rows() == engine.candidate_rows()
+        assert replayed.has_voted("device:a", "King") and replayed.has_voted("device:a", "Queen")
+        assert replayed.has_voted("fingerprint:1", "King")
+        assert replayed.has_ip_voted("10.0.0.1", "King")
+        # Wiped by the reset
+        assert not replayed.has_token("device:old")
+        assert not replayed.has_ip_voted("10.0.0.9", "King")
+        assert replayed.admit(*ballot("a")) == "device"
+    finally:
+        journal.close()
+
+
+def test_torn_last_record_is_skipped_and_later_segments_replay(tmp_path):
+    engine, journal = open_journal(tmp_path)
+    record(engine, journal, ballot("a"), ballot("b"))
+    segment = journal._segment_path(journal._seq)
+    journal.close()
+    # A crash halfway through the next record
+    frame = VoteJournal._frame(b"\x01" + b"x" * 40)
+    with open(segment, "ab") as f:
+        f.write(frame[:len(frame) // 2])
+
+    engine, journal = open_journal(tmp_path)
+    assert engine.totals()["King"] == 2
+    record(engine, journal, ballot("c"))
+    journal.close()
+
+    engine, journal = open_journal(tmp_path)
+    try:
+        assert engine.totals()["King"] == 3
+        assert all(engine.has_voted(f"device:{device}", "King") for device in "abc")
+    finally:
+        journal.close()
+
+
+def test_snapshot_plus_tail(tmp_path):
+    engine, journal = open_journal(tmp_path)
+    record(engine, journal, ballot("a"), ballot("b", category="Queen"))
+    journal.snapshot()
+    journal._snapshot_thread.join()
+    first_segment = journal._segment_path(0)
+    record(engine, journal, ballot("c", candidate_name="Min"))
+    journal.close()
+
+    # The snapshot holds the first two ballots and replaced their segment
+    assert os.path.exists(tmp_path / SNAPSHOT_FILE)
+    assert not os.path.exists(first_segment)
+    restored, journal = open_journal(tmp_path)
+    try:
+        assert restored.totals() == engine.totals()
+        assert (restored.totals()["King"], restored.totals()["Queen"]) == (2, 1)
+        assert restored.candidate_rows() == engine.candidate_rows()
+        assert all(restored.has_token(f"device:{device}") for device in "abc")
+    finally:
+        journal.close()
+
+
+def test_backend_journals_in_the_threadpool_and_undoes_unwritten_ballots(tmp_path, monkeypatch):
+    monkeypatch.setattr(memory, "VOTE_JOURNAL_DIR", str(tmp_path))
+    backend = memory.MemoryBackend()
+    assert not backend.blocking
+    backend.init()
+    try:
+        assert backend.blocking
+        assert backend.admit_ballot(*ballot("a")) is None
+
+        fd = backend.journal._fd
+        backend.journal._fd = -1
+        try:
+            assert backend.admit_ballot(*ballot("b")) == "error"
+            assert backend.admit_ballots([ballot("c"), ballot("a")]) == ["error", "device"]
+        finally:
+            backend.journal._fd = fd
+        assert not backend.has_voted("device:b") and not backend.has_voted("device:c")
+        assert backend.get_counts()["total"] == 1
+    finally:
+        backend.close()
@@ -0,0 +1,75 @@
+from app.migrations import MIGRATIONS, TEXT_SCHEMA_SQL
+
+# Two ballots in the original free-text schema: one row per token, the
+# device: row being the ballot itself
+LEGACY_VOTES = [
+    ("device:old1", "King", "Aung", "10.0.0.1"),
+    ("fingerprint:fp1", "King", "Aung", "10.0.0.1"),
+    ("device:old2", "King", "Min", "10.0.0.2"),
+    ("fingerprint:fp2", "King", "Min", "10.0.0.2"),
+    ("device:old1", "Queen", "Su", "10.0.0.1"),
+    ("device:old3", "Legacy Award", None, "10.0.0.3"),
+]
+
+
+def create_baseline(conn):
+    # A database from before migrations were versioned: no schema_migrations
+    with conn.cursor() as cur:
+        for statement in TEXT_SCHEMA_SQL:
+            cur.execute(statement)
+        cur.executemany('INSERT INTO votes (device_token, category, candidate_name, client_ip) VALUES (%s, %s, %s, %s)',
+                        LEGACY_VOTES)
+        cur.executemany('INSERT INTO ip_votes (client_ip, category) VALUES (%s, %s) ON CONFLICT DO NOTHING',
+                        {(client_ip, category) for _, category, _, client_ip in LEGACY_VOTES})
+
+
+def test_migrations_apply_in_order_on_a_baseline_schema(database, pg_conn):
+    create_baseline(pg_conn)
+    database.init_database()
+
+    with pg_conn.cursor() as cur:
+        cur.execute('SELECT version FROM schema_migrations ORDER BY version')
+        assert [row['version'] for row in cur.fetchall()] == [version for version, _, _ in MIGRATIONS]
+        cur.execute("SELECT to_regclass('votes_v1') AS old")
+        assert cur.fetchone()['old'] is None
+        cur.execute('SELECT COUNT(*) AS ballots, COUNT(DISTINCT epoch) AS epochs FROM ballots')
+        assert cur.fetchone() == {"ballots": 4, "epochs": 1}
+        cur.execute('SELECT SUM(ballots)::int AS ballots FROM vote_rates')
+        assert cur.fetchone()['ballots'] == 4
+
+    counts = database.get_vote_counts()
+    assert (counts["King"], counts["Queen"], counts["Legacy Award"], counts["total"]) == (2, 1, 1, 4)
+    results = database.get_results_db()
+    assert results["King"]["all_candidates"] == {"Aung": 1, "Min": 1}
+    assert results["Queen"]["leading_candidate"] == "Su"
+
+
+def test_migrated_votes_still_reject_duplicates(database, pg_conn):
+    create_baseline(pg_conn)
+    database.init_database()
+
+    assert database.admit_ballot_db({"device": "device:old1"}, "King", "Aung") == "device"
+    assert database.admit_ballot_db({"device": "device:new", "fingerprint": "fingerprint:fp2"}, "King", "Aung") == "fingerprint"
+    assert database.admit_ballot_db({"device": "device:new"}, "King", "Aung", "10.0.0.2") == "ip"
+    assert database.admit_ballot_db({"device": "device:new"}, "King", "Aung", "10.0.0.9") is None
+    assert database.get_vote_counts()["King"] == 3
+
+
+def test_migrations_run_once(database, pg_conn):
+    create_baseline(pg_conn)
+    database.init_database()
+    database.init_database()
+
+    with pg_conn.cursor() as cur:
+        cur.execute('SELECT COUNT(*) AS applied FROM schema_migrations')
+        assert cur.fetchone()['applied'] == len(MIGRATIONS)
+        cur.execute('SELECT COUNT(*) AS ballots FROM ballots')
+        assert cur.fetchone()['ballots'] == 4
+    assert database.get_vote_counts()["total"] == 4
+
+
+def test_fresh_database(db):
+    counts = db.get_vote_counts()
+    assert counts["total"] == 0
+    assert db.admit_ballot_db({"device": "device:first"}, "King", "Aung", "10.0.0.1") is None
+    assert db.get_vote_counts()["King"] == 1
@@ -0,0 +1,48 @@
+def ballot(device, category="King", candidate_name="Aung", client_ip=None):
+    return {"device": f"device:{device}"}, category, candidate_name, client_ip
+
+
+def current_epoch(conn):
+    with conn.cursor() as cur:
+        cur.execute('SELECT max(id) AS epoch FROM elections')
+        return cur.fetchone()['epoch']
+
+
+def test_reset_opens_the_next_election(db, pg_conn):
+    db.admit_ballots_db([ballot("a", client_ip="10.0.0.1"), ballot("b", candidate_name="Min")])
+    assert current_epoch(pg_conn) == 1
+
+    db.reset_all_votes_db()
+
+    assert current_epoch(pg_conn) == 2
+    assert db.get_vote_counts()["total"] == 0
+    king = db.get_results_db()["King"]
+    assert (king["leading_candidate"], king["total_votes"], king["all_candidates"]) == ("No votes yet", 0, {})
+    # Nothing was deleted: the first round is still there for audit
+    with pg_conn.cursor() as cur:
+        cur.execute('SELECT epoch, COUNT(*) AS ballots FROM ballots GROUP BY epoch')
+        assert cur.fetchall() == [{"epoch": 1, "ballots": 2}]
+
+
+def test_voters_can_vote_again_after_reset(db):
+    assert db.admit_ballot_db(*ballot("a", client_ip="10.0.0.1")) is None
+    assert db.admit_ballot_db(*ballot("a")) == "device"
+
+    db.reset_all_votes_db()
+
+    assert not db.has_voted_for_category_db("device:a", "King")
+    assert db.admit_ballot_db(*ballot("a", candidate_name="Min", client_ip="10.0.0.1")) is None
+    assert db.admit_ballots_db([ballot("a"), ballot("b", client_ip="10.0.0.1")]) == ["device", "ip"]
+    assert db.get_results_db()["King"]["all_candidates"] == {"Min": 1}
+
+
+def test_earlier_elections_stay_exportable(db):
+    db.admit_ballot_db(*ballot("a"))
+    db.reset_all_votes_db()
+    db.admit_ballot_db(*ballot("b", candidate_name="Min"))
+
+    def exported(election=None):
+        return [(row[0], row[2]) for rows in db.iter_ballots_db(election=election) for row in rows]
+
+    assert exported() == [("b", "Min")]
+    assert exported(1) == [("a", "Aung")]
@@ -0,0 +1,41 @@
+"""File session persistence shared by several workers."""
+import time
+
+from app.sessions import FileSessionPersistence, SessionStore
+
+
+def session(user_id, created_at=None):
+    return {"user_id": user_id, "email": f"{user_id}@example.com", "name": user_id,
+            "created_at": time.time() if created_at is None else created_at}
+
+
+def test_workers_merge_into_one_session_file(tmp_path):
+    path = str(tmp_path / "sessions.json")
+    first = SessionStore(persistence=FileSessionPersistence(path))
+    second = SessionStore(persistence=FileSessionPersistence(path))
+    first.create("token-a", session("a"))
+    first.create("token-b", session("b"))
+    second.create("token-c", session("c"))
+    first.flush()
+    second.flush()
+
+    # The second worker's flush kept the first worker's sessions
+    restarted = SessionStore(persistence=FileSessionPersistence(path))
+    restarted.load()
+    assert all(token in restarted for token in ("token-a", "token-b", "token-c"))
+
+    # A logout in one worker leaves the other worker's sessions alone
+    first.delete("token-b")
+    first.flush()
+    restarted = SessionStore(persistence=FileSessionPersistence(path))
+    restarted.load()
+    assert len(restarted) == 2 and "token-a" in restarted and "token-c" in restarted
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_flush_drops_sessions_expired_in_the_file(tmp_path):
+    path = str(tmp_path / "sessions.json")
+    persistence = FileSessionPersistence(path, ttl=60)
+    persistence.flush({"old": session("old", created_at=time.time() - 120)}, {"old"}, set())
+    persistence.flush({"new": session("new")}, {"new"}, set())
+    assert set(persistence.load()) == {"new"}
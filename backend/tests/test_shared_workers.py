@@ -0,0 +1,52 @@
+"""Several worker processes on one shared-memory segment."""
+import multiprocessing
+import uuid
+
+from app.shared_engine import SharedVoteEngine, unlink
+
+CATEGORIES = ["King", "Queen"]
+VOTERS = 1000
+
+
+def vote_in_worker(name, lock_path, barrier, results, reverse):
+    engine = SharedVoteEngine(categories=CATEGORIES, name=name, slots=1 << 12, lock_path=lock_path)
+    barrier.wait()
+    # Both workers try every voter, from opposite ends, so they meet in the middle
+    voters = range(VOTERS - 1, -1, -1) if reverse else range(VOTERS)
+    accepted = [voter for voter in voters
+                if engine.admit({"device": f"device:{voter}"}, "King", f"Candidate {voter % 3}", None) is None]
+    results.put(accepted)
+    engine.close()
+
+
+def test_workers_share_one_duplicate_set_and_one_tally(tmp_path):
+    name = f"voting_test_{uuid.uuid4().hex[:12]}"
+    lock_path = str(tmp_path / "votes.lock")
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(2)
+    results = context.Queue()
+    workers = [context.Process(target=vote_in_worker, args=(name, lock_path, barrier, results, reverse))
+               for reverse in (False, True)]
+    for worker in workers:
+        worker.start()
+    try:
+        accepted = [results.get(timeout=60) for _ in workers]
+        for worker in workers:
+            worker.join(timeout=60)
+            assert worker.exitcode == 0
+
+        # Every voter got in exactly once, through one worker or the other
+        assert sorted(accepted[0] + accepted[1]) == list(range(VOTERS))
+        assert all(accepted)
+        engine = SharedVoteEngine(categories=CATEGORIES, name=name, slots=1 << 12, lock_path=lock_path)
+        try:
+            assert engine.totals() == {"King": VOTERS, "Queen": 0}
+            assert sum(votes for _, _, votes in engine.candidate_rows()) == VOTERS
+            assert engine.has_voted("device:7", "King")
+        finally:
+            engine.close()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        unlink(name)
@@ -0,0 +1,40 @@
+from datetime import datetime
+
+import pytest
+
+from app.timeline import MinuteRing, build_timeline, minute_of, minute_start, timeline_range
+
+
+def test_minute_numbers_are_utc():
+    moment = datetime(2025, 3, 1, 8, 30, 59)
+    assert minute_start(minute_of(moment)) == datetime(2025, 3, 1, 8, 30)
+
+
+def test_range_bounds():
+    now = 1000 * 60 + 30
+    assert timeline_range(minutes=5, now=now) == (996, 1000)
+    assert timeline_range(since=minute_start(990), until=minute_start(995), now=now) == (990, 994)
+    with pytest.raises(ValueError):
+        timeline_range(since=minute_start(995), until=minute_start(995), now=now)
+    with pytest.raises(ValueError):
+        timeline_range(minutes=100000, now=now)
+
+
+def test_build_timeline_buckets_rows():
+    rows = [(10, "King", 2), (12, "King", 1), (12, "Queen", 4), (9, "King", 7), (13, "King", 7), (11, "Nobody", 1)]
+    timeline = build_timeline(rows, 10, 12, ["King", "Queen"])
+    assert timeline["categories"] == {"King": [2, 0, 1], "Queen": [0, 0, 4]}
+    assert timeline["total"] == [2, 0, 5]
+    assert timeline["minutes"][0] == minute_start(10).isoformat() + "Z"
+    assert timeline["until"] == minute_start(13).isoformat() + "Z"
+
+
+def test_minute_ring_wraps_and_forgets_old_minutes():
+    ring = MinuteRing.allocate(2, minutes=4)
+    ring.add(0, minute=100)
+    ring.add(1, count=3, minute=101)
+    ring.add(0, minute=104)
+    assert ring.rows(100, 104) == [(101, 1, 3), (104, 0, 1)]
+    # A late write for a minute the ring has moved past is dropped
+    ring.add(0, minute=100)
+    assert ring.rows(104, 104) == [(104, 0, 1)]
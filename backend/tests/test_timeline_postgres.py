@@ -0,0 +1,53 @@
+from datetime import datetime
+
+from app.timeline import current_minute, minute_of
+
+
+def add_rates(conn, rows):
+    # (epoch, minute, category, shard, ballots)
+    with conn.cursor() as cur:
+        for epoch, minute, category, shard, ballots in rows:
+            cur.execute('''
+                INSERT INTO vote_rates (epoch, minute, category_id, shard, ballots)
+                SELECT %s, %s, id, %s, %s FROM categories WHERE name = %s
+            ''', (epoch, minute, shard, ballots, category))
+
+
+def test_timeline_sums_shards_per_minute(db, pg_conn):
+    first = minute_of(datetime(2025, 3, 1, 8, 0))
+    add_rates(pg_conn, [
+        (1, datetime(2025, 3, 1, 8, 0), "King", 0, 2),
+        (1, datetime(2025, 3, 1, 8, 0), "King", 5, 3),
+        (1, datetime(2025, 3, 1, 8, 2), "Queen", 1, 1),
+        (1, datetime(2025, 3, 1, 8, 3), "King", 0, 9),
+        (1, datetime(2025, 3, 1, 7, 59), "King", 0, 9),
+    ])
+
+    timeline = db.get_timeline_db(first, first + 2)
+    assert timeline["categories"]["King"] == [5, 0, 0]
+    assert timeline["categories"]["Queen"] == [0, 0, 1]
+    assert timeline["total"] == [5, 0, 1]
+
+
+def test_timeline_reads_the_current_election(db, pg_conn):
+    first = minute_of(datetime(2025, 3, 1, 8, 0))
+    add_rates(pg_conn, [(1, datetime(2025, 3, 1, 8, 0), "King", 0, 4)])
+    db.reset_all_votes_db()
+    add_rates(pg_conn, [(2, datetime(2025, 3, 1, 8, 1), "King", 0, 1)])
+
+    assert db.get_timeline_db(first, first + 1)["categories"]["King"] == [0, 1]
+
+
+def test_ballots_land_in_the_current_utc_minute(database, pg_conn):
+    # A session time zone far from UTC must not move the minute
+    with pg_conn.cursor() as cur:
+        cur.execute(f'ALTER DATABASE "{pg_conn.info.dbname}" SET TimeZone = \'Asia/Yangon\'')
+    database.init_database()
+
+    before = current_minute()
+    database.admit_ballot_db({"device": "device:a"}, "King", "Aung")
+    database.admit_ballots_db([({"device": "device:b"}, "King", "Aung", None), ({"device": "device:c"}, "Queen", None, None)])
+    timeline = database.get_timeline_db(before, current_minute())
+
+    assert sum(timeline["categories"]["King"]) == 2
+    assert sum(timeline["categories"]["Queen"]) == 1
@@ -34,16 +34,16 @@ function ResultsPage({ onSwitchToVoting }: ResultsPageProps) {
   const [isAdmin, setIsAdmin] = useState(false)
 
   useEffect(() => {
+    const apiUrl = import.meta.env.VITE_API_URL || 'https://sti-myanmar-voting-system.onrender.com'
+    let interval: ReturnType<typeof setInterval> | null = null
+
     const fetchData = async () => {
       setIsUpdating(true)
       try {
-        const apiUrl = import.meta.env.VITE_API_URL || 'https://sti-myanmar-voting-system.onrender.com'
-        const [countsResponse, resultsResponse] = await Promise.all([
-          axios.get(`${apiUrl}/api/v1/counts`),
-          axios.get(`${apiUrl}/api/v1/results`)
-        ])
-        setCounts(countsResponse.data)
-        setResults(resultsResponse.data)
+        // One request for counts and results; unchanged polls are answered with 304 via the ETag
+        const response = await axios.get(`${apiUrl}/api/v1/dashboard`)
+        setCounts(response.data.counts)
+        setResults(response.data.results)
         setLastUpdate(new Date())
       } catch (error) {
         console.error('Error fetching data:', error)
@@ -52,10 +52,45 @@ function ResultsPage({ onSwitchToVoting }: ResultsPageProps) {
       }
     }
 
-    fetchData()
-    const interval = setInterval(fetchData, 2000)
+    const startPolling = () => {
+      if (interval) return
+      fetchData()
+      interval = setInterval(fetchData, 2000)
+    }
+
+    if (typeof EventSource === 'undefined') {
+      startPolling()
+      return () => { if (interval) clearInterval(interval) }
+    }
+
+    // The server pushes a full snapshot on connect and only changed categories afterwards
+    const source = new EventSource(`${apiUrl}/api/v1/stream`)
+
+    source.addEventListener('snapshot', (event) => {
+      const data = JSON.parse((event as MessageEvent).data)
+      setCounts(data.counts)
+      setResults(data.results)
+      setLastUpdate(new Date())
+    })
 
-    return () => clearInterval(interval)
+    source.addEventListener('delta', (event) => {
+      const data = JSON.parse((event as MessageEvent).data)
+      if (data.counts) setCounts(prev => ({ ...prev, ...data.counts }))
+      if (data.results) setResults((prev: any) => ({ ...prev, ...data.results }))
+      setLastUpdate(new Date())
+    })
+
+    source.onerror = () => {
+      // Stream refused (e.g. subscriber cap reached) or unsupported by a proxy: fall back to polling
+      if (source.readyState === EventSource.CLOSED) {
+        startPolling()
+      }
+    }
+
+    return () => {
+      source.close()
+      if (interval) clearInterval(interval)
+    }
   }, [])
 
   return (
@@ -12,15 +12,25 @@ function VotingPage({ onSwitchToResults, user, authToken }: VotingPageProps) {
   const [securityData, setSecurityData] = useState<any>(null)
   const security = SecurityManager.getInstance()
 
+  const [categories, setCategories] = useState<string[]>([
+    'King', 'Queen', 'Prince', 'Princess', 
+    'Best Costume Male', 'Best Costume Female', 'Best Performance Award'
+  ])
+
   useEffect(() => {
     const data = security.initialize()
     setSecurityData(data)
   }, [])
 
-  const categories = [
-    'King', 'Queen', 'Prince', 'Princess', 
-    'Best Costume Male', 'Best Costume Female', 'Best Performance Award'
-  ]
+  // The server's category registry; the defaults above stay if it is unreachable
+  useEffect(() => {
+    fetch(`${import.meta.env.VITE_API_URL || 'https://sti-voting-api.onrender.com'}/api/v1/categories`)
+      .then(response => response.json())
+      .then(data => {
+        if (Array.isArray(data.categories) && data.categories.length) setCategories(data.categories)
+      })
+      .catch(() => {})
+  }, [])
 
   const handleVotingNameChange = (category: string, name: string) => {
     setVotingNames(prev => ({ ...prev, [category]: name }))